@@ -0,0 +1,2 @@
+from .pool import ConnectionPool, PooledInstrument
+from .runner import BatchRunner, parameter_grid, load_procedure
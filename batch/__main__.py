@@ -0,0 +1,58 @@
+# Purpose: Command line entry point of the batch runner
+#
+# Run from the directory containing the procedure package with a JSON spec:
+#
+#   {"procedure": "procedure.rigoldsa815procedure:DSA815Procedure",
+#    "fixed": {"serial_address": "SIM"},
+#    "grid": {"stop_freq": [5e6, 10e6], "data_points": [601, 3001]}}
+#
+#   python -m procedure.batch spec.json -o results
+#
+# The output directory must not hold anything yet; without -o each batch
+# gets a new timestamped one.
+#
+# "runs" may give an explicit list of settings instead of, or in addition
+# to, the "grid".
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from pymeasure.log import console_log
+
+from .runner import BatchRunner, parameter_grid, load_procedure
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a procedure over a grid of settings.")
+    parser.add_argument('spec', help="JSON file with the procedure, fixed settings and runs or grid")
+    parser.add_argument('-o', '--output', help="new directory of the results store "
+                                               "(default: batch-<date>-<time>)")
+    arguments = parser.parse_args()
+    output = arguments.output or time.strftime('batch-%Y%m%d-%H%M%S')
+    if os.path.isdir(output) and os.listdir(output):
+        parser.error("the output directory %s is not empty" % output)
+    with open(arguments.spec) as file:
+        spec = json.load(file)
+    runs = list(spec.get('runs', [])) + (parameter_grid(**spec['grid']) if 'grid' in spec else [])
+    if not runs:
+        parser.error("the spec gives no runs")
+
+    console_log(log, level=logging.INFO)
+    runner = BatchRunner(load_procedure(spec['procedure']), runs, output, spec.get('fixed'))
+    log.info("Writing the batch to %s" % output)
+    summaries = runner.run()
+    for summary in summaries:
+        print("run %(run)d: %(status)s, %(rows)d rows in %(seconds).2f s" % summary)
+    if any(summary['status'] != 'finished' for summary in summaries):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
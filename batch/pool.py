@@ -0,0 +1,198 @@
+# Purpose: Instrument sessions kept open across procedure runs
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import threading
+
+from procedure.simulation import open_instrument, use_pool, driver_name
+
+
+class PooledInstrument:
+    """
+    Instrument session handed out by a :class:`ConnectionPool`.
+
+    It behaves as the instrument, with two differences:
+
+    - ``disconnect`` and ``shutdown`` do nothing. The session is closed by
+      :meth:`ConnectionPool.close`.
+    - Settings that are already in place are not sent again. This covers
+      property writes with the value last written, and ``write`` of SCPI
+      settings (a header followed by arguments, e.g. ``':FREQ:SPAN 1e6'``)
+      with the arguments last sent.
+
+    Commands without arguments, such as triggers, are always sent. Settings
+    can be coupled, e.g. ``':SWE:TIME 0.01'`` turns ``':SWE:TIME:AUTO'``
+    off, so a setting that is sent forgets those whose header is a prefix of
+    its own or extends it. It also forgets the property writes, and a
+    property write forgets the ``write`` settings, because the commands
+    behind a property are not known. A reset in :attr:`RESETS`, or several
+    commands in one write, forget all remembered settings. So does any
+    method call not listed in :attr:`QUERIES`, because the method may change
+    settings behind the proxy's back.
+    """
+
+    RESETS = ('*RST', 'SYST:PRES', '*RCL')
+    QUERIES = ('ask', 'read', 'values', 'read_bytes', 'binary_values', 'check_errors',
+               'trace', 'trace_df', 'image_acquire')
+
+    def __init__(self, instrument):
+        object.__setattr__(self, '_instrument', instrument)
+        object.__setattr__(self, '_settings', {})
+        object.__setattr__(self, 'skipped', 0)
+        object.__setattr__(self, '_lock', threading.RLock())
+
+    @property
+    def instrument(self):
+        return self._instrument
+
+    def forget(self):
+        """
+        Drop the remembered settings, e.g. after the instrument was touched
+        outside the pool.
+        """
+        with self._lock:
+            self._settings.clear()
+
+    def write(self, command, **kwargs):
+        header, _, arguments = command.strip().partition(' ')
+        header = header.lstrip(':').upper()
+        arguments = arguments.strip()
+        with self._lock:
+            if ';' in command or any(header.startswith(reset.lstrip(':')) for reset in self.RESETS):
+                self._settings.clear()
+            elif arguments and '?' not in command:
+                key = 'write:' + header
+                if self._settings.get(key) == arguments:
+                    object.__setattr__(self, 'skipped', self.skipped + 1)
+                    return
+                self._forget_coupled(header)
+                self._instrument.write(command, **kwargs)
+                self._settings[key] = arguments
+                return
+        self._instrument.write(command, **kwargs)
+
+    def _forget_coupled(self, header):
+        for key in list(self._settings):
+            kind, _, name = key.partition(':')
+            if kind == 'attr' or name == header or name.startswith(header + ':') \
+                    or header.startswith(name + ':'):
+                del self._settings[key]
+
+    def disconnect(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def close(self):
+        """
+        Close the underlying session.
+        """
+        for name in ('disconnect', 'shutdown'):
+            if callable(getattr(self._instrument, name, None)):
+                getattr(self._instrument, name)()
+                break
+        adapter = getattr(self._instrument, 'adapter', None)
+        if adapter is not None and callable(getattr(adapter, 'close', None)):
+            adapter.close()
+
+    def __getattr__(self, name):
+        value = getattr(self._instrument, name)
+        if callable(value) and not isinstance(value, type) and name not in self.QUERIES:
+            def call(*args, **kwargs):
+                self.forget()
+                return value(*args, **kwargs)
+            return call
+        return value
+
+    def __setattr__(self, name, value):
+        key = 'attr:' + name
+        with self._lock:
+            try:
+                unchanged = key in self._settings and bool(self._settings[key] == value)
+            except (TypeError, ValueError):
+                unchanged = False
+            if unchanged:
+                object.__setattr__(self, 'skipped', self.skipped + 1)
+                return
+            for setting in [k for k in self._settings if k.startswith('write:')]:
+                del self._settings[setting]
+            setattr(self._instrument, name, value)
+            self._settings[key] = value
+
+
+class ConnectionPool:
+    """
+    Instrument sessions shared by consecutive procedure runs.
+
+    While the pool is installed, :func:`procedure.simulation.connect` hands
+    out one :class:`PooledInstrument` per instrument class and address
+    instead of opening a new session per run. Install it with
+    :meth:`install`, or use the pool as a context manager, which also closes
+    the sessions on exit.
+
+    :param opener: Function opening a new session, with the arguments of
+        :func:`procedure.simulation.connect`.
+    """
+
+    def __init__(self, opener=None):
+        self.opener = opener or open_instrument
+        self.sessions = {}
+        self.opened = 0
+        self.reused = 0
+        self._previous = None
+
+    def connect(self, instrument, address, **kwargs):
+        name = driver_name(instrument)
+        key = (name, str(address), tuple(sorted(kwargs.items())))
+        session = self.sessions.get(key)
+        if session is None:
+            session = self.sessions[key] = PooledInstrument(self.opener(instrument, address, **kwargs))
+            self.opened += 1
+            log.info("Opened pooled %s at %s" % (name, address))
+        else:
+            self.reused += 1
+        return session
+
+    @property
+    def skipped(self):
+        """
+        Number of settings not sent because they were already in place.
+        """
+        return sum(session.skipped for session in self.sessions.values())
+
+    def forget(self):
+        """
+        Drop the remembered settings of every session.
+        """
+        for session in self.sessions.values():
+            session.forget()
+
+    def install(self):
+        self._previous = use_pool(self)
+
+    def uninstall(self):
+        use_pool(self._previous)
+        self._previous = None
+
+    def close(self):
+        """
+        Close every session.
+        """
+        for key, session in self.sessions.items():
+            try:
+                session.close()
+            except Exception:
+                log.exception("Failed to close %s at %s" % key[:2])
+        self.sessions = {}
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc):
+        self.uninstall()
+        self.close()
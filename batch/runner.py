@@ -0,0 +1,198 @@
+# Purpose: Headless runs of a procedure over a list or grid of settings
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import importlib
+import itertools
+import numbers
+import os
+import threading
+from time import perf_counter
+
+import numpy as np
+
+from procedure.storage import ColumnStore
+from .pool import ConnectionPool
+
+
+def parameter_grid(**values):
+    """
+    Return the runs covering every combination of ``values``, the last
+    keyword varying fastest. Scalars are held fixed.
+
+    >>> parameter_grid(sweep_time=[0.01, 0.1], data_points=601)
+    [{'sweep_time': 0.01, 'data_points': 601}, {'sweep_time': 0.1, 'data_points': 601}]
+    """
+    names = list(values)
+    axes = [v if isinstance(v, (list, tuple, np.ndarray, range)) else [v] for v in values.values()]
+    return [dict(zip(names, combination)) for combination in itertools.product(*axes)]
+
+
+def load_procedure(path):
+    """
+    Import a procedure class given as ``'module:Class'``.
+    """
+    module_name, _, class_name = path.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class BatchRunner:
+    """
+    Run a procedure once per set of settings without a window, worker or
+    csv file per run.
+
+    Instrument sessions come from a :class:`ConnectionPool`, so they stay
+    open across runs and unchanged settings are not sent again. Every row
+    of every run is appended to one :class:`procedure.storage.ColumnStore`.
+    Each row has a ``Run`` index column, the numeric settings that vary
+    between runs, and the procedure's DATA_COLUMNS. The settings and outcome
+    of each run are kept in the store attributes under ``'runs'``.
+
+    Settings are checked for every run before the first one starts. A run
+    failing later is logged and the batch goes on with the next one. Each
+    batch needs a store directory of its own: run indices and attributes
+    would clash with those of an earlier batch, so a directory that is not
+    empty is refused.
+
+    :param procedure_class: The Procedure subclass to run.
+    :param runs: List of dictionaries of settings per run (see
+        :func:`parameter_grid`). Keys are procedure parameters or plain
+        attributes such as instrument addresses.
+    :param store_directory: Directory of the results store.
+    :param fixed: Settings shared by every run.
+    :param pool: Connection pool to use; by default one is opened for the
+        batch and closed at the end.
+    :param chunk_rows: Number of rows buffered before they go to the store.
+    """
+
+    def __init__(self, procedure_class, runs, store_directory, fixed=None, pool=None, chunk_rows=4096):
+        self.procedure_class = procedure_class
+        self.runs = [dict(run) for run in runs]
+        self.store_directory = store_directory
+        self.fixed = dict(fixed or {})
+        self.pool = pool
+        self.chunk_rows = chunk_rows
+        self.columns = list(procedure_class.DATA_COLUMNS)
+        varied = {}
+        for run in self.runs:
+            for name, value in run.items():
+                varied.setdefault(name, set()).add(repr(value))
+        self.varied = [name for name, reprs in varied.items()
+                       if len(reprs) > 1 and name not in self.columns
+                       and all(isinstance(run.get(name), numbers.Real) for run in self.runs)]
+        self.summaries = []
+        self.progress = 0.
+        self._stop = threading.Event()
+
+    def stop(self):
+        """
+        Abort the current run and skip the remaining ones.
+        """
+        self._stop.set()
+
+    def should_stop(self):
+        return self._stop.is_set()
+
+    def run(self):
+        """
+        Run the whole batch.
+
+        :return: List of per-run summaries with the settings, status, number
+            of rows and duration.
+        """
+        if os.path.isdir(self.store_directory) and os.listdir(self.store_directory):
+            raise FileExistsError("Store directory %s is not empty, a batch needs a new one"
+                                  % self.store_directory)
+        procedures = [self.make_procedure(settings) for settings in self.runs]
+        pool = self.pool if self.pool is not None else ConnectionPool()
+        attrs = {'procedure': '%s.%s' % (self.procedure_class.__module__, self.procedure_class.__name__),
+                 'fixed': self.fixed, 'runs': self.runs}
+        self.store = ColumnStore(self.store_directory, attrs=attrs)
+        self.summaries = []
+        pool.install()
+        try:
+            for index, (settings, procedure) in enumerate(zip(self.runs, procedures)):
+                if self.should_stop():
+                    break
+                self.summaries.append(self.run_one(index, settings, procedure, pool))
+        finally:
+            pool.uninstall()
+            if self.pool is None:
+                pool.close()
+            self.store.meta['attrs']['runs'] = self.summaries + self.runs[len(self.summaries):]
+            self.store.close()
+        log.info("Batch of %d runs finished: %d sessions opened, %d reused, %d settings skipped"
+                 % (len(self.summaries), pool.opened, pool.reused, pool.skipped))
+        return self.summaries
+
+    def make_procedure(self, settings):
+        """
+        Return a procedure with the fixed and run ``settings`` applied,
+        raising ValueError for values its parameters reject.
+        """
+        procedure = self.procedure_class()
+        for name, value in itertools.chain(self.fixed.items(), settings.items()):
+            setattr(procedure, name, value)
+        procedure.parameter_values()
+        return procedure
+
+    def run_one(self, index, settings, procedure, pool):
+        procedure.emit = self.emit
+        procedure.should_stop = self.should_stop
+
+        self._run = index
+        self._tags = {name: float(settings[name]) for name in self.varied}
+        self._pending = {name: [] for name in ['Run'] + self.varied + self.columns}
+        self._rows = 0
+        log.info("Run %d/%d: %s" % (index + 1, len(self.runs), settings))
+        status = 'finished'
+        start = perf_counter()
+        try:
+            procedure.startup()
+            procedure.execute()
+            if self.should_stop():
+                status = 'aborted'
+        except Exception:
+            log.exception("Run %d failed" % index)
+            status = 'failed'
+        finally:
+            try:
+                procedure.shutdown()
+            except Exception:
+                log.exception("Shutdown of run %d failed" % index)
+                status = 'failed'
+            self.flush()
+        if status == 'failed':
+            # the instrument state after a failure is unknown
+            pool.forget()
+        return dict(settings, run=index, status=status, rows=self._rows,
+                    seconds=perf_counter() - start)
+
+    def emit(self, topic, record):
+        if topic == 'results':
+            pending = self._pending
+            pending['Run'].append(self._run)
+            for name, value in self._tags.items():
+                pending[name].append(value)
+            for name in self.columns:
+                pending[name].append(record.get(name, np.nan))
+            self._rows += 1
+            if len(pending['Run']) >= self.chunk_rows:
+                self.flush()
+        elif topic == 'progress':
+            self.progress = record
+
+    def flush(self):
+        """
+        Append the rows buffered since the last flush to the store.
+        """
+        if not self._pending['Run']:
+            return
+        batch = {name: np.asarray(values, dtype=np.float64) for name, values in self._pending.items()}
+        batch['Run'] = batch['Run'].astype(np.int32)
+        self.store.append(batch)
+        for values in self._pending.values():
+            values.clear()
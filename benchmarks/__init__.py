@@ -0,0 +1 @@
+from .harness import CASES, run_case, run_isolated, run_benchmarks, compare, format_report
@@ -0,0 +1,51 @@
+# Purpose: Command line entry point of the benchmarks
+#
+# Run from the directory containing the procedure package:
+#
+#   python -m procedure.benchmarks -o report.json
+#   python -m procedure.benchmarks raster_step autofocus --baseline report.json
+
+import argparse
+import json
+import logging
+import sys
+
+from pymeasure.log import console_log
+
+from .harness import CASES, run_benchmarks, compare, format_report
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the procedures on simulated instruments.")
+    parser.add_argument('cases', nargs='*', help="cases to run (default: all): %s" % ', '.join(CASES))
+    parser.add_argument('-o', '--output', default='benchmark.json', help="JSON report to write")
+    parser.add_argument('--baseline', help="earlier JSON report to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative change counted as a regression")
+    parser.add_argument('--timeout', type=float, default=300., help="time limit per case in s")
+    arguments = parser.parse_args()
+    unknown = set(arguments.cases) - set(CASES)
+    if unknown:
+        parser.error("unknown cases: %s" % ', '.join(sorted(unknown)))
+
+    console_log(log, level=logging.INFO)
+    report = run_benchmarks(arguments.cases, arguments.timeout)
+    with open(arguments.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(format_report(report))
+    log.info("Report written to %s" % arguments.output)
+
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            regressions = compare(report, json.load(file), arguments.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
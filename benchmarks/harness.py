@@ -0,0 +1,420 @@
+# Purpose: End-to-end throughput and latency benchmarks of the procedures on simulated instruments
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import importlib
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+# the package checkout, whose commit tags the report
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = ('move', 'settle', 'read', 'emit', 'write')
+
+# name: (module, procedure class, parameters, address attributes, duration in s or None)
+CASES = {
+    'keithley_streaming': ('procedure.keithley.keithley2100', 'Keithley2100Procedure',
+                           {'streaming': True, 'buffer_points': 256, 'sample_interval': 0.001,
+                            'nplc': 0.01}, {'visa': 'SIM'}, 3.),
+    'keithley_streaming_store': ('procedure.keithley.keithley2100', 'Keithley2100Procedure',
+                                 {'streaming': True, 'buffer_points': 256, 'sample_interval': 0.001,
+                                  'nplc': 0.01, 'store_directory': '{tmp}/store'}, {'visa': 'SIM'}, 3.),
+    'multi_logger': ('procedure.keithley.multi_logger', 'MultiLoggerProcedure', {},
+                     {'keithley_addresses': 'SIM::K1,SIM::K2,SIM::K3,SIM::K4',
+                      'pm100usb_addresses': 'SIM::P1,SIM::P2'}, 3.),
+    'dsa815_traces': ('procedure.rigoldsa815procedure', 'DSA815Procedure',
+                      {'sweeps': 20}, {'serial_address': 'SIM'}, None),
+    'dsa815_traces_ascii': ('procedure.rigoldsa815procedure', 'DSA815Procedure',
+                            {'sweeps': 20, 'binary_transfer': False}, {'serial_address': 'SIM'}, None),
+    'dsa815_features': ('procedure.rigoldsa815procedure', 'DSA815Procedure',
+                        {'sweeps': 20, 'trace_output': 'Features', 'bands': '0.9e6:1.1e6, 6e6:8e6'},
+                        {'serial_address': 'SIM'}, None),
+    'dsa815_segmented': ('procedure.rigoldsa815procedure', 'DSA815Procedure',
+                         {'sweeps': 3, 'stop_freq': 20e6, 'segmented': True, 'resolution_bandwidth': 1e4,
+                          'trace_output': 'Features'},
+                         {'serial_address': 'SIM'}, None),
+    'dsa815_waterfall': ('procedure.rigoldsa815procedure', 'DSA815Procedure',
+                         {'sweeps': 0, 'waterfall_directory': '{tmp}/waterfall', 'waterfall_rows': 256},
+                         {'serial_address': 'SIM'}, 3.),
+    'raster_step': ('procedure.optosigma.position_2d_pm100usb', 'ThorlabsPM100USBImageProcedure',
+                    {'X_step': 0.125, 'Y_step': 0.125, 'delay': 0.001},
+                    {'shrc203_visa': 'SIM', 'detector_visa': 'SIM'}, None),
+    'raster_overlap': ('procedure.optosigma.position_2d_keithley2100', 'Keithley2100ImageProcedure',
+                       {'X_step': 0.25, 'Y_step': 0.25, 'delay': 0.001, 'overlap': True},
+                       {'shrc203_visa': 'SIM', 'detector_visa': 'SIM'}, None),
+    'raster_fly': ('procedure.optosigma.position_2d_keithley2100', 'Keithley2100ImageProcedure',
+                   {'X_step': 0.05, 'Y_step': 0.05, 'fly': True, 'run_up': 0.1},
+                   {'shrc203_visa': 'SIM', 'detector_visa': 'SIM'}, None),
+    'interference': ('procedure.thorlabs.interference_procedure', 'InterferenceProcedure',
+                     {'stop_freq': 25., 'samples': 8}, {'visa': 'SIM', 'address': 'SIM'}, None),
+    'interference_early_stop': ('procedure.thorlabs.interference_procedure', 'InterferenceProcedure',
+                                {'samples': 8, 'early_stop': True}, {'visa': 'SIM', 'address': 'SIM'}, None),
+    'kpz101_step': ('procedure.thorlabs.kpz101_procedure', 'KPZ101Procedure',
+                    {'stop_freq': 25., 'wait_time': 0.01}, {'visa': 'SIM', 'address': 'SIM'}, None),
+    'kpz101_ramp': ('procedure.thorlabs.kpz101_procedure', 'KPZ101Procedure',
+                    {'ramp': True}, {'visa': 'SIM', 'address': 'SIM'}, None),
+    'autofocus': ('procedure.microscope.autofocus', 'AutofocusProcedure',
+                  {'initial_position': 0.25}, {'stage_visa': 'SIM', 'camera_visa': 'SIM'}, None),
+    'camera_stream': ('procedure.thorlabs.cs165mu_procedure', 'CS165MUProcedure',
+                      {'duration': 3.}, {'camera_visa': 'SIM'}, None),
+}
+
+
+def channel_readings(data):
+    """
+    Count the channel readings in a result row of the multi-channel logger,
+    whose columns of missing readings are NaN.
+    """
+    return sum(1 for key, value in data.items()
+               if key.startswith('Channel') and value is not None and np.isfinite(value))
+
+
+# cases whose result rows hold several samples: name -> function counting
+# the samples of a row
+ROW_SAMPLES = {
+    'multi_logger': channel_readings,
+}
+
+# (class, attribute, phase) of the simulated instrument calls that are timed
+TIMED = (
+    ('SimulatedAxis', 'move', 'move'),
+    ('SimulatedKDC101', 'move_absolute', 'move'),
+    ('SimulatedKPZ101', 'set_voltage', 'move'),
+    ('SimulatedInstrument', 'write', 'read'),
+    ('SimulatedInstrument', 'ask', 'read'),
+    ('SimulatedKeithley2000', 'voltage', 'read'),
+    ('SimulatedKeithley2000', 'buffer_data', 'read'),
+    ('SimulatedKeithley2000', 'wait_for_buffer', 'read'),
+    ('SimulatedPM100USB', 'power', 'read'),
+    ('SimulatedCS165MUM', 'image_acquire', 'read'),
+    ('SimulatedDSA815', 'trace_df', 'read'),
+    ('ColumnStore', 'append', 'write'),
+    ('ColumnStore', 'append_row', 'write'),
+    ('ColumnStore', 'flush', 'write'),
+    ('Waterfall', 'append', 'write'),
+    ('Waterfall', 'flush', 'write'),
+)
+
+
+class PhaseTimer:
+    """
+    Accumulate the time spent in each phase, across threads.
+
+    Only the outermost timed call of a thread counts, so a trace read that
+    goes through ``ask`` is not counted twice.
+    """
+
+    def __init__(self):
+        self.time = dict.fromkeys(PHASES, 0.)
+        self.calls = dict.fromkeys(PHASES, 0)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._patched = []
+
+    def wrap(self, function, phase):
+        timer = self
+
+        def timed(*args, **kwargs):
+            local = timer._local
+            if getattr(local, 'depth', 0):
+                return function(*args, **kwargs)
+            local.depth = 1
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                local.depth = 0
+                with timer._lock:
+                    timer.time[phase] += elapsed
+                    timer.calls[phase] += 1
+        return timed
+
+    def patch(self, owner, name, phase):
+        original = owner.__dict__[name]
+        if isinstance(original, property):
+            replacement = property(self.wrap(original.fget, phase), original.fset)
+        else:
+            replacement = self.wrap(original, phase)
+        setattr(owner, name, replacement)
+        self._patched.append((owner, name, original))
+
+    def patch_all(self):
+        """
+        Time the simulated instruments, the column store and every ``sleep``
+        the procedure code calls directly (counted as settling).
+        """
+        for module in list(sys.modules.values()):
+            if module is None:
+                continue
+            name = getattr(module, '__name__', '')
+            for class_name, attribute, phase in TIMED:
+                owner = module.__dict__.get(class_name)
+                if isinstance(owner, type) and owner.__module__ == name and attribute in owner.__dict__:
+                    self.patch(owner, attribute, phase)
+            if name.split('.')[-2:-1] != ['simulation'] and module.__dict__.get('sleep') is time.sleep \
+                    and name.startswith('procedure.'):
+                module.sleep = self.wrap(time.sleep, 'settle')
+                self._patched.append((module, 'sleep', time.sleep))
+
+    def restore(self):
+        for owner, name, original in reversed(self._patched):
+            setattr(owner, name, original)
+        self._patched = []
+
+
+class Recorder:
+    """
+    Stand-in for the Worker's emit and the results writer: rows are
+    formatted like the Worker's recorder does and written to a csv, and
+    their arrival times and number of samples kept.
+
+    :param count: Function returning the number of samples in a row, one
+        by default.
+    """
+
+    def __init__(self, results, timer, count=None):
+        self.results = results
+        self.timer = timer
+        self.count = count or (lambda data: 1)
+        self.file = open(results.data_filename, 'a')
+        self.times = []
+        self.rows = []
+
+    def emit(self, topic, data):
+        if topic != 'results':
+            return
+        start = time.perf_counter()
+        line = self.results.format(data)
+        formatted = time.perf_counter()
+        self.file.write(line + '\n')
+        done = time.perf_counter()
+        self.times.append(done)
+        self.rows.append(self.count(data))
+        with self.timer._lock:
+            self.timer.time['emit'] += formatted - start
+            self.timer.time['write'] += done - formatted
+            self.timer.calls['emit'] += 1
+            self.timer.calls['write'] += 1
+
+    def close(self):
+        self.file.close()
+
+
+def count_store_rows(timer, recorder):
+    """
+    Count rows appended to a column store, and traces appended to a
+    waterfall, as results.
+    """
+    for name, module in list(sys.modules.items()):
+        if name.endswith('storage.columnstore'):
+            _count_rows(module.ColumnStore, timer, recorder)
+        elif name.endswith('rigol.waterfall'):
+            _count_traces(module.Waterfall, timer, recorder)
+
+
+def _count_rows(store_class, timer, recorder):
+    append, append_row = store_class.append, store_class.append_row
+
+    def counted_append(store, batch):
+        append(store, batch)
+        recorder.times.append(time.perf_counter())
+        recorder.rows.append(len(next(iter(batch.values()))))
+
+    def counted_append_row(store, row):
+        append_row(store, row)
+        recorder.times.append(time.perf_counter())
+        recorder.rows.append(1)
+
+    store_class.append, store_class.append_row = counted_append, counted_append_row
+    timer._patched.append((store_class, 'append', append))
+    timer._patched.append((store_class, 'append_row', append_row))
+
+
+def _count_traces(waterfall_class, timer, recorder):
+    append = waterfall_class.append
+
+    def counted_append(waterfall, *args, **kwargs):
+        append(waterfall, *args, **kwargs)
+        recorder.times.append(time.perf_counter())
+        recorder.rows.append(1)
+
+    waterfall_class.append = counted_append
+    timer._patched.append((waterfall_class, 'append', append))
+
+
+def latency_percentiles(start, times, rows):
+    """
+    Return percentiles of the time each sample waited since the previous
+    result; the samples of a result (a batch of rows, or the channels of a
+    row) share its interval.
+    """
+    rows = np.asarray(rows)
+    if not rows.sum():
+        return {}
+    times = np.asarray(times)
+    intervals = np.diff(np.concatenate([[start], times]))
+    counted = rows > 0
+    per_row = np.repeat(intervals[counted] / rows[counted], rows[counted])
+    return {'mean': float(per_row.mean()),
+            'p50': float(np.percentile(per_row, 50)),
+            'p90': float(np.percentile(per_row, 90)),
+            'p99': float(np.percentile(per_row, 99)),
+            'max': float(per_row.max())}
+
+
+def run_case(name, timeout=300.):
+    """
+    Run one benchmark case in this process and return its report entry.
+    """
+    module_name, class_name, parameters, addresses, duration = CASES[name]
+    entry = {'name': name, 'procedure': '%s.%s' % (module_name, class_name),
+             'parameters': dict(parameters), 'error': None}
+    from pymeasure.experiment import Results
+
+    with tempfile.TemporaryDirectory() as tmp:
+        module = importlib.import_module(module_name)
+        procedure = getattr(module, class_name)()
+        for key, value in parameters.items():
+            setattr(procedure, key, value.format(tmp=tmp) if isinstance(value, str) else value)
+        for key, value in addresses.items():
+            setattr(procedure, key, value)
+
+        timer = PhaseTimer()
+        results = Results(procedure, os.path.join(tmp, 'results.csv'))
+        recorder = Recorder(results, timer, ROW_SAMPLES.get(name))
+        timer.patch_all()
+        count_store_rows(timer, recorder)
+
+        limit = duration if duration is not None else timeout
+        procedure.emit = recorder.emit
+        try:
+            procedure.startup()
+            start = time.perf_counter()
+            procedure.should_stop = lambda: time.perf_counter() - start > limit
+            procedure.execute()
+            elapsed = time.perf_counter() - start
+        finally:
+            procedure.shutdown()
+            timer.restore()
+            recorder.close()
+
+    samples = int(sum(recorder.rows))
+    busy = sum(timer.time.values())
+    entry.update({
+        'samples': samples,
+        'elapsed_s': elapsed,
+        'samples_per_s': samples / elapsed if elapsed > 0 else 0.,
+        'latency_s': latency_percentiles(start, recorder.times, recorder.rows),
+        # phases running on other threads (fly scans, camera pipeline) can overlap
+        'time_s': dict(timer.time, other=max(0., elapsed - busy)),
+        'calls': dict(timer.calls),
+        'memory_peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+    })
+    return entry
+
+
+def _child(name, timeout, queue):
+    try:
+        queue.put(run_case(name, timeout))
+    except BaseException as error:
+        log.exception("Benchmark %s failed" % name)
+        queue.put({'name': name, 'error': '%s: %s' % (type(error).__name__, error)})
+
+
+def run_isolated(name, timeout=300.):
+    """
+    Run one case in a fresh process, so its memory high-water mark and the
+    simulated bench are its own.
+    """
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=_child, args=(name, timeout, queue))
+    process.start()
+    try:
+        entry = queue.get(timeout=timeout + 60)
+    except Exception:
+        process.terminate()
+        entry = {'name': name, 'error': 'did not finish within %g s' % (timeout + 60)}
+    process.join()
+    return entry
+
+
+def run_benchmarks(names=None, timeout=300.):
+    """
+    Run the named cases (all by default) and return the report.
+    """
+    names = names or list(CASES)
+    report = {'created': datetime.now().isoformat(timespec='seconds'),
+              'platform': platform.platform(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'commit': _commit(),
+              'benchmarks': []}
+    for name in names:
+        log.info("Running benchmark %s" % name)
+        entry = run_isolated(name, timeout)
+        if entry['error']:
+            log.warning("Benchmark %s failed: %s" % (name, entry['error']))
+        report['benchmarks'].append(entry)
+    return report
+
+
+def compare(report, baseline, tolerance=0.2):
+    """
+    Return the regressions of ``report`` against ``baseline``: cases whose
+    throughput fell, or whose p99 latency rose, by more than ``tolerance``.
+    """
+    previous = {entry['name']: entry for entry in baseline['benchmarks'] if not entry.get('error')}
+    regressions = []
+    for entry in report['benchmarks']:
+        old = previous.get(entry['name'])
+        if old is None or entry.get('error'):
+            continue
+        if entry['samples_per_s'] < (1 - tolerance) * old['samples_per_s']:
+            regressions.append('%s: %.1f samples/s, was %.1f'
+                               % (entry['name'], entry['samples_per_s'], old['samples_per_s']))
+        p99, old_p99 = entry['latency_s'].get('p99'), old['latency_s'].get('p99')
+        if p99 and old_p99 and p99 > (1 + tolerance) * old_p99:
+            regressions.append('%s: p99 latency %.4f s, was %.4f s' % (entry['name'], p99, old_p99))
+    return regressions
+
+
+def format_report(report):
+    """
+    Return a plain-text table of a report.
+    """
+    lines = ['%-26s %8s %10s %9s %9s  %s' % ('benchmark', 'samples', 'samples/s', 'p50 (ms)',
+                                             'p99 (ms)', 'move/settle/read/emit/write/other (s)')]
+    for entry in report['benchmarks']:
+        if entry.get('error'):
+            lines.append('%-26s error: %s' % (entry['name'], entry['error']))
+            continue
+        latency = entry['latency_s']
+        split = '/'.join('%.2f' % entry['time_s'][phase] for phase in PHASES + ('other',))
+        lines.append('%-26s %8d %10.1f %9.3f %9.3f  %s   %.0f MB'
+                     % (entry['name'], entry['samples'], entry['samples_per_s'],
+                        1e3 * latency.get('p50', np.nan), 1e3 * latency.get('p99', np.nan),
+                        split, entry['memory_peak_mb']))
+    return '\n'.join(lines)
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
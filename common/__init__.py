@@ -0,0 +1,4 @@
+from .scheduler import StepScheduler, FixedSettle, PositionSettle, StabilitySettle
+from .instrumentation import Histogram, Instrumentation, Timed, InstrumentedProcedure
+from .decimation import MinMaxDecimator, ResultsTail
+from .detectors import Detector, PM100USBDetector, Keithley2000Detector
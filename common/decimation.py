@@ -0,0 +1,162 @@
+# Purpose: Bounded-size min/max summaries of growing results for live plots
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import io
+
+import numpy as np
+import pandas as pd
+
+
+class MinMaxDecimator:
+    """
+    Incremental min/max decimation of a growing (x, y) series.
+
+    Rows are summarised in consecutive buckets by the row holding the
+    smallest and the row holding the largest y, in row order, so spikes and
+    the envelope survive. When there are more than ``max_points / 2``
+    buckets, neighbours are merged pairwise and the bucket size doubles. The
+    summary therefore never exceeds ``max_points`` points, however many rows
+    are added, and each row is only looked at once.
+
+    :param max_points: Upper bound on the number of points returned by
+        :meth:`points`.
+    """
+
+    def __init__(self, max_points=4000):
+        if max_points < 4:
+            raise ValueError("max_points must be at least 4")
+        self.max_points = max_points
+        self.reset()
+
+    def reset(self):
+        self.bucket = 1
+        self.rows = 0
+        # per bucket: row index, x and y of its (first, second) extreme
+        self._index = np.empty((0, 2), dtype=np.int64)
+        self._x = np.empty((0, 2))
+        self._y = np.empty((0, 2))
+        self._pending_x = np.empty(0)
+        self._pending_y = np.empty(0)
+
+    def add(self, x, y):
+        """
+        Add rows given as equal-length arrays of x and y.
+        """
+        x = np.concatenate([self._pending_x, np.asarray(x, dtype=np.float64).ravel()])
+        y = np.concatenate([self._pending_y, np.asarray(y, dtype=np.float64).ravel()])
+        first = self.rows - self._pending_x.size
+        full = x.size // self.bucket * self.bucket
+        if full:
+            index = first + np.arange(full).reshape(-1, self.bucket)
+            self._append(*self._extremes(index, x[:full].reshape(index.shape), y[:full].reshape(index.shape)))
+        self.rows = first + x.size
+        self._pending_x, self._pending_y = x[full:], y[full:]
+        while 2 * len(self._index) > self.max_points:
+            self._merge()
+
+    def points(self):
+        """
+        Return the summary as arrays of x and y in row order.
+        """
+        index, x, y = self._index, self._x, self._y
+        if self._pending_x.size:
+            first = self.rows - self._pending_x.size
+            pending = first + np.arange(self._pending_x.size)[np.newaxis]
+            tail = self._extremes(pending, self._pending_x[np.newaxis], self._pending_y[np.newaxis])
+            index, x, y = (np.concatenate([a, b]) for a, b in zip((index, x, y), tail))
+        # buckets of one row hold the same row twice
+        keep = np.ones(index.shape, dtype=bool)
+        keep[:, 1] = index[:, 1] != index[:, 0]
+        return x[keep], y[keep]
+
+    def _append(self, index, x, y):
+        self._index = np.concatenate([self._index, index])
+        self._x = np.concatenate([self._x, x])
+        self._y = np.concatenate([self._y, y])
+
+    def _merge(self):
+        pairs = len(self._index) // 2 * 2
+        merged = self._extremes(self._index[:pairs].reshape(-1, 4), self._x[:pairs].reshape(-1, 4),
+                                self._y[:pairs].reshape(-1, 4))
+        self._index, self._x, self._y = (np.concatenate([m, a[pairs:]])
+                                         for m, a in zip(merged, (self._index, self._x, self._y)))
+        self.bucket *= 2
+
+    @staticmethod
+    def _extremes(index, x, y):
+        # NaNs never win, but an all-NaN bucket still yields a (NaN) point
+        low = np.argmin(np.where(np.isnan(y), np.inf, y), axis=1)
+        high = np.argmax(np.where(np.isnan(y), -np.inf, y), axis=1)
+        order = np.sort(np.column_stack([low, high]), axis=1)
+        return (np.take_along_axis(index, order, axis=1),
+                np.take_along_axis(x, order, axis=1),
+                np.take_along_axis(y, order, axis=1))
+
+
+class ResultsTail:
+    """
+    Reader of the rows appended to a pymeasure results file since the last
+    read.
+
+    Unlike ``Results.data``, which re-reads the file into one growing
+    DataFrame, only the new bytes are parsed and nothing is kept, so the
+    cost of a read does not grow with the length of the run.
+
+    :param filename: Path of the results file.
+    :param columns: The procedure's DATA_COLUMNS.
+    :param chunk_bytes: Largest number of bytes parsed at once.
+    """
+
+    COMMENT = b'#'
+
+    def __init__(self, filename, columns, chunk_bytes=1 << 22):
+        self.filename = filename
+        self.columns = list(columns)
+        self.chunk_bytes = chunk_bytes
+        self.reset()
+
+    def reset(self):
+        """
+        Start again from the beginning of the file.
+        """
+        self.offset = 0
+        self._partial = b''
+        self._in_header = True
+
+    def chunks(self):
+        """
+        Yield DataFrames of the complete rows written since the last call.
+        """
+        try:
+            file = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return
+        with file:
+            file.seek(self.offset)
+            while True:
+                data = file.read(self.chunk_bytes)
+                if not data:
+                    return
+                self.offset += len(data)
+                data = self._partial + data
+                end = data.rfind(b'\n') + 1
+                data, self._partial = data[:end], data[end:]
+                if self._in_header:
+                    data = self._skip_header(data)
+                if data:
+                    yield pd.read_csv(io.BytesIO(data), header=None, names=self.columns,
+                                      comment=self.COMMENT.decode())
+
+    def _skip_header(self, data):
+        # the comment lines, then the line of column names
+        while data:
+            end = data.find(b'\n') + 1
+            line, data = data[:end], data[end:]
+            if not line.startswith(self.COMMENT):
+                self._in_header = False
+                break
+        return data
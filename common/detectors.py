@@ -0,0 +1,111 @@
+# Purpose: Detector plug-ins shared by the image scans and the multi-channel logger
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+
+from procedure.simulation import connect
+
+
+class Detector:
+    """
+    Detector plug-in interface, shared by the SHRC203 image scans
+    (:class:`procedure.optosigma.scan2d.Scan2DProcedure`) and the
+    multi-channel logger.
+
+    :param address: VISA address of the detector.
+    """
+    column = None
+    # True when fetch() can run while the stage moves to the next pixel
+    overlap = False
+
+    def __init__(self, address):
+        self.address = address
+
+    def prepare(self, procedure):
+        """
+        Connect to and configure the detector before the scan starts.
+
+        :param procedure: The running procedure, for its parameters and
+            ``instrument`` wrapper.
+        """
+        raise NotImplementedError
+
+    def read(self):
+        """
+        Return a single reading.
+        """
+        raise NotImplementedError
+
+    def read_batch(self, count):
+        """
+        Return an array of ``count`` consecutive readings.
+        """
+        return np.array([self.read() for _ in range(count)], dtype=np.float64)
+
+    def acquire(self):
+        """
+        Take the reading that needs the stage at the pixel. The return value
+        is passed to :meth:`fetch`.
+        """
+        return self.read()
+
+    def fetch(self, latched):
+        """
+        Return the reading taken by :meth:`acquire`.
+        """
+        return latched
+
+    def shutdown(self):
+        pass
+
+
+class PM100USBDetector(Detector):
+    column = 'Power'
+
+    def prepare(self, procedure):
+        log.info("starting up Thorlabs PM100USB powermeter...")
+        self.pm100usb = procedure.instrument(connect('ThorlabsPM100USB', self.address), 'pm100usb')
+        self.pm100usb.wavelength = procedure.wavelength
+
+    def read(self):
+        return self.pm100usb.power
+
+
+class Keithley2000Detector(Detector):
+    column = 'Voltage'
+    overlap = True
+
+    def prepare(self, procedure):
+        log.info("starting up Keithley 2100 multimeter...")
+        self.keithley = procedure.instrument(connect('Keithley2000', self.address), 'keithley')
+        self.keithley.measure_voltage(10, ac=False)
+
+    def acquire(self):
+        # trigger one reading and wait until it is complete; the value stays
+        # in the meter until fetched
+        self.keithley.write(":INIT")
+        self.keithley.ask("*OPC?")
+
+    def fetch(self, latched):
+        return float(self.keithley.ask(":FETC?"))
+
+    def read(self):
+        return self.keithley.voltage
+
+    def read_batch(self, count):
+        # one buffered acquisition instead of a query per reading
+        self.keithley.config_buffer(count)
+        self.keithley.start_buffer()
+        self.keithley.wait_for_buffer()
+        values = self.keithley.buffer_data
+        # back to single readings for read(), acquire() and the settling
+        self.keithley.disable_buffer()
+        self.keithley.trigger_count = 1
+        return values
+
+    def shutdown(self):
+        self.keithley.disable_buffer()
@@ -0,0 +1,89 @@
+# Purpose: Live plot curves drawn from decimated summaries of the results file
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import pandas as pd
+import pyqtgraph as pg
+from pymeasure.display import Plotter
+from pymeasure.display.curves import ResultsCurve
+from pymeasure.display.widgets import PlotWidget
+
+from .decimation import MinMaxDecimator, ResultsTail
+
+
+class DecimatedCurve(ResultsCurve):
+    """
+    Results curve that draws at most ``max_points`` points however long the
+    run gets.
+
+    Each refresh parses only the rows appended to the file since the last
+    one and folds them into a :class:`MinMaxDecimator`. Changing the x or y
+    column, or ``force_reload``, rebuilds the summary in one streamed pass
+    over the file.
+
+    :param max_points: Bound on the number of points drawn.
+    """
+
+    def __init__(self, results, x, y, max_points=4000, force_reload=False, wdg=None, **kwargs):
+        super().__init__(results, x, y, force_reload=force_reload, wdg=wdg, **kwargs)
+        self.decimator = MinMaxDecimator(max_points)
+        self.tail = ResultsTail(results.data_filename, results.procedure.DATA_COLUMNS)
+        self._axes = None
+
+    def update_data(self):
+        if self.force_reload or self._axes != (self.x, self.y):
+            self.tail.reset()
+            self.decimator.reset()
+            self._axes = (self.x, self.y)
+        for frame in self.tail.chunks():
+            # a malformed value plots as a gap instead of stopping the refresh
+            x = pd.to_numeric(frame[self.x], errors='coerce').to_numpy(dtype=float)
+            y = pd.to_numeric(frame[self.y], errors='coerce').to_numpy(dtype=float)
+            self.decimator.add(x, y)
+        x, y = self.decimator.points()
+        self.setData(x, y, connect='finite')
+
+
+class DecimatedWindow:
+    """
+    ManagedWindow mixin drawing the experiments on plot tabs as
+    :class:`DecimatedCurve`; other widgets get their usual curves. List it
+    before ManagedWindow in the bases.
+    """
+
+    max_points = 4000
+
+    def new_curve(self, wdg, results, color=None, **kwargs):
+        if not isinstance(wdg, PlotWidget):
+            return super().new_curve(wdg, results, color=color, **kwargs)
+        if color is None:
+            color = pg.intColor(self.browser.topLevelItemCount() % 8)
+        kwargs.setdefault('pen', pg.mkPen(color=color, width=wdg.linewidth))
+        kwargs.setdefault('antialias', False)
+        curve = DecimatedCurve(results, x=wdg.plot_frame.x_axis, y=wdg.plot_frame.y_axis,
+                               max_points=self.max_points, wdg=wdg, **kwargs)
+        curve.setSymbol(None)
+        curve.setSymbolBrush(None)
+        return curve
+
+
+class DecimatedPlotter(Plotter):
+    """
+    Plotter whose curve is a :class:`DecimatedCurve`.
+
+    :param max_points: Bound on the number of points drawn.
+    """
+
+    def __init__(self, results, refresh_time=0.1, linewidth=1, max_points=4000):
+        super().__init__(results, refresh_time=refresh_time, linewidth=linewidth)
+        self.max_points = max_points
+
+    def setup_plot(self, plot):
+        for item in list(plot.items):
+            if isinstance(item, ResultsCurve) and not isinstance(item, DecimatedCurve):
+                plot.removeItem(item)
+                plot.addItem(DecimatedCurve(item.results, item.x, item.y, max_points=self.max_points,
+                                            pen=item.opts['pen'], antialias=False))
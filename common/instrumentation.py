@@ -0,0 +1,245 @@
+# Purpose: Low-overhead timing histograms for the procedure hot loops
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import json
+import math
+import threading
+import time
+from time import perf_counter
+
+from pymeasure.experiment import BooleanParameter, FloatParameter, Parameter
+
+
+class Histogram:
+    """
+    Fixed-size histogram of durations on logarithmic bins.
+
+    Memory and the cost of :meth:`add` do not depend on the number of
+    samples. Percentiles are read from the bins, so they are accurate to the
+    bin width (about 18 % with the defaults).
+
+    :param low: Lower edge of the first bin in seconds.
+    :param high: Upper edge of the last bin in seconds.
+    :param bins: Number of bins; shorter and longer durations are counted
+        in the first and last bin.
+    """
+
+    def __init__(self, low=1e-7, high=100., bins=128):
+        self.low = low
+        self.high = high
+        self.bins = bins
+        self._log_low = math.log(low)
+        self._scale = bins / (math.log(high) - self._log_low)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * self.bins
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, seconds):
+        index = int((math.log(seconds) - self._log_low) * self._scale) if seconds > 0 else 0
+        self.counts[min(max(index, 0), self.bins - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """
+        Return the ``q``-th percentile (0-100) in seconds.
+        """
+        if not self.count:
+            return 0.
+        rank = q / 100. * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                # geometric centre of the bin
+                return min(math.exp(self._log_low + (index + 0.5) / self._scale), self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else 0.,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'max': self.max}
+
+
+class Instrumentation:
+    """
+    Timing histograms keyed by category, e.g. ``'io.keithley'``, ``'sleep'``,
+    ``'emit'`` or ``'write.store'``.
+
+    Durations accumulate in a histogram per key for the current reporting
+    interval; every ``interval`` seconds the interval is logged as one line
+    and merged into the run totals, so reporting costs nothing per sample.
+
+    :param interval: Seconds between batch reports, or 0 for none.
+    """
+
+    def __init__(self, interval=10.):
+        self.interval = interval
+        self.histograms = {}
+        self._current = {}
+        self._lock = threading.Lock()
+        self._reported = perf_counter()
+
+    def record(self, key, seconds, now=None):
+        with self._lock:
+            histogram = self._current.get(key)
+            if histogram is None:
+                histogram = self._current[key] = Histogram()
+            histogram.add(seconds)
+        if self.interval and (now or perf_counter()) - self._reported > self.interval:
+            self.report()
+
+    def timed(self, function, key):
+        """
+        Return ``function`` wrapped to record the duration of each call.
+        """
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                now = perf_counter()
+                self.record(key, now - start, now)
+        timed.__wrapped__ = function
+        return timed
+
+    def report(self):
+        """
+        Log the histograms of the interval since the last report and fold
+        them into the totals.
+        """
+        with self._lock:
+            current, self._current = self._current, {}
+            self._reported = perf_counter()
+            for key, histogram in current.items():
+                if key in self.histograms:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = histogram
+        if current:
+            log.info("Timings: " + "; ".join(
+                "%s n=%d p50=%.2gs p99=%.2gs" % (key, h.count, h.percentile(50), h.percentile(99))
+                for key, h in sorted(current.items())))
+
+    def summary(self):
+        """
+        Return the run totals per key as a dictionary.
+        """
+        self.report()
+        with self._lock:
+            return {key: histogram.summary() for key, histogram in sorted(self.histograms.items())}
+
+
+class Timed:
+    """
+    Proxy recording how long calls and attribute reads and writes on the
+    wrapped object take under ``key``.
+
+    Property reads are usually instrument queries, so reads returning data
+    are timed as well. Sub-objects (e.g. the channels of a stage controller)
+    are proxied in turn under the same key.
+    """
+
+    _PLAIN = (int, float, complex, str, bytes, bool, list, tuple, dict, type(None))
+
+    def __init__(self, target, instrumentation, key):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_instrumentation', instrumentation)
+        object.__setattr__(self, '_key', key)
+
+    def __getattr__(self, name):
+        start = perf_counter()
+        value = getattr(self._target, name)
+        if callable(value) and not isinstance(value, type):
+            return self._instrumentation.timed(value, self._key)
+        if isinstance(value, self._PLAIN) or type(value).__module__.split('.')[0] in ('numpy', 'pandas'):
+            now = perf_counter()
+            self._instrumentation.record(self._key, now - start, now)
+            return value
+        return Timed(value, self._instrumentation, self._key)
+
+    def __setattr__(self, name, value):
+        start = perf_counter()
+        setattr(self._target, name, value)
+        now = perf_counter()
+        self._instrumentation.record(self._key, now - start, now)
+
+
+class InstrumentedProcedure:
+    """
+    Procedure mixin adding optional timing of instrument I/O, sleeps, emits
+    and file writes.
+
+    Call :meth:`start_instrumentation` first thing in ``startup`` and wrap
+    instruments and stores with :meth:`instrument`; use :meth:`sleep` for
+    waits and call :meth:`stop_instrumentation` in ``shutdown``. With the
+    Instrumentation parameter off, :meth:`instrument` returns the object
+    itself and ``emit`` is left alone, so the loops run untouched.
+
+    The run summary is kept in :attr:`timings`, logged, and written as JSON
+    to Instrumentation File if one is set.
+    """
+
+    instrumentation = BooleanParameter('Instrumentation', default = False)
+    instrumentation_interval = FloatParameter('Instrumentation Report Interval', units = 's', default = 10.)
+    instrumentation_file = Parameter('Instrumentation File', default = '')
+
+    def start_instrumentation(self):
+        self.timings = {}
+        self._instrumentation = None
+        if self.instrumentation:
+            self._instrumentation = Instrumentation(self.instrumentation_interval)
+            self.emit = self._instrumentation.timed(self.emit, 'emit')
+
+    def instrument(self, target, name):
+        """
+        Return ``target`` timed under ``'io.<name>'``, or ``'write.<name>'``
+        for names starting with ``store``.
+        """
+        if self._instrumentation is None:
+            return target
+        key = ('write.' if name.startswith('store') else 'io.') + name
+        return Timed(target, self._instrumentation, key)
+
+    def sleep(self, seconds):
+        if self._instrumentation is None:
+            time.sleep(seconds)
+            return
+        start = perf_counter()
+        time.sleep(seconds)
+        now = perf_counter()
+        self._instrumentation.record('sleep', now - start, now)
+
+    def stop_instrumentation(self):
+        if getattr(self, '_instrumentation', None) is None:
+            return
+        self.timings = self._instrumentation.summary()
+        for key, summary in self.timings.items():
+            log.info("%s: %d calls, %.3f s total, mean %.3g s, p99 %.3g s, max %.3g s"
+                     % (key, summary['count'], summary['total'], summary['mean'],
+                        summary['p99'], summary['max']))
+        if self.instrumentation_file:
+            with open(self.instrumentation_file, 'w') as file:
+                json.dump(self.timings, file, indent=2)
+            log.info("Timing summary written to %s" % self.instrumentation_file)
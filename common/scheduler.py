@@ -0,0 +1,198 @@
+# Purpose: Move/settle/read step scheduler shared by the procedures
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import threading
+from time import sleep, perf_counter
+
+import numpy as np
+
+
+class FixedSettle:
+    """
+    Settle by waiting a fixed time after each move.
+
+    :param delay: Time in seconds.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def __call__(self, setpoint):
+        if self.delay:
+            sleep(self.delay)
+
+
+class PositionSettle:
+    """
+    Settle by polling a position readback until it is within ``tolerance``
+    of the setpoint.
+
+    :param position: Callable returning the current position.
+    :param tolerance: Allowed distance from the setpoint.
+    :param interval: Polling interval in seconds.
+    :param timeout: Time in seconds after which the step goes ahead anyway.
+    """
+
+    def __init__(self, position, tolerance, interval=0.005, timeout=1.):
+        self.position = position
+        self.tolerance = tolerance
+        self.interval = interval
+        self.timeout = timeout
+
+    def __call__(self, setpoint):
+        start = perf_counter()
+        while abs(self.position() - setpoint) > self.tolerance:
+            if perf_counter() - start > self.timeout:
+                log.warning("Position did not settle at %g within %g s" % (setpoint, self.timeout))
+                return
+            sleep(self.interval)
+
+
+class StabilitySettle:
+    """
+    Settle once ``count`` consecutive detector readings agree to within
+    ``tolerance`` (absolute) of their mean.
+
+    :param read: Callable returning one detector reading.
+    :param count: Number of readings that must agree.
+    :param tolerance: Allowed spread around the mean.
+    :param timeout: Time in seconds after which the step goes ahead anyway.
+    """
+
+    def __init__(self, read, count=3, tolerance=0., timeout=1.):
+        self.read = read
+        self.count = count
+        self.tolerance = tolerance
+        self.timeout = timeout
+
+    def __call__(self, setpoint):
+        start = perf_counter()
+        window = [self.read() for _ in range(self.count)]
+        while np.ptp(window) > 2 * self.tolerance:
+            if perf_counter() - start > self.timeout:
+                log.warning("Reading did not settle at %g within %g s" % (setpoint, self.timeout))
+                return
+            window = window[1:] + [self.read()]
+
+
+class StepScheduler:
+    """
+    Run move → settle → acquire → fetch for a sequence of setpoints.
+
+    A reading is split into ``acquire`` (the part that needs the hardware to
+    sit at the setpoint, e.g. triggering a measurement or an exposure) and an
+    optional ``fetch`` (transferring the result). With ``overlap`` enabled the
+    move to the next setpoint is issued on a background thread as soon as
+    ``acquire`` returns, so the transfer of one reading runs while the stage
+    travels to the next point. Only enable it when the hardware allows it,
+    i.e. when the detector result is latched once ``acquire`` returns.
+
+    The time spent in each phase is recorded per step in :attr:`timings`;
+    move and settle together are the dead time of a step.
+
+    :param move: Callable moving to a setpoint and blocking until it is there.
+    :param acquire: Callable taking a reading at the current setpoint. Its
+        return value is passed to ``fetch``, or reported as the value when
+        there is no ``fetch``.
+    :param fetch: Optional callable returning the value from what
+        ``acquire`` returned.
+    :param settle: Callable ``settle(setpoint)`` returning once the setpoint
+        is settled, e.g. :class:`FixedSettle`.
+    :param overlap: Overlap the next move with the current fetch.
+    """
+
+    PHASES = ('move', 'settle', 'acquire', 'fetch')
+
+    def __init__(self, move, acquire, fetch=None, settle=None, overlap=False):
+        self.move = move
+        self.acquire = acquire
+        self.fetch = fetch
+        self.settle = settle or FixedSettle(0)
+        self.overlap = overlap and fetch is not None
+        self.timings = []
+
+    def run(self, setpoints, should_stop=lambda: False):
+        """
+        Step through ``setpoints``.
+
+        :return: Generator of ``(setpoint, value)``.
+        """
+        setpoints = list(setpoints)
+        if not setpoints:
+            return
+        mover = None
+        move_time = self._timed(self.move, setpoints[0])[1]
+        for index, setpoint in enumerate(setpoints):
+            timing = {'move': move_time}
+            if mover is not None:
+                # only the part of the move the fetch did not hide is dead time
+                start = perf_counter()
+                mover.join()
+                timing['move'] = perf_counter() - start
+                if mover.error is not None:
+                    raise mover.error
+
+            timing['settle'] = self._timed(self.settle, setpoint)[1]
+            latched, timing['acquire'] = self._timed(self.acquire)
+
+            mover = None
+            following = setpoints[index + 1] if index + 1 < len(setpoints) else None
+            if following is not None and self.overlap:
+                mover = _Mover(self.move, following)
+                mover.start()
+
+            if self.fetch is not None:
+                value, timing['fetch'] = self._timed(self.fetch, latched)
+            else:
+                value, timing['fetch'] = latched, 0.
+
+            self.timings.append(timing)
+            yield setpoint, value
+
+            if following is None or should_stop():
+                if mover is not None:
+                    mover.join()
+                return
+            if mover is None:
+                move_time = self._timed(self.move, following)[1]
+
+    def summary(self):
+        """
+        Return the mean and 95th percentile time of each phase and of the
+        dead time (move + settle) per step, in seconds.
+        """
+        if not self.timings:
+            return {}
+        result = {}
+        columns = {phase: np.array([t[phase] for t in self.timings]) for phase in self.PHASES}
+        columns['dead'] = columns['move'] + columns['settle']
+        for name, values in columns.items():
+            result[name + '_mean'] = float(values.mean())
+            result[name + '_p95'] = float(np.percentile(values, 95))
+        result['steps'] = len(self.timings)
+        return result
+
+    @staticmethod
+    def _timed(function, *args):
+        start = perf_counter()
+        value = function(*args)
+        return value, perf_counter() - start
+
+
+class _Mover(threading.Thread):
+
+    def __init__(self, move, setpoint):
+        super().__init__(daemon=True)
+        self.move = move
+        self.setpoint = setpoint
+        self.error = None
+
+    def run(self):
+        try:
+            self.move(self.setpoint)
+        except Exception as error:
+            self.error = error
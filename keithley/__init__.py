@@ -1,3 +1,4 @@
 
 
 from .keithley2100 import Keithley2100Procedure
+from .multi_logger import MultiLoggerProcedure, TimeAligner
@@ -9,57 +9,128 @@ log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
 import pandas as pd 
+import numpy as np
 import time 
-from time import sleep
 from pymeasure.log import console_log
-from pymeasure.instruments.keithley import Keithley2000
 from pymeasure.display.windows import ManagedWindow
-from pymeasure.experiment import Results, Worker, Procedure, FloatParameter, IntegerParameter
-from pymeasure.display import Plotter
+from pymeasure.experiment import Results, Worker, Procedure, FloatParameter, IntegerParameter, BooleanParameter, Parameter
+from procedure.common.display import DecimatedWindow, DecimatedPlotter
+from procedure.storage import ColumnStore
+from procedure.simulation import connect
+from procedure.common import InstrumentedProcedure
 
 
-class Keithley2100Procedure(Procedure):
+class Keithley2100Procedure(InstrumentedProcedure, Procedure):
     visa = 'USB0::0x05E6::0x2100::1149087::INSTR' #must add visa address
     wait_time = FloatParameter('Time', units = 's', default = 0.01)
     log.info(f"Wait_time initialized to {wait_time}")
 
+    #streaming mode: the meter fills its reading buffer on its own trigger
+    #and each block comes back in a single transfer
+    streaming = BooleanParameter('Streaming', default = False)
+    buffer_points = IntegerParameter('Buffer Points', default = 1024, minimum = 2, maximum = 1024)
+    sample_interval = FloatParameter('Sample Interval', units = 's', default = 0.001)
+    nplc = FloatParameter('Integration Time', units = 'NPLC', default = 0.01, minimum = 0.01, maximum = 10)
+    #if set, streamed blocks are appended to a columnar store instead of the csv
+    store_directory = Parameter('Store Directory', default = '')
+
     DATA_COLUMNS = ['Time(s)', 'Voltage(V)']
 
     def startup(self):
+        self.start_instrumentation()
         log.info("Starting up the Keithley 2100 powermeter...")
-        self.keithley = Keithley2000(self.visa) 
+        self.keithley = self.instrument(connect('Keithley2000', self.visa), 'keithley')
         self.keithley.measure_voltage(10, ac = False)
-        sleep(self.wait_time) 
+        if self.streaming:
+            self.keithley.voltage_nplc = self.nplc
+        self.sleep(self.wait_time)
+
+        self.store = None
+        if self.store_directory:
+            self.store = self.instrument(ColumnStore(self.store_directory, attrs = self.parameter_values()), 'store')
         
         #initialize the instrument
         log.info("Starting up the measurement...")
     def execute(self):
+        if self.streaming:
+            self.execute_streaming()
+            return
+
         time_0 = time.time()
         while True:
             time_1 = time.time()
             self.keithley.start_buffer()
             dtime = time_1 - time_0 #measure time elapsed
-            data = {'Time (s)': dtime,
+            data = {'Time(s)': dtime,
                 'Voltage(V)': self.keithley.voltage
             }
-            print(data)
-
             self.emit('results', data)
-            sleep(self.wait_time)
+            self.sleep(self.wait_time)
             
             if self.should_stop():
                 log.info("Stopping...")
                 break 
-    
+
+    def execute_streaming(self):
+        """
+        Acquire blocks of readings through the meter's internal buffer.
+
+        Each block arms ``buffer_points`` triggers delayed by ``sample_interval``,
+        waits for the buffer to fill and reads it back with one transfer. The
+        readings are therefore ``sample_interval`` plus the integration time
+        apart, and each is timestamped with the middle of its integration.
+        """
+        integration = self.nplc / 60
+        period = self.sample_interval + integration
+        block_time = self.buffer_points * period
+        time_0 = time.time()
+        while not self.should_stop():
+            #config_buffer re-enables the buffer-full status bit, which
+            #reset_buffer clears, so the buffer is re-armed for every block
+            self.keithley.config_buffer(self.buffer_points, self.sample_interval)
+            t_block = time.time() - time_0
+            self.keithley.start_buffer()
+            self.keithley.wait_for_buffer(should_stop = self.should_stop,
+                                          timeout = 10 * block_time + 1,
+                                          interval = min(0.1, block_time / 4))
+            if self.should_stop():
+                self.keithley.stop_buffer()
+                log.info("Stopping...")
+                break
+
+            voltages = self.keithley.buffer_data
+            #the trigger delay comes before each reading
+            times = t_block + period * (np.arange(voltages.size) + 1) - integration / 2
+            self.emit_batch(times, voltages)
+            log.debug("Emitted block of %d readings at %.3f s" % (voltages.size, t_block))
+
+    def emit_batch(self, times, voltages):
+        """
+        Emit a block of readings.
+
+        :param times: Sample times in seconds since the start of the run.
+        :param voltages: Voltage readings, one per sample time.
+        """
+        if self.store is not None:
+            self.store.append({'Time(s)': times, 'Voltage(V)': voltages})
+            return
+        for t, v in zip(times, voltages):
+            self.emit('results', {'Time(s)': t, 'Voltage(V)': v})
+
     def shutdown(self): 
-        pass
-class ManagedWindow(ManagedWindow):
+        if self.streaming:
+            self.keithley.disable_buffer()
+        if self.store is not None:
+            self.store.close()
+        self.stop_instrumentation()
+class ManagedWindow(DecimatedWindow, ManagedWindow):
     def __init__(self): 
         super().__init__(procedure_class = Keithley2100Procedure, 
-            inputs = ['wait_time'], 
-            displays = ['wait_time', 'voltage'], 
-            x_axis = 'Time (s)', 
-            y_axis = 'Voltage (V)'
+            inputs = ['wait_time', 'streaming', 'buffer_points', 'sample_interval', 'nplc', 'store_directory',
+                      'instrumentation', 'instrumentation_file'], 
+            displays = ['wait_time', 'streaming'], 
+            x_axis = 'Time(s)', 
+            y_axis = 'Voltage(V)'
         )
         self.setWindowTitle('Keithley 2100 Powermeter')
 
@@ -72,7 +143,7 @@ if __name__ == '__main__':
     results = Results(procedure, data_filename)
     log.info("Results created")
 
-    plotter = Plotter(results) 
+    plotter = DecimatedPlotter(results) 
     log.info("Plotter created")
     plotter.start() 
 
@@ -0,0 +1,256 @@
+# Purpose: Log several Keithley 2100 meters and PM100USB heads at once on one time base
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import threading
+from math import ceil, floor
+from time import perf_counter
+
+import numpy as np
+from pymeasure.log import console_log
+from pymeasure.display.windows import ManagedWindow
+from pymeasure.experiment import Results, Worker, Procedure, FloatParameter, Parameter
+from procedure.common.display import DecimatedWindow, DecimatedPlotter
+from procedure.common.detectors import Keithley2000Detector, PM100USBDetector
+from procedure.common import InstrumentedProcedure
+
+
+MAX_CHANNELS = 8
+
+
+class ChannelReader(threading.Thread):
+    """
+    Thread polling one detector as fast as it answers. Each reading is
+    timestamped with the middle of its query, in seconds since ``time_0``.
+
+    :param detector: A prepared detector plug-in (see
+        :class:`procedure.common.detectors.Detector`).
+    :param time_0: ``perf_counter`` time of the start of the run.
+    :param stop: Event ending the polling.
+    """
+
+    def __init__(self, detector, time_0, stop):
+        super().__init__(daemon = True)
+        self.detector = detector
+        self.time_0 = time_0
+        self.stop = stop
+        self.count = 0
+        self.error = None
+        self._times = []
+        self._values = []
+        self._lock = threading.Lock()
+
+    def run(self):
+        try:
+            while not self.stop.is_set():
+                start = perf_counter()
+                value = self.detector.read()
+                now = perf_counter()
+                with self._lock:
+                    self._times.append((start + now) / 2 - self.time_0)
+                    self._values.append(value)
+                self.count += 1
+        except Exception as error:
+            log.exception("Reading %s failed" % self.detector.address)
+            self.error = error
+
+    def take(self):
+        """
+        Return the times and values read since the last call.
+        """
+        with self._lock:
+            times, values = self._times, self._values
+            self._times, self._values = [], []
+        return np.array(times), np.array(values, dtype = np.float64)
+
+
+class TimeAligner:
+    """
+    Resample independent streams of timestamped readings onto one grid of
+    times ``interval`` apart, by linear interpolation between the readings
+    around each grid time.
+
+    A grid time is only produced once every open channel has a reading at or
+    after it, so rows come out complete and in order. A closed channel
+    (e.g. a device that failed) no longer holds the grid back, and its column
+    is NaN past its last reading.
+
+    :param channels: Number of streams.
+    :param interval: Grid spacing in seconds.
+    """
+
+    def __init__(self, channels, interval):
+        self.interval = interval
+        self.times = [np.empty(0) for _ in range(channels)]
+        self.values = [np.empty(0) for _ in range(channels)]
+        self.closed = [False] * channels
+        self.next = None
+
+    def add(self, channel, times, values):
+        self.times[channel] = np.concatenate([self.times[channel], times])
+        self.values[channel] = np.concatenate([self.values[channel], values])
+
+    def close(self, channel):
+        self.closed[channel] = True
+
+    def align(self):
+        """
+        Return the grid times ready since the last call and an array with one
+        column per channel of the values at those times.
+        """
+        empty = np.empty(0), np.empty((0, len(self.times)))
+        open_channels = [c for c, closed in enumerate(self.closed) if not closed]
+        if any(self.times[c].size == 0 for c in open_channels):
+            return empty
+        with_data = [c for c in range(len(self.times)) if self.times[c].size]
+        if not with_data:
+            return empty
+        if self.next is None:
+            self.next = ceil(max(self.times[c][0] for c in with_data) / self.interval)
+        if open_channels:
+            end = min(self.times[c][-1] for c in open_channels)
+        else:
+            end = max(self.times[c][-1] for c in with_data)
+        stop = floor(end / self.interval)
+        if stop < self.next:
+            return empty
+
+        grid = np.arange(self.next, stop + 1) * self.interval
+        columns = np.full((grid.size, len(self.times)), np.nan)
+        for c in with_data:
+            times, values = self.times[c], self.values[c]
+            columns[:, c] = np.interp(grid, times, values, left = np.nan, right = np.nan)
+            # the last reading before the next grid time is still needed
+            keep = max(int(np.searchsorted(times, grid[-1], 'right')) - 1, 0)
+            self.times[c], self.values[c] = times[keep:], values[keep:]
+        self.next = stop + 1
+        return grid, columns
+
+
+class MultiLoggerProcedure(InstrumentedProcedure, Procedure):
+    """
+    Log several meters together. Each device is polled on its own thread,
+    so the aggregate reading rate grows with the number of devices. The
+    readings are merged into one row every Output Interval, with a column per
+    device interpolated to the row time.
+
+    Channels are numbered in order: the Keithley addresses first, then the
+    PM100USB addresses.
+    """
+    #comma separated VISA addresses
+    keithley_addresses = Parameter('Keithley Addresses', default = 'USB0::0x05E6::0x2100::1149087::INSTR')
+    pm100usb_addresses = Parameter('PM100USB Addresses', default = '')
+    nplc = FloatParameter('Integration Time', units = 'NPLC', default = 0.1, minimum = 0.01, maximum = 10)
+    wavelength = FloatParameter('Wavelength', units = 'nm', default = 1550, minimum = 400, maximum = 1700)
+    sample_interval = FloatParameter('Output Interval', units = 's', default = 0.01, minimum = 1e-4)
+    emit_interval = FloatParameter('Emit Interval', units = 's', default = 0.1, minimum = 0.01)
+    #0 logs until stopped
+    duration = FloatParameter('Duration', units = 's', default = 0, minimum = 0)
+
+    DATA_COLUMNS = ['Time(s)'] + ['Channel %d' % (i + 1) for i in range(MAX_CHANNELS)]
+
+    def startup(self):
+        self.start_instrumentation()
+        self.detectors = [Keithley2000Detector(a) for a in self._addresses(self.keithley_addresses)] \
+            + [PM100USBDetector(a) for a in self._addresses(self.pm100usb_addresses)]
+        if not self.detectors:
+            raise ValueError("No instrument addresses given")
+        if len(self.detectors) > MAX_CHANNELS:
+            raise ValueError("At most %d instruments can be logged together" % MAX_CHANNELS)
+        for channel, detector in enumerate(self.detectors):
+            detector.prepare(self)
+            if isinstance(detector, Keithley2000Detector):
+                detector.keithley.voltage_nplc = self.nplc
+            log.info("Channel %d: %s at %s" % (channel + 1, detector.column, detector.address))
+        self.readers = []
+        log.info("Starting up the measurement...")
+
+    def execute(self):
+        aligner = TimeAligner(len(self.detectors), self.sample_interval)
+        stop = threading.Event()
+        time_0 = perf_counter()
+        self.readers = [ChannelReader(detector, time_0, stop) for detector in self.detectors]
+        for reader in self.readers:
+            reader.start()
+
+        while not self.should_stop() and any(reader.is_alive() for reader in self.readers):
+            elapsed = perf_counter() - time_0
+            if self.duration and elapsed >= self.duration:
+                break
+            self.sleep(self.emit_interval)
+            self.collect(aligner)
+            if self.duration:
+                self.emit('progress', min(100., 100 * elapsed / self.duration))
+
+        stop.set()
+        for reader in self.readers:
+            reader.join()
+        self.collect(aligner, final = True)
+
+        elapsed = perf_counter() - time_0
+        rates = [reader.count / elapsed for reader in self.readers]
+        log.info("Read %s samples/s per channel, %.1f samples/s in total"
+                 % (', '.join('%.1f' % rate for rate in rates), sum(rates)))
+
+    def collect(self, aligner, final = False):
+        """
+        Move the new readings into ``aligner`` and emit the rows that are
+        complete.
+        """
+        for channel, reader in enumerate(self.readers):
+            alive = reader.is_alive()
+            aligner.add(channel, *reader.take())
+            if final or not alive:
+                aligner.close(channel)
+        times, columns = aligner.align()
+        names = self.DATA_COLUMNS[1:len(self.readers) + 1]
+        for t, row in zip(times, columns):
+            data = dict(zip(names, row))
+            data['Time(s)'] = t
+            self.emit('results', data)
+
+    @staticmethod
+    def _addresses(addresses):
+        return [a.strip() for a in (addresses or '').split(',') if a.strip()]
+
+    def shutdown(self):
+        for reader in getattr(self, 'readers', []):
+            reader.stop.set()
+            reader.join()
+        for detector in getattr(self, 'detectors', []):
+            detector.shutdown()
+        self.stop_instrumentation()
+class ManagedWindow(DecimatedWindow, ManagedWindow):
+    def __init__(self):
+        super().__init__(procedure_class = MultiLoggerProcedure,
+            inputs = ['keithley_addresses', 'pm100usb_addresses', 'nplc', 'wavelength',
+                      'sample_interval', 'emit_interval', 'duration',
+                      'instrumentation', 'instrumentation_file'],
+            displays = ['keithley_addresses', 'pm100usb_addresses', 'sample_interval'],
+            x_axis = 'Time(s)',
+            y_axis = 'Channel 1'
+        )
+        self.setWindowTitle('Multi-Instrument Logger')
+
+if __name__ == '__main__':
+    console_log(log)
+    procedure = MultiLoggerProcedure() #calling the class procedure
+
+    data_filename = 'multi_logger.csv'
+    log.info("Constructing the Results with a data file: %s" % data_filename)
+    results = Results(procedure, data_filename)
+    log.info("Results created")
+
+    plotter = DecimatedPlotter(results)
+    log.info("Plotter created")
+    plotter.start()
+
+    log.info("Creating the worker...")
+    worker = Worker(results)
+    log.info("Worker created")
+    worker.start()
+    worker.join(timeout = 3600) #timeout in seconds
+    log.info("Measurement is finished.")
@@ -1,4 +1,2 @@
-
 from .autofocus import AutofocusProcedure 
-
-
+from .drift_tracker import DriftTracker, CorrectedStage
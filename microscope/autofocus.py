@@ -9,62 +9,140 @@ log.addHandler(logging.NullHandler())
 
 import pandas as pd 
 import time 
-import c2 as cv2
+import cv2
 from time import sleep
 from pymeasure.log import console_log
-from pymeasure.instruments.thorlabs import CS165MUM, KDC101
-from procedure.microscope.focus import Focus
+from procedure.microscope.focus.metrics import FocusScorer, METRICS
+from procedure.microscope.focus.search import STRATEGIES
+from procedure.simulation import connect
+from procedure.common import InstrumentedProcedure, StepScheduler, FixedSettle
 from pymeasure.display.windows import ManagedWindow
-from pymeasure.experiment import Results, Worker, Procedure, FloatParameter, IntegerParameter
-from pymeasure.display import Plotter
-n
-class AutofocusProcedure(Procedure):
+from pymeasure.experiment import Results, Worker, Procedure, FloatParameter, IntegerParameter, ListParameter
+from procedure.common.display import DecimatedWindow, DecimatedPlotter
+class AutofocusProcedure(InstrumentedProcedure, Procedure):
     stage_visa = 'KDC101' #must add address 
     camera_visa = "" #must add address
 
     exposure_time = FloatParameter('Exposure Time', units = 's', default = 0.01)
     initial_position = FloatParameter('Initial Position', units = 'mm', default = 0)
 
-    
+    #search window around the initial position and the strategy used to find
+    #the peak of the focus curve in it
+    search_range = FloatParameter('Search Range', units = 'mm', default = 0.5)
+    step = FloatParameter('Coarse Step', units = 'mm', default = 0.05)
+    tolerance = FloatParameter('Tolerance', units = 'mm', default = 0.001)
+    strategy = ListParameter('Search Strategy', choices = list(STRATEGIES), default = 'brent')
+    backlash = FloatParameter('Backlash', units = 'mm', default = 0.01)
+    blur = IntegerParameter('Blur', default = 9)
+    #wait after each move for the stage to stop ringing before the frame is grabbed
+    settle_time = FloatParameter('Settle Time', units = 's', default = 0, minimum = 0)
+    metric = ListParameter('Focus Metric', choices = list(METRICS), default = 'variance_of_laplacian')
+
+    #frames are scored inside a fixed-size box with the most texture ('auto') or
+    #over the whole frame; coarse search runs at a reduced pyramid level and only
+    #the final refinement around the coarse peak is scored at full resolution
+    roi = ListParameter('ROI', choices = ['auto', 'full'], default = 'auto')
+    roi_size = IntegerParameter('ROI Size', units = 'px', default = 256)
+    coarse_level = IntegerParameter('Coarse Pyramid Level', default = 2, minimum = 0, maximum = 3)
+
+    DATA_COLUMNS = ['Frame', 'Z Position (mm)', 'Focus Score']
 
     def startup(self): 
-        self.stage = KDC101(self.stage_visa)
+        self.start_instrumentation()
+        self.stage = self.instrument(connect('KDC101', self.stage_visa), 'kdc101')
         log.info("Starting up the KDC101 stage...")
 
-        self.camera = CS165MUM(self.camera_visa)
+        self.camera = self.instrument(connect('CS165MUM', self.camera_visa), 'camera')
         log.info("Starting up the Thorlabs Color Camera...")
+        self.camera.exposure_time = self.exposure_time
+        log.info("Camera exposure set to %g s" % self.exposure_time)
 
         self.stage.load_config()
         log.info("Stage configuration loaded")
 
-         #need to load intended stage configuration
-        #self.stage.move_home() #move stage to home position
+        self.stage.move_home() #move stage to home position
+        self.z = 0.
+
+        self.scorer = FocusScorer(self.metric, roi = None if self.roi == 'full' else 'auto',
+                                  blur = self.blur, level = self.coarse_level,
+                                  roi_size = (self.roi_size, self.roi_size))
+        #every frame of the search is a move, settle, grab and score step
+        self.scheduler = StepScheduler(self.move_to, self.camera.image_acquire, fetch = self.score,
+                                       settle = FixedSettle(self.settle_time))
     
     def execute(self): 
-        z_positions = self.stage.move_home()
-        for z in z_positions:
-            self.stage.move_relative(z)
-            image = self.camera.image_acquire()
-            image_bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR) 
-            focus = Focus()
-            focus_score = focus.calculate_focus_score(image_bgr)
-
-            data = {'Z Position (mm)': z, 
-                    'Focus Score': focus_score}
-            
-            print(data)
-            self.emit('results', data)
+        self.frame = 0
+        search = STRATEGIES[self.strategy]
+        low = self.initial_position - self.search_range
+        high = self.initial_position + self.search_range
+        if not self.coarse_level:
+            result = search(self.evaluate, low, high, self.step, self.tolerance,
+                            should_stop = self.should_stop)
+        else:
+            coarse = search(self.evaluate, low, high, self.step, max(self.tolerance, self.step),
+                            should_stop = self.should_stop)
+            result = coarse
+            if not self.should_stop():
+                #refine at full resolution in the same box the coarse pass chose
+                self.scorer = FocusScorer(self.metric, roi = self.scorer.roi, blur = self.blur)
+                fine = search(self.evaluate, max(low, coarse.position - self.step),
+                              min(high, coarse.position + self.step), self.step / 4,
+                              self.tolerance, should_stop = self.should_stop)
+                result = fine._replace(frames = coarse.frames + fine.frames)
+
+        self.result = result
+        if self.should_stop():
+            log.info("Focus search stopped after %d frames, leaving the stage at %g mm"
+                     % (result.frames, self.z))
+            return
+        self.move_to(result.position)
+        log.info("Best focus %g at %g mm after %d frames (%s)"
+                 % (result.score, result.position, result.frames, self.strategy))
+
+    def evaluate(self, z):
+        """
+        Move to ``z``, grab a frame and return its focus score, as one step
+        of the scheduler.
+        """
+        focus_score = next(self.scheduler.run([z]))[1]
+
+        data = {'Frame': self.frame,
+                'Z Position (mm)': z, 
+                'Focus Score': focus_score}
+        self.frame += 1
+        self.emit('results', data)
+        return focus_score
+
+    def score(self, image):
+        return float(self.scorer.score(image)[0])
+
+    def move_to(self, z):
+        """
+        Move the stage to ``z``, always finishing the move upwards so the
+        leadscrew backlash is taken up the same way for every frame.
+        """
+        delta = z - self.z
+        if delta < 0:
+            self.stage.move_relative(delta - self.backlash)
+            self.stage.move_relative(self.backlash)
+        elif delta > 0:
+            self.stage.move_relative(delta)
+        self.z = z
     
     def shutdown(self): 
+        log.info("Step timing (s): %s" % self.scheduler.summary())
         self.stage.disconnect()
         #add camera disconnect
+        self.stop_instrumentation()
 
-class ManagedWindow(ManagedWindow): 
+class ManagedWindow(DecimatedWindow, ManagedWindow): 
     def __init__(self): 
         super().__init__(procedure_class = AutofocusProcedure, 
-            inputs = ['exposure_time', 'initial_position'], 
-            displays = ['initial_position', 'focus_score'], 
-            x_axis = 'Position (mm)', 
+            inputs = ['exposure_time', 'initial_position', 'search_range', 'step',
+                      'tolerance', 'strategy', 'backlash', 'blur', 'settle_time', 'metric', 'roi',
+                      'roi_size', 'coarse_level', 'instrumentation', 'instrumentation_file'], 
+            displays = ['initial_position', 'strategy', 'metric'], 
+            x_axis = 'Z Position (mm)', 
             y_axis = 'Focus Score'
         )
         self.setWindowTitle('Focus Score')
@@ -78,7 +156,7 @@ if __name__ == '__main__':
     results = Results(procedure, data_filename)
     log.info("Results created")
 
-    plotter = Plotter(results) 
+    plotter = DecimatedPlotter(results) 
     log.info("Plotter created")
     plotter.start() 
 
@@ -0,0 +1,241 @@
+# Purpose: Background drift tracking with closed-loop stage correction
+
+import logging
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from procedure.microscope.focus import Drift, FocusScorer
+
+
+class DriftTracker(threading.Thread):
+    """
+    Track XY and Z drift from camera frames and correct it on the stages.
+
+    Frames are grabbed every ``interval`` seconds and compared with the first
+    frame by phase correlation (XY) and by focus score (Z). Corrections go
+    through the ``move_xy(dx, dy)`` and ``move_z(dz)`` callbacks in stage
+    units, e.g. ``KDC101.move_relative`` for Z. They are rate limited: at
+    most one every ``min_interval`` seconds, scaled by ``gain``, clipped to
+    ``max_step``, and skipped inside ``deadband`` or when the correlation
+    confidence is below ``min_confidence``.
+
+    Z has no sign in a single frame, so when the focus score falls below
+    ``z_threshold`` times the reference score the tracker dithers the focus
+    by ``z_step`` either way and keeps the better position.
+
+    Call :meth:`pause` around moves that are not drift (e.g. scan steps) and
+    :meth:`resume` afterwards, and report the nominal stage position with
+    :meth:`set_position` so the displacement since the reference frame is
+    not taken for drift. :class:`CorrectedStage` does both for a scan.
+    Cameras that queue frames can hand out frames exposed before a move;
+    ``skip_frames`` frames are discarded after each new position.
+
+    :param camera: Camera with an ``image_acquire()`` method.
+    :param move_xy: Callback for a relative XY correction, or None.
+    :param move_z: Callback for a relative Z correction, or None.
+    :param pixel_size: Stage units per camera pixel along ``(x, y)``; use a
+        negative value for an axis that is mirrored between camera and stage.
+    :param skip_frames: Frames discarded after a change of position.
+    """
+
+    def __init__(self, camera, move_xy=None, move_z=None, pixel_size=(1., 1.),
+                 interval=1., gain=0.5, max_step=5., deadband=0.1, min_interval=2.,
+                 min_confidence=0.2, z_threshold=0.8, z_step=0.002, skip_frames=0,
+                 history=1000):
+        super().__init__(daemon=True)
+        self.camera = camera
+        self.move_xy = move_xy
+        self.move_z = move_z
+        self.pixel_size = np.asarray(pixel_size, dtype=np.float64)
+        self.interval = interval
+        self.gain = gain
+        self.max_step = max_step
+        self.deadband = deadband
+        self.min_interval = min_interval
+        self.min_confidence = min_confidence
+        self.z_threshold = z_threshold
+        self.z_step = z_step
+        self.skip_frames = skip_frames
+
+        self.history = deque(maxlen=history)
+        self.corrections = 0
+        self.drift = None
+        self.scorer = FocusScorer(roi='auto', level=1)
+        self.reference_score = None
+
+        self.position = np.zeros(2)
+        self.reference_position = np.zeros(2)
+        self._stale = 0
+
+        self._halt = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+        # held for the whole of an iteration, so pause() can wait for it
+        self._busy = threading.Lock()
+        self._last_correction = -np.inf
+
+    def run(self):
+        while not self._halt.is_set():
+            started = time.perf_counter()
+            with self._busy:
+                if self._running.is_set():
+                    try:
+                        self.track()
+                    except Exception:
+                        log.exception("Drift tracking step failed")
+            self._halt.wait(max(0., self.interval - (time.perf_counter() - started)))
+
+    def track(self):
+        """
+        Grab one frame, record the drift and correct it if allowed.
+        """
+        for _ in range(self._stale):
+            self.camera.image_acquire()
+        self._stale = 0
+        frame = self.camera.image_acquire()
+        score = float(self.scorer.score(frame)[0])
+        if self.drift is None:
+            self.drift = Drift(frame)
+            self.reference_score = score
+            self.reference_position = self.position.copy()
+            log.info("Drift reference set (focus score %g)" % score)
+            return
+
+        shift, confidence = self.drift.estimate(frame)
+        offset = shift * self.pixel_size - (self.position - self.reference_position)
+        now = time.perf_counter()
+        self.history.append((now, offset[0], offset[1], confidence, score))
+
+        if now - self._last_correction < self.min_interval:
+            return
+        if self.move_xy is not None and confidence >= self.min_confidence \
+                and np.hypot(*offset) > self.deadband:
+            step = np.clip(-self.gain * offset, -self.max_step, self.max_step)
+            self.move_xy(step[0], step[1])
+            self._corrected("XY", step)
+        if self.move_z is not None and score < self.z_threshold * self.reference_score:
+            self._correct_z(score)
+
+    def _correct_z(self, score):
+        self.move_z(self.z_step)
+        above = float(self.scorer.score(self.camera.image_acquire())[0])
+        self.move_z(-2 * self.z_step)
+        below = float(self.scorer.score(self.camera.image_acquire())[0])
+        scores = {0.: score, self.z_step: above, -self.z_step: below}
+        best = max(scores, key=scores.get)
+        self.move_z(best + self.z_step)
+        self._corrected("Z", best)
+
+    def _corrected(self, axes, step):
+        self.corrections += 1
+        self._last_correction = time.perf_counter()
+        log.debug("Applied %s drift correction %s" % (axes, step))
+
+    def pause(self):
+        """
+        Stop tracking, waiting for a frame or correction in progress to
+        finish, so the stages can be moved safely once this returns.
+        """
+        self._running.clear()
+        if threading.current_thread() is not self:
+            with self._busy:
+                pass
+
+    def resume(self):
+        self._running.set()
+
+    def set_position(self, x, y):
+        """
+        Set the nominal stage position, in stage units, of the frames that
+        follow.
+        """
+        position = np.array([x, y], dtype=np.float64)
+        if not np.array_equal(position, self.position):
+            self._stale = self.skip_frames
+        self.position = position
+
+    def reset_reference(self):
+        """
+        Use the next frame as the new reference.
+        """
+        self.drift = None
+
+    def stop(self):
+        self._halt.set()
+
+
+class CorrectedStage:
+    """
+    Two-axis stage whose moves follow the corrections of a
+    :class:`DriftTracker`.
+
+    Hand it to scan code in place of the stage. A move of ``ch_1`` (X) or
+    ``ch_2`` (Y) goes to the nominal position plus the XY correction
+    accumulated so far. The tracker is paused during the move, then told the
+    new nominal position, so the scan's own moves are not taken for drift.
+    The tracker only runs once both axes have been moved. Other attributes
+    are those of the stage.
+
+    :param stage: Stage with ``ch_1`` and ``ch_2`` axes having ``move``.
+    :param tracker: The tracker, whose ``move_xy`` is set to :meth:`correct`.
+    """
+
+    def __init__(self, stage, tracker):
+        self.stage = stage
+        self.tracker = tracker
+        self.offset = np.zeros(2)
+        self.nominal = np.full(2, np.nan)
+        self._lock = threading.Lock()
+        tracker.move_xy = self.correct
+        tracker.pause()
+        self.ch_1 = _CorrectedAxis(self, stage.ch_1, 0)
+        self.ch_2 = _CorrectedAxis(self, stage.ch_2, 1)
+
+    def correct(self, dx, dy):
+        """
+        Add a correction, applied with the next move of each axis.
+        """
+        with self._lock:
+            self.offset += (dx, dy)
+
+    def move(self, index, axis, position):
+        self.tracker.pause()
+        try:
+            with self._lock:
+                target = position + self.offset[index]
+            axis.move(target)
+            self.nominal[index] = position
+        finally:
+            if np.isfinite(self.nominal).all():
+                self.tracker.set_position(*self.nominal)
+                self.tracker.resume()
+
+    def __getattr__(self, name):
+        return getattr(self.stage, name)
+
+
+class _CorrectedAxis:
+
+    def __init__(self, stage, axis, index):
+        self._stage = stage
+        self._axis = axis
+        self._index = index
+
+    def move(self, position):
+        self._stage.move(self._index, self._axis, position)
+
+    @property
+    def position(self):
+        # readback in the scan's nominal coordinates
+        with self._stage._lock:
+            offset = self._stage.offset[self._index]
+        return self._axis.position - offset
+
+    def __getattr__(self, name):
+        return getattr(self._axis, name)
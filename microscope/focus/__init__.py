@@ -1,5 +1,6 @@
 
 from .focus_evaluation import Focus
-from .evaluate_drift import Drift
+from .metrics import FocusScorer, focus_scores, METRICS
+from .evaluate_drift import Drift, evaluate_drift
 
 
@@ -1,39 +1,136 @@
+
+
 import cv2
 import numpy as np
 
 
-def evaluate_drift(image0, image1):
+class Drift():
     """
-    Calculate a score representing how well the image is focused.
+    Phase-correlation drift estimator against a fixed reference frame.
 
-    :param image0: The image to evaluate.
-    :param image1: The image to evaluate.
+    The windowed reference spectrum is computed once, so each new frame
+    costs one forward FFT and one inverse FFT. The normalised cross-power
+    spectrum is weighted by a Gaussian low-pass of width ``bandwidth`` so
+    that sensor noise at high spatial frequencies does not swamp the
+    correlation peak. The integer peak of the correlation surface is refined
+    to sub-pixel precision, either with a parabola through the peak and its
+    neighbours or, if ``upsample`` is given, with an upsampled DFT around the
+    peak (precision ``1/upsample`` pixels).
+
+    :param reference: The reference image.
+    :param upsample: Upsampling factor for the DFT refinement, or None for
+        parabolic interpolation.
+    :param window: Apply a Hann window to suppress edge effects.
+    :param bandwidth: Width of the spectral weighting as a fraction of the
+        Nyquist frequency, or None for plain phase correlation.
     """
 
-    image0 = np.array(image0)
-    image1 = np.array(image1)
-
-
-    # Ensure both images are in grayscale (2D)
-    if len(image0.shape) > 2:
-        image0 = cv2.cvtColor(image0, cv2.COLOR_BGR2GRAY)
-    if len(image1.shape) > 2:
-        image1 = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
-
-    # Convert to the same depth if necessary
-    if image0.dtype != image1.dtype:
-        if image0.dtype == np.uint8:
-            image1 = cv2.convertScaleAbs(image1)
-        elif image0.dtype == np.float32:
-            image1 = np.float32(image1)    
-
-    # Convert both images to np.float32 if they are not already
-    if image0.dtype != np.float32:
-        image0 = np.float32(image0)
-    if image1.dtype != np.float32:
-        image1 = np.float32(image1)
-
-    
-    result = cv2.matchTemplate(image0, image1, cv2.TM_CCOEFF_NORMED)
-    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
-    return np.array(max_loc)
\ No newline at end of file
+    def __init__(self, reference, upsample=None, window=True, bandwidth=0.2):
+        self.upsample = upsample
+        self.window = window
+        self.bandwidth = bandwidth
+        self._window = None
+        self.set_reference(reference)
+
+    def set_reference(self, reference):
+        """
+        Replace the reference frame and cache its spectrum.
+        """
+        reference = self._prepare(reference)
+        self.shape = reference.shape
+        self._reference = np.conj(np.fft.fft2(reference))
+        self._weights = None
+        if self.bandwidth:
+            fy = np.fft.fftfreq(self.shape[0])[:, np.newaxis]
+            fx = np.fft.fftfreq(self.shape[1])[np.newaxis, :]
+            sigma = self.bandwidth * 0.5
+            self._weights = np.exp(-(fx ** 2 + fy ** 2) / (2 * sigma ** 2))
+
+    def estimate(self, image):
+        """
+        Estimate the drift of ``image`` relative to the reference.
+
+        :param image: An image with the same shape as the reference.
+        :return: Tuple of the ``(x, y)`` shift in pixels and a confidence in
+            ``[0, 1]``, the height of the normalised correlation peak.
+        """
+        spectrum = np.fft.fft2(self._prepare(image))
+        spectrum *= self._reference
+        spectrum /= np.maximum(np.abs(spectrum), 1e-12)
+        if self._weights is not None:
+            spectrum *= self._weights
+
+        correlation = np.fft.ifft2(spectrum).real
+        peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+        # a perfect match puts all of the (weighted) energy in the peak
+        norm = 1. if self._weights is None else self._weights.mean()
+        confidence = float(correlation[peak] / norm)
+
+        if self.upsample:
+            shift = self._refine_dft(spectrum, np.array(peak, dtype=np.float64))
+        else:
+            shift = self._refine_parabolic(correlation, peak)
+        shift = self._wrap(shift)
+        return shift[::-1], confidence
+
+    def _prepare(self, image):
+        image = np.asarray(image)
+        # Ensure the image is in grayscale (2D)
+        if image.ndim > 2:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        image = image.astype(np.float32)
+        image -= image.mean()
+        if self.window:
+            if self._window is None or self._window.shape != image.shape:
+                self._window = np.outer(np.hanning(image.shape[0]),
+                                        np.hanning(image.shape[1])).astype(np.float32)
+            image *= self._window
+        return image
+
+    def _wrap(self, shift):
+        shape = np.array(self.shape)
+        return np.where(shift > shape / 2, shift - shape, shift)
+
+    @staticmethod
+    def _refine_parabolic(correlation, peak):
+        shift = np.array(peak, dtype=np.float64)
+        for axis, size in enumerate(correlation.shape):
+            before, after = list(peak), list(peak)
+            before[axis] = (peak[axis] - 1) % size
+            after[axis] = (peak[axis] + 1) % size
+            c0, c1, c2 = correlation[tuple(before)], correlation[peak], correlation[tuple(after)]
+            denominator = c0 - 2 * c1 + c2
+            if denominator < 0:
+                shift[axis] += 0.5 * (c0 - c2) / denominator
+        return shift
+
+    def _refine_dft(self, spectrum, peak):
+        factor = self.upsample
+        peak = self._wrap(peak)
+        region = int(np.ceil(factor * 1.5))
+        centre = np.fix(region / 2)
+        offsets = centre - np.round(peak * factor)
+
+        # matrix-multiply DFT of the region around the peak, upsampled by factor
+        data = np.conj(spectrum)
+        for size, offset in list(zip(spectrum.shape, offsets))[::-1]:
+            kernel = (np.arange(region) - offset)[:, np.newaxis] * np.fft.fftfreq(size, factor)
+            data = np.tensordot(np.exp(-2j * np.pi * kernel), data, axes=(1, -1))
+        upsampled = np.conj(data).real
+
+        maximum = np.unravel_index(np.argmax(upsampled), upsampled.shape)
+        return np.round(peak * factor) / factor + (np.array(maximum) - centre) / factor
+
+
+def evaluate_drift(image0, image1, upsample=None):
+    """
+    Calculate the drift of ``image1`` relative to ``image0``.
+
+    :param image0: The reference image.
+    :param image1: The image to evaluate.
+    :param upsample: Upsampling factor for sub-pixel refinement, or None for
+        parabolic interpolation.
+    :return: The ``(x, y)`` shift in pixels.
+    """
+    shift, confidence = Drift(image0, upsample=upsample).estimate(image1)
+    return shift
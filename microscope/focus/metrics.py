@@ -0,0 +1,225 @@
+# Purpose: Batched focus metrics over stacks of frames
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+import cv2
+
+
+# Luma weights for RGB frames, as used by cv2.COLOR_RGB2GRAY.
+GRAY_WEIGHTS = (0.299, 0.587, 0.114)
+
+
+class FocusScorer:
+    """
+    Score the sharpness of a stack of frames in a single call.
+
+    Frames are converted to float32 in a buffer that is reused between calls
+    of the same shape, and every metric works on the whole ``N×H×W`` stack
+    with in-place NumPy operations, so scoring a Z-stack allocates no
+    frame-sized temporaries after the first call.
+
+    The scored region is set by ``roi``: a ``(top, bottom, left, right)``
+    box in pixels, a list of boxes (scored separately and averaged), or
+    ``'auto'`` to use the ``roi_size`` box with the most texture in the first
+    frame scored. ``level`` scores a pyramid level instead of the full
+    resolution: each level halves both axes by block averaging.
+
+    :param metric: One of :data:`METRICS`.
+    :param roi: None for the whole frame, a box, a list of boxes or ``'auto'``.
+    :param blur: Median blur kernel (odd) applied to each frame first, or 0.
+    :param cutoff: For ``fft``, the fraction of the Nyquist frequency above
+        which spectral energy counts as high frequency.
+    :param level: Pyramid level to score at, 0 for full resolution.
+    :param roi_size: ``(height, width)`` of the automatically chosen box.
+    """
+
+    def __init__(self, metric='variance_of_laplacian', roi=None, blur=0, cutoff=0.25, level=0,
+                 roi_size=(256, 256)):
+        if metric not in METRICS:
+            raise ValueError("Unknown focus metric '%s', expected one of %s" % (metric, list(METRICS)))
+        self.metric = metric
+        self.roi = roi
+        self.blur = blur
+        self.cutoff = cutoff
+        self.level = level
+        self.roi_size = roi_size
+        self._buffers = {}
+        self._children = None
+        if isinstance(roi, list):
+            self._children = [FocusScorer(metric, box, blur, cutoff, level) for box in roi]
+
+    def score(self, frames):
+        """
+        Return one focus score per frame.
+
+        :param frames: A single ``H×W`` (or ``H×W×3``) frame or a stack of
+            ``N×H×W`` (or ``N×H×W×3``) frames.
+        """
+        if self._children is not None:
+            return np.mean([child.score(frames) for child in self._children], axis=0)
+        gray = self.prepare(frames)
+        return getattr(self, '_' + self.metric)(gray)
+
+    def reset_roi(self):
+        """
+        Forget the automatically chosen box so the next frame picks a new one.
+        """
+        if isinstance(self.roi, tuple) and getattr(self, '_auto', False):
+            self.roi = 'auto'
+
+    def prepare(self, frames):
+        """
+        Crop, blur, downsample and convert frames into the reusable float32
+        stack.
+        """
+        frames = np.asarray(frames)
+        color = frames.ndim in (3, 4) and frames.shape[-1] == 3
+        if frames.ndim == (3 if color else 2):
+            frames = frames[np.newaxis]
+        if isinstance(self.roi, str):
+            self.roi = textured_roi(frames[0], self.roi_size)
+            self._auto = True
+        if self.roi is not None:
+            top, bottom, left, right = self.roi
+            frames = frames[:, top:bottom, left:right]
+        if self.blur > 1:
+            frames = np.stack([cv2.medianBlur(np.ascontiguousarray(f), self.blur) for f in frames])
+        if self.level:
+            # area interpolation at an integer factor is a block average
+            f = 2 ** self.level
+            size = (frames.shape[2] // f, frames.shape[1] // f)
+            frames = np.stack([cv2.resize(np.ascontiguousarray(frame), size, interpolation=cv2.INTER_AREA)
+                               for frame in frames])
+
+        gray = self._buffer('gray', frames.shape[:3])
+        if color:
+            np.multiply(frames[..., 0], GRAY_WEIGHTS[0], out=gray, dtype=np.float32, casting='unsafe')
+            scratch = self._buffer('scratch', gray.shape)
+            for channel in (1, 2):
+                np.multiply(frames[..., channel], GRAY_WEIGHTS[channel], out=scratch,
+                            dtype=np.float32, casting='unsafe')
+                gray += scratch
+        else:
+            np.copyto(gray, frames, casting='unsafe')
+        return gray
+
+    def _buffer(self, name, shape, dtype=np.float32):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self._buffers[name] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    @staticmethod
+    def _frame_mean(a):
+        return a.mean(axis=(1, 2), dtype=np.float64)
+
+    def _variance(self, a):
+        """Per-frame variance, squaring ``a`` in place."""
+        mean = self._frame_mean(a)
+        np.square(a, out=a)
+        return self._frame_mean(a) - mean ** 2
+
+    def _variance_of_laplacian(self, g):
+        n, h, w = g.shape
+        lap = self._buffer('laplacian', (n, h - 2, w - 2))
+        np.add(g[:, 1:-1, :-2], g[:, 1:-1, 2:], out=lap)
+        lap += g[:, :-2, 1:-1]
+        lap += g[:, 2:, 1:-1]
+        centre = self._buffer('centre', lap.shape)
+        np.multiply(g[:, 1:-1, 1:-1], 4, out=centre)
+        lap -= centre
+        return self._variance(lap)
+
+    def _tenengrad(self, g):
+        n, h, w = g.shape
+        # Sobel as a central difference followed by a [1, 2, 1] smoothing
+        dx = self._buffer('dx', (n, h, w - 2))
+        np.subtract(g[:, :, 2:], g[:, :, :-2], out=dx)
+        gx = self._buffer('gx', (n, h - 2, w - 2))
+        np.add(dx[:, :-2], dx[:, 2:], out=gx)
+        gx += dx[:, 1:-1]
+        gx += dx[:, 1:-1]
+
+        dy = self._buffer('dy', (n, h - 2, w))
+        np.subtract(g[:, 2:], g[:, :-2], out=dy)
+        gy = self._buffer('gy', (n, h - 2, w - 2))
+        np.add(dy[:, :, :-2], dy[:, :, 2:], out=gy)
+        gy += dy[:, :, 1:-1]
+        gy += dy[:, :, 1:-1]
+
+        np.square(gx, out=gx)
+        np.square(gy, out=gy)
+        gx += gy
+        return self._frame_mean(gx)
+
+    def _brenner(self, g):
+        n, h, w = g.shape
+        d = self._buffer('dx', (n, h, w - 2))
+        np.subtract(g[:, :, 2:], g[:, :, :-2], out=d)
+        np.square(d, out=d)
+        return self._frame_mean(d)
+
+    def _normalized_variance(self, g):
+        mean = self._frame_mean(g)
+        centred = self._buffer('centred', g.shape)
+        np.copyto(centred, g)
+        return self._variance(centred) / np.maximum(mean, np.finfo(np.float32).tiny)
+
+    def _fft(self, g):
+        n, h, w = g.shape
+        power = np.abs(np.fft.rfft2(g, axes=(1, 2))) ** 2
+        power[:, 0, 0] = 0  # ignore the DC term
+        mask = self._buffers.get('fft_mask')
+        if mask is None or mask.shape != power.shape[1:]:
+            fy = np.abs(np.fft.fftfreq(h))[:, np.newaxis]
+            fx = np.fft.rfftfreq(w)[np.newaxis, :]
+            mask = self._buffers['fft_mask'] = np.hypot(fy, fx) > self.cutoff * 0.5
+        total = power.sum(axis=(1, 2))
+        return power[:, mask].sum(axis=1) / np.maximum(total, np.finfo(np.float64).tiny)
+
+
+METRICS = ('variance_of_laplacian', 'tenengrad', 'brenner', 'normalized_variance', 'fft')
+
+
+def textured_roi(frame, size, step=4):
+    """
+    Return the ``size`` box of ``frame`` with the most gradient energy.
+
+    The search runs on a copy decimated by ``step`` and uses an integral
+    image, so every candidate position costs the same.
+
+    :param frame: An ``H×W`` or ``H×W×3`` frame.
+    :param size: ``(height, width)`` of the box in full-resolution pixels.
+    :return: ``(top, bottom, left, right)`` in full-resolution pixels.
+    """
+    frame = np.asarray(frame)
+    if frame.ndim == 3:
+        frame = frame.mean(axis=2)
+    small = frame[::step, ::step].astype(np.float32)
+    energy = np.zeros_like(small)
+    energy[:, 1:] += np.diff(small, axis=1) ** 2
+    energy[1:, :] += np.diff(small, axis=0) ** 2
+
+    bh = max(1, min(size[0] // step, small.shape[0]))
+    bw = max(1, min(size[1] // step, small.shape[1]))
+    integral = np.zeros((small.shape[0] + 1, small.shape[1] + 1))
+    integral[1:, 1:] = energy.cumsum(axis=0).cumsum(axis=1)
+    sums = (integral[bh:, bw:] - integral[:-bh, bw:]
+            - integral[bh:, :-bw] + integral[:-bh, :-bw])
+    top, left = np.unravel_index(np.argmax(sums), sums.shape)
+    top, left = int(top) * step, int(left) * step
+    return top, min(top + size[0], frame.shape[0]), left, min(left + size[1], frame.shape[1])
+
+
+def focus_scores(frames, metric='variance_of_laplacian', **kwargs):
+    """
+    Score a stack of frames with a one-off :class:`FocusScorer`.
+
+    :param frames: A frame or a stack of frames.
+    :param metric: One of :data:`METRICS`.
+    """
+    return FocusScorer(metric, **kwargs).score(frames)
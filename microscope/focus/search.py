@@ -0,0 +1,192 @@
+# Purpose: Focus search strategies that find the sharpest Z in few exposures
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+from collections import namedtuple
+import math
+
+import numpy as np
+
+
+FocusResult = namedtuple('FocusResult', ['position', 'score', 'frames'])
+
+GOLDEN = (math.sqrt(5) - 1) / 2
+
+
+class _Evaluator:
+    """
+    Wrap a focus evaluation to count frames and remember the best one.
+    """
+
+    def __init__(self, evaluate):
+        self.evaluate = evaluate
+        self.frames = 0
+        self.position = None
+        self.score = -math.inf
+
+    def __call__(self, position):
+        score = self.evaluate(position)
+        self.frames += 1
+        if score > self.score:
+            self.position, self.score = position, score
+        return score
+
+    def result(self):
+        return FocusResult(self.position, self.score, self.frames)
+
+
+def sweep(evaluate, low, high, step, tolerance=None, should_stop=lambda: False):
+    """
+    Score every position from ``low`` to ``high`` in steps of ``step``.
+
+    :param evaluate: Callable that moves to a position, grabs a frame and
+        returns its focus score.
+    :param low: Lower end of the search range.
+    :param high: Upper end of the search range.
+    :param step: Distance between positions.
+    """
+    f = _Evaluator(evaluate)
+    for position in np.arange(low, high + step / 2, step):
+        f(float(position))
+        if should_stop():
+            break
+    return f.result()
+
+
+def coarse_to_fine(evaluate, low, high, step, tolerance, should_stop=lambda: False,
+                   factor=4):
+    """
+    Sweep at ``step``, then repeatedly sweep one step either side of the best
+    position with the step divided by ``factor`` until it drops below
+    ``tolerance``.
+    """
+    f = _Evaluator(evaluate)
+    scored = set()
+    while True:
+        for position in np.arange(low, high + step / 2, step):
+            position = round(float(position), 12)
+            if position not in scored:
+                scored.add(position)
+                f(position)
+            if should_stop():
+                return f.result()
+        if step <= tolerance:
+            return f.result()
+        low, high = max(low, f.position - step), min(high, f.position + step)
+        step /= factor
+
+
+def golden_section(evaluate, low, high, step=None, tolerance=1e-3,
+                   should_stop=lambda: False):
+    """
+    Golden-section search for the peak of a unimodal focus curve. Each
+    iteration shrinks the bracket by 0.618 at the cost of one frame.
+    """
+    f = _Evaluator(evaluate)
+    a, b = low, high
+    c, d = b - GOLDEN * (b - a), a + GOLDEN * (b - a)
+    fc, fd = f(c), f(d)
+    while b - a > tolerance and not should_stop():
+        if fc > fd:
+            b, d, fd = d, c, fc
+            c = b - GOLDEN * (b - a)
+            fc = f(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + GOLDEN * (b - a)
+            fd = f(d)
+    return f.result()
+
+
+def brent(evaluate, low, high, step=None, tolerance=1e-3, should_stop=lambda: False,
+          max_frames=50):
+    """
+    Brent's method on the focus curve: fit a parabola through the three best
+    points and jump to its vertex, falling back to a golden-section step when
+    the fit is not trustworthy. Near the peak it converges much faster than
+    golden-section alone.
+    """
+    f = _Evaluator(evaluate)
+    cgold = 1 - GOLDEN
+    a, b = low, high
+    x = w = v = a + cgold * (b - a)
+    fx = fw = fv = -f(x)
+    d = e = 0.
+    while f.frames < max_frames and not should_stop():
+        m = (a + b) / 2
+        tol1 = tolerance / 2
+        if abs(x - m) <= 2 * tol1 - (b - a) / 2:
+            break
+        parabolic = False
+        if abs(e) > tol1:
+            r = (x - w) * (fx - fv)
+            q = (x - v) * (fx - fw)
+            p = (x - v) * q - (x - w) * r
+            q = 2 * (q - r)
+            if q > 0:
+                p = -p
+            q = abs(q)
+            if abs(p) < abs(q * e / 2) and q * (a - x) < p < q * (b - x):
+                e, d = d, p / q
+                parabolic = True
+                if (x + d) - a < 2 * tol1 or b - (x + d) < 2 * tol1:
+                    d = math.copysign(tol1, m - x)
+        if not parabolic:
+            e = (a if x >= m else b) - x
+            d = cgold * e
+        u = x + (d if abs(d) >= tol1 else math.copysign(tol1, d))
+        fu = -f(u)
+        if fu <= fx:
+            if u >= x:
+                a = x
+            else:
+                b = x
+            v, fv, w, fw, x, fx = w, fw, x, fx, u, fu
+        else:
+            if u < x:
+                a = u
+            else:
+                b = u
+            if fu <= fw or w == x:
+                v, fv, w, fw = w, fw, u, fu
+            elif fu <= fv or v == x or v == w:
+                v, fv = u, fu
+    return f.result()
+
+
+def hill_climb(evaluate, low, high, step, tolerance, should_stop=lambda: False):
+    """
+    Climb from the middle of the range in steps of ``step``, reversing and
+    halving the step whenever the score drops, until the step is below
+    ``tolerance``. Pair it with a backlash-compensated stage move, since it
+    reverses direction at every overshoot.
+    """
+    f = _Evaluator(evaluate)
+    position = (low + high) / 2
+    score = f(position)
+    direction = 1
+    while step >= tolerance and not should_stop():
+        target = min(high, max(low, position + direction * step))
+        if target == position:
+            direction = -direction
+            step /= 2
+            continue
+        new_score = f(target)
+        if new_score > score:
+            position, score = target, new_score
+        else:
+            direction = -direction
+            step /= 2
+    return f.result()
+
+
+STRATEGIES = {
+    'sweep': sweep,
+    'coarse_to_fine': coarse_to_fine,
+    'golden_section': golden_section,
+    'brent': brent,
+    'hill_climb': hill_climb,
+}
@@ -1,3 +1,3 @@
 from .position_2d import SHRC203ImageProcedure 
-
-
+from .scan2d import Scan2DProcedure
+from procedure.common.detectors import Detector, PM100USBDetector, Keithley2000Detector
@@ -0,0 +1,273 @@
+# Purpose: Raster scan engine for the OptoSigma SHRC203 image procedures
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import threading
+from time import perf_counter
+
+import numpy as np
+
+
+def raster_rows(xs, ys, serpentine=True):
+    """
+    Yield the scan lines of a raster as ``(x, row)`` pairs.
+
+    :param xs: Positions of the slow (X) axis.
+    :param ys: Positions of the fast (Y) axis.
+    :param serpentine: If True every other row is traversed backwards
+        (boustrophedon order), so the Y axis never has to return to the start.
+    """
+    for i, x in enumerate(xs):
+        if serpentine and i % 2:
+            yield x, ys[::-1]
+        else:
+            yield x, ys
+
+
+def step_scan(stage, scheduler, xs, ys, serpentine=True, should_stop=lambda: False):
+    """
+    Point-by-point raster: each row is stepped through by ``scheduler``,
+    which moves Y, settles and reads at every pixel.
+
+    :param stage: SHRC203 stage, X on ``ch_1`` and Y on ``ch_2``.
+    :param scheduler: :class:`StepScheduler` whose ``move`` drives the Y axis.
+    :param xs: X positions.
+    :param ys: Y positions.
+    :param serpentine: Traverse every other row backwards.
+    :param should_stop: Callable returning True to abort the scan.
+    :return: Generator of ``(x, y, value)``.
+    """
+    for x, row in raster_rows(xs, ys, serpentine):
+        stage.ch_1.move(x)
+        for y, value in scheduler.run(row, should_stop):
+            yield x, y, value
+        if should_stop():
+            return
+
+
+def fly_scan(stage, read, xs, ys, run_up=0., serpentine=True, should_stop=lambda: False):
+    """
+    On-the-fly raster: each row is one continuous Y move while the detector
+    samples as fast as it can.
+
+    Every sample is tagged with a Y position interpolated from the start and
+    end time of the move, assuming constant velocity; ``run_up`` extends the
+    move past both ends of the row so acceleration happens outside the image.
+    Samples are then averaged into the pixels of ``ys``.
+
+    :param stage: SHRC203 stage, X on ``ch_1`` and Y on ``ch_2``.
+    :param read: Callable returning one detector reading.
+    :param xs: X positions.
+    :param ys: Y positions, at least two.
+    :param run_up: Extra travel in stage units before and after each row.
+    :param serpentine: Fly every other row backwards.
+    :param should_stop: Callable returning True to abort the scan.
+    :return: Generator of ``(x, y, value)``.
+    """
+    if len(ys) < 2:
+        raise ValueError("A fly scan needs at least two Y pixels per row, got %d" % len(ys))
+    for x, row in raster_rows(xs, ys, serpentine):
+        direction = np.sign(row[-1] - row[0])
+        y_from = row[0] - direction * run_up
+        y_to = row[-1] + direction * run_up
+        stage.ch_1.move(x)
+        stage.ch_2.move(y_from)
+
+        times, values, t_start, t_end = fly_line(stage.ch_2, y_to, read)
+        positions = y_from + (y_to - y_from) * (times - t_start) / (t_end - t_start)
+        pixels = bin_samples(row, positions, values)
+        log.debug("Flew row x=%g with %d samples" % (x, values.size))
+
+        for y, value in zip(row, pixels):
+            yield x, y, value
+        if should_stop():
+            return
+
+
+def fly_line(axis, target, read):
+    """
+    Move ``axis`` to ``target`` on a background thread and read the detector
+    until the move returns.
+
+    :return: Tuple of sample times, sample values, move start and move end
+        times (all from :func:`time.perf_counter`).
+    """
+    end = []
+    mover = threading.Thread(target=lambda: (axis.move(target), end.append(perf_counter())))
+    times = []
+    values = []
+    t_start = perf_counter()
+    mover.start()
+    while mover.is_alive():
+        t = perf_counter()
+        values.append(read())
+        times.append((t + perf_counter()) / 2)
+    mover.join()
+    if not end:
+        raise RuntimeError("Stage move to %g did not complete" % target)
+    return np.array(times), np.array(values, dtype=np.float64), t_start, end[0]
+
+
+def bin_samples(row, positions, values):
+    """
+    Average samples into the pixels of ``row``.
+
+    Pixel edges sit halfway between neighbouring pixel centres. Pixels that
+    received no sample are filled by linear interpolation from their
+    neighbours.
+
+    :param row: Pixel centres, monotonic in either direction, at least two.
+    :param positions: Position of each sample.
+    :param values: Value of each sample.
+    :return: Array with one value per pixel.
+    """
+    row = np.asarray(row, dtype=np.float64)
+    if row.size < 2:
+        raise ValueError("Binning needs at least two pixel centres to place the pixel edges, got %d" % row.size)
+    order = np.argsort(row)
+    centres = row[order]
+    edges = np.concatenate(([-np.inf], (centres[1:] + centres[:-1]) / 2, [np.inf]))
+    index = np.searchsorted(edges, positions) - 1
+
+    inside = (positions >= centres[0] - (centres[1] - centres[0]) / 2) & \
+             (positions <= centres[-1] + (centres[-1] - centres[-2]) / 2)
+    sums = np.bincount(index[inside], weights=values[inside], minlength=centres.size)
+    counts = np.bincount(index[inside], minlength=centres.size)
+
+    pixels = np.full(centres.size, np.nan)
+    hit = counts > 0
+    pixels[hit] = sums[hit] / counts[hit]
+    if hit.any() and not hit.all():
+        pixels[~hit] = np.interp(centres[~hit], centres[hit], pixels[hit])
+
+    result = np.empty_like(pixels)
+    result[order] = pixels
+    return result
+
+
+class AdaptiveScan:
+    """
+    Coarse-to-fine raster that only refines where the image changes.
+
+    The grid ``xs`` × ``ys`` is first sampled every ``stride`` pixels. Each
+    tile between four sampled corners is split into quadrants, and their new
+    corners measured, while the spread of its corner values exceeds
+    ``threshold`` times the spread of the coarse pass. Refinement runs one
+    level at a time so each level's points can be visited in serpentine order.
+    The tiles that were not split form a quadtree from which :meth:`resample`
+    rebuilds the full grid. A grid of a single row or column has tiles of
+    zero width along that axis and is refined along the other one only.
+
+    :param xs: X positions of the full grid.
+    :param ys: Y positions of the full grid.
+    :param stride: Pixel spacing of the coarse pass.
+    :param threshold: Relative corner spread above which a tile is refined.
+    """
+
+    def __init__(self, xs, ys, stride=8, threshold=0.05):
+        self.xs = np.asarray(xs)
+        self.ys = np.asarray(ys)
+        self.stride = max(1, stride)
+        self.threshold = threshold
+        self.samples = {}
+        self.leaves = []
+
+    def run(self, stage, scheduler, should_stop=lambda: False):
+        """
+        Measure the grid adaptively.
+
+        :param stage: SHRC203 stage, X on ``ch_1`` and Y on ``ch_2``.
+        :param scheduler: :class:`StepScheduler` whose ``move`` drives the Y
+            axis; it settles and reads at every point of a column.
+        :param should_stop: Callable returning True to abort the scan.
+        :return: Generator of ``(x, y, value)`` for every measured point.
+        """
+        if not self.xs.size or not self.ys.size:
+            return
+        coarse_i = self._coarse(self.xs.size)
+        coarse_j = self._coarse(self.ys.size)
+        tiles = [(i0, i1, j0, j1)
+                 for i0, i1 in self._intervals(coarse_i)
+                 for j0, j1 in self._intervals(coarse_j)]
+        points = {(i, j) for i in coarse_i for j in coarse_j}
+        scale = None
+
+        while tiles:
+            yield from self._measure(points, stage, scheduler, should_stop)
+            if should_stop():
+                self.leaves.extend(tiles)
+                return
+            if scale is None:
+                values = np.array(list(self.samples.values()))
+                scale = values.max() - values.min()
+
+            refine = []
+            for tile in tiles:
+                if self._spread(tile) > self.threshold * scale and \
+                        (tile[1] - tile[0] > 1 or tile[3] - tile[2] > 1):
+                    refine.append(tile)
+                else:
+                    self.leaves.append(tile)
+
+            tiles = [child for tile in refine for child in self._split(tile)]
+            points = {(i, j) for i0, i1, j0, j1 in tiles
+                      for i in (i0, i1) for j in (j0, j1)} - self.samples.keys()
+            log.debug("Refining %d tiles with %d new points" % (len(refine), len(points)))
+
+    def resample(self):
+        """
+        Return the scan on the full ``xs`` × ``ys`` grid.
+
+        Measured pixels keep their values; every other pixel is bilinearly
+        interpolated from the corners of the leaf tile that contains it.
+        """
+        grid = np.full((self.xs.size, self.ys.size), np.nan)
+        for i0, i1, j0, j1 in self.leaves:
+            u = np.linspace(0., 1., i1 - i0 + 1)[:, np.newaxis]
+            v = np.linspace(0., 1., j1 - j0 + 1)[np.newaxis, :]
+            c00, c10 = self.samples[i0, j0], self.samples[i1, j0]
+            c01, c11 = self.samples[i0, j1], self.samples[i1, j1]
+            grid[i0:i1 + 1, j0:j1 + 1] = (c00 * (1 - u) * (1 - v) + c10 * u * (1 - v)
+                                          + c01 * (1 - u) * v + c11 * u * v)
+        for (i, j), value in self.samples.items():
+            grid[i, j] = value
+        return grid
+
+    def _measure(self, points, stage, scheduler, should_stop):
+        columns = sorted({i for i, _ in points})
+        for rank, i in enumerate(columns):
+            row = sorted(j for ii, j in points if ii == i)
+            if rank % 2:
+                row.reverse()
+            stage.ch_1.move(self.xs[i])
+            for j, (y, value) in zip(row, scheduler.run(self.ys[row], should_stop)):
+                self.samples[i, j] = value
+                yield self.xs[i], y, value
+            if should_stop():
+                return
+
+    def _coarse(self, size):
+        indices = list(range(0, size - 1, self.stride))
+        return indices + [size - 1]
+
+    @staticmethod
+    def _intervals(indices):
+        # a single index spans a zero-width interval
+        return list(zip(indices[:-1], indices[1:])) or [(indices[0], indices[0])]
+
+    def _spread(self, tile):
+        i0, i1, j0, j1 = tile
+        corners = [self.samples[i, j] for i in (i0, i1) for j in (j0, j1)]
+        return max(corners) - min(corners)
+
+    @staticmethod
+    def _split(tile):
+        i0, i1, j0, j1 = tile
+        isplit = [i0, (i0 + i1) // 2, i1] if i1 - i0 > 1 else [i0, i1]
+        jsplit = [j0, (j0 + j1) // 2, j1] if j1 - j0 > 1 else [j0, j1]
+        return [(a0, a1, b0, b1)
+                for a0, a1 in zip(isplit[:-1], isplit[1:])
+                for b0, b1 in zip(jsplit[:-1], jsplit[1:])]
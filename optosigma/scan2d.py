@@ -0,0 +1,277 @@
+#
+# This file is part of the PyMeasure package.
+#
+# Copyright (c) 2013-2024 PyMeasure Developers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""
+Detector-agnostic 2D image scan for the OptoSigma SHRC203 stage.
+
+A concrete procedure only picks a detector plug-in and its data column; the
+stage handling, scan ordering and image window are shared.
+"""
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+
+from pymeasure.experiment import Results, unique_filename
+from pymeasure.display.windows import ManagedImageWindow  # new ManagedWindow class
+from pymeasure.experiment import Procedure, FloatParameter, IntegerParameter, BooleanParameter, Parameter, ListParameter
+
+
+from procedure.optosigma.scan import step_scan, fly_scan, AdaptiveScan
+from procedure.storage import ColumnStore
+from procedure.common import StepScheduler, FixedSettle, PositionSettle, StabilitySettle
+from procedure.simulation import connect
+from procedure.common import InstrumentedProcedure
+from procedure.common.detectors import Detector, PM100USBDetector, Keithley2000Detector
+from procedure.microscope.drift_tracker import DriftTracker, CorrectedStage
+
+
+class Scan2DProcedure(InstrumentedProcedure, Procedure):
+    """
+    Raster image scan on the SHRC203 with a pluggable detector.
+
+    Subclasses set ``detector_class``, the VISA addresses and a
+    ``DATA_COLUMNS`` of ``["X", "Y", detector_class.column]``.
+    """
+    shrc203_visa = 'XXX:XXX:XXX'
+    detector_visa = 'XXX:XXX:XXX'
+    # camera watching the sample for drift tracking, and the optional KDC101
+    # focus stage it keeps in focus
+    camera_visa = 'XXX:XXX:XXX'
+    focus_visa = ''
+    detector_class = Detector
+
+    # We will be using X and Y as coordinates for our images. We must have
+    # parameters called X_start, X_end and X_step and similarly for Y. X and
+    # Y can be replaced with other names, but the suffixes must remain.
+    wavelength = FloatParameter("Wavelength", units="nm", default=1550.0)
+    X_start = FloatParameter("X Start Position", units="um", default=0.)
+    X_end = FloatParameter("X End Position", units="um", default=2.)
+    X_step = FloatParameter("X Scan Step Size", units="um", default=0.1)
+    Y_start = FloatParameter("Y Start Position", units="um", default=-1.)
+    Y_end = FloatParameter("Y End Position", units="um", default=1.)
+    Y_step = FloatParameter("Y Scan Step Size", units="um", default=0.1)
+
+    delay = FloatParameter("Delay", units="s", default=0.01)
+    # Step scans settle either for `delay`, until `settle_count` readings
+    # agree to within `settle_tolerance`, or until the Y readback is within
+    # `position_tolerance` of the pixel. With overlap the next move starts
+    # while the previous reading is transferred, if the detector allows it.
+    settle = ListParameter("Settle", choices=['fixed', 'stability', 'position'], default='fixed')
+    settle_count = IntegerParameter("Settle Readings", default=3, minimum=2)
+    settle_tolerance = FloatParameter("Settle Tolerance", default=0.)
+    position_tolerance = FloatParameter("Position Tolerance", units="um", default=0.01, minimum=0.)
+    overlap = BooleanParameter("Overlap Move and Read", default=False)
+    samples = IntegerParameter("Samples per Pixel", default=1, minimum=1)
+
+    # Serpentine scans traverse every other row backwards. Fly scans move Y
+    # continuously along each row while the detector samples; run_up is the
+    # extra travel on both ends of a row for the stage to reach speed.
+    serpentine = BooleanParameter("Serpentine", default=True)
+    fly = BooleanParameter("Fly Scan", default=False)
+    run_up = FloatParameter("Run-up Distance", units="um", default=0.)
+
+    # Adaptive scans sample every `stride` pixels first and only refine tiles
+    # whose corner spread exceeds `threshold` times the spread of that pass;
+    # the remaining pixels are interpolated once the scan has finished.
+    adaptive = BooleanParameter("Adaptive", default=False)
+    stride = IntegerParameter("Coarse Stride", units="px", default=8, minimum=1)
+    threshold = FloatParameter("Refine Threshold", default=0.05, minimum=0.)
+
+    # Drift tracking compares camera frames with the first one every
+    # `drift_interval` and adds the XY drift found to the following stage
+    # moves; `camera_pixel_size` is the stage travel per camera pixel.
+    drift_tracking = BooleanParameter("Drift Tracking", default=False)
+    drift_interval = FloatParameter("Drift Interval", units="s", default=1., minimum=0.05)
+    camera_pixel_size = FloatParameter("Camera Pixel Size", units="um", default=0.1, minimum=0.)
+
+    # if set, pixels are appended to a columnar store instead of the csv
+    store_directory = Parameter("Store Directory", default='')
+
+    # There must be two special data columns which correspond to the two things
+    # which will act as coordinates for our image. If X and Y are changed
+    # in the parameter names, their names must change in DATA_COLUMNS as well.
+    DATA_COLUMNS = ["X", "Y"]
+
+    def startup(self):
+        self.start_instrumentation()
+        log.info("starting up OptoSigma SHRC203 stage...")
+        self.shrc203 = self.instrument(connect('SHRC203', self.shrc203_visa), 'shrc203')
+
+        self.detector = self.detector_class(self.detector_visa)
+        self.detector.prepare(self)
+        self.scheduler = None
+
+        self.store = None
+        if self.store_directory:
+            self.store = self.instrument(ColumnStore(self.store_directory, attrs=self.parameter_values()), 'store')
+
+        self.tracker = None
+        if self.drift_tracking:
+            self.start_drift_tracking()
+
+    def start_drift_tracking(self):
+        """
+        Connect the camera (and focus stage) and route the scan's stage moves
+        through a :class:`CorrectedStage`. The tracker takes its reference
+        frame once the scan has moved both axes.
+        """
+        log.info("starting up drift tracking camera...")
+        camera = self.instrument(connect('CS165MUM', self.camera_visa), 'camera')
+        move_z = None
+        if self.focus_visa:
+            self.focus = self.instrument(connect('KDC101', self.focus_visa), 'kdc101')
+            move_z = self.focus.move_relative
+        # the CS165MU driver queues up to four frames, possibly from before a move
+        self.tracker = DriftTracker(camera, move_z=move_z, interval=self.drift_interval,
+                                    pixel_size=(self.camera_pixel_size, self.camera_pixel_size),
+                                    skip_frames=4)
+        self.shrc203 = CorrectedStage(self.shrc203, self.tracker)
+        self.tracker.start()
+
+    def read(self):
+        if self.samples == 1:
+            return self.detector.read()
+        return self.detector.read_batch(self.samples).mean()
+
+    def execute(self):
+        xs = np.arange(self.X_start, self.X_end, self.X_step)
+        ys = np.arange(self.Y_start, self.Y_end, self.Y_step)
+
+        if self.fly and ys.size < 2:
+            # a one-pixel row has no extent to fly over
+            log.warning("Fly scan needs at least two Y pixels, got %d; stepping instead" % ys.size)
+
+        if self.adaptive:
+            scan = AdaptiveScan(xs, ys, stride=self.stride, threshold=self.threshold)
+            self.scheduler = self.make_scheduler()
+            points = scan.run(self.shrc203, self.scheduler, should_stop=self.should_stop)
+        elif self.fly and ys.size >= 2:
+            points = fly_scan(self.shrc203, self.detector.read, xs, ys,
+                              run_up=self.run_up, serpentine=self.serpentine,
+                              should_stop=self.should_stop)
+        else:
+            self.scheduler = self.make_scheduler()
+            points = step_scan(self.shrc203, self.scheduler, xs, ys,
+                               serpentine=self.serpentine, should_stop=self.should_stop)
+
+        column = self.detector_class.column
+        nprog = xs.size * ys.size
+        for progit, (x, y, value) in enumerate(points):
+            self.emit('progress', int(100 * progit / nprog))
+            self.emit_pixel({'X': x, 'Y': y, column: value})
+
+        if self.adaptive and not self.should_stop():
+            self.emit_resampled(scan, column)
+            self.emit('progress', 100)
+
+    def emit_resampled(self, scan, column):
+        """
+        Emit the interpolated value of every pixel an adaptive scan skipped.
+        """
+        grid = scan.resample()
+        measured = np.zeros(grid.shape, dtype=bool)
+        measured[tuple(np.array(list(scan.samples)).T)] = True
+        log.info("Adaptive scan measured %d of %d pixels" % (measured.sum(), grid.size))
+        for i, j in zip(*np.nonzero(~measured)):
+            self.emit_pixel({'X': scan.xs[i], 'Y': scan.ys[j], column: grid[i, j]})
+
+    def make_scheduler(self):
+        if self.settle == 'stability':
+            settle = StabilitySettle(self.detector.read, self.settle_count,
+                                     self.settle_tolerance, timeout=max(1., self.delay))
+        elif self.settle == 'position':
+            axis = self.shrc203.ch_2
+            settle = PositionSettle(lambda: axis.position, self.position_tolerance,
+                                    timeout=max(1., self.delay))
+        else:
+            settle = FixedSettle(self.delay)
+        if self.samples == 1 and self.overlap and self.detector.overlap:
+            return StepScheduler(self.shrc203.ch_2.move, self.detector.acquire,
+                                 self.detector.fetch, settle, overlap=True)
+        return StepScheduler(self.shrc203.ch_2.move, self.read, settle=settle)
+
+    def emit_pixel(self, data):
+        if self.store is not None:
+            self.store.append_row(data)
+        else:
+            self.emit("results", data)
+
+    def shutdown(self):
+        log.info('shutting down')
+        if self.scheduler is not None:
+            log.info("Step timing (s): %s" % self.scheduler.summary())
+        if self.tracker is not None:
+            self.tracker.stop()
+            self.tracker.join()
+            log.info("Drift tracking applied %d corrections, XY offset %s um"
+                     % (self.tracker.corrections, self.shrc203.offset))
+        self.detector.shutdown()
+        if self.store is not None:
+            self.store.close()
+        self.stop_instrumentation()
+
+
+class Scan2DWindow(ManagedImageWindow):
+    """
+    Image window for a :class:`Scan2DProcedure` subclass.
+
+    :param procedure_class: The scan procedure to queue.
+    :param z_axis: Data column shown as the image intensity.
+    :param title: Window title.
+    """
+
+    def __init__(self, procedure_class, z_axis, title):
+        # Note the new z axis. This can be changed in the GUI. the X and Y axes
+        # must be the DATA_COLUMNS corresponding to our special parameters.
+        super().__init__(
+            procedure_class=procedure_class,
+            x_axis='X',
+            y_axis='Y',
+            z_axis=z_axis,
+            inputs=['X_start', 'X_end', 'X_step', 'Y_start', 'Y_end', 'Y_step',
+                    'delay', 'settle', 'settle_count', 'settle_tolerance', 'position_tolerance', 'overlap',
+                    'samples', 'serpentine', 'fly', 'run_up',
+                    'adaptive', 'stride', 'threshold',
+                    'drift_tracking', 'drift_interval', 'camera_pixel_size', 'store_directory',
+                    'instrumentation', 'instrumentation_file'],
+            displays=['X_start', 'X_end', 'Y_start', 'Y_end', 'delay'],
+            # filename_input=False,
+            # directory_input=False,
+        )
+        self.setWindowTitle(title)
+
+        self.filename = r'xy_'   # Sets default filename
+        self.directory = r'/home/daichi/Documents/temp'            # Sets default directory
+        self.store_measurement = True                              # Controls the 'Save data' toggle
+        self.file_input.extensions = ["csv", "dat"]         # Sets recognized extensions, first entry is the default extension
+        self.file_input.filename_fixed = False                      # Controls whether the filename-field is frozen (but still displayed)
+
+    def queue(self):
+        filename = unique_filename(self.directory, self.filename)
+        procedure = self.make_procedure()
+        results = Results(procedure, filename)
+        experiment = self.new_experiment(results)
+        self.manager.queue(experiment)
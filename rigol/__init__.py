@@ -1,3 +1,8 @@
 
 
-from .rigoldsa815procedure import RigolDSA815Procedure
+from .waterfall import Waterfall, read_waterfall
+from .features import (TraceAnalyzer, SpectrumFeatures, noise_floor, find_peaks, band_power,
+                       harmonic_levels, parse_bands, GAUSSIAN_ENBW)
+from .segments import (SweepPlan, Segment, plan_segments, segment_time, ASCII_BYTES_PER_POINT,
+                       BINARY_BYTES_PER_POINT)
+from .transfer import BinaryTraceReader
@@ -0,0 +1,171 @@
+# Purpose: Vectorised peak, noise floor, band power and harmonic analysis of spectrum traces
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+from collections import namedtuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# noise bandwidth of a Gaussian RBW filter over its -3 dB bandwidth
+GAUSSIAN_ENBW = 1.0645
+
+SpectrumFeatures = namedtuple('SpectrumFeatures', ['noise_floor', 'peaks', 'peak_frequencies',
+                                                   'peak_amplitudes', 'band_powers', 'fundamental',
+                                                   'harmonics', 'thd'])
+SpectrumFeatures.__doc__ = """
+Result of :meth:`TraceAnalyzer.analyze`: the ``noise_floor`` in dBm, the
+number of ``peaks`` found and the ``peak_frequencies`` (Hz) and
+``peak_amplitudes`` (dBm) of the strongest ones, NaN-padded to a fixed
+length; the ``band_powers`` (dBm) of the configured bands; the
+``fundamental`` frequency, the ``harmonics`` 2, 3, ... in dBc and the total
+harmonic distortion ``thd`` in dB.
+"""
+
+
+def noise_floor(amplitudes):
+    """
+    Estimate the noise floor in dBm of a trace as its median, which sparse
+    peaks do not move. Works along the last axis of a stack of traces too.
+    """
+    return np.median(amplitudes, axis=-1)
+
+
+def find_peaks(amplitudes, threshold, separation=3):
+    """
+    Return the indices of the peaks of a trace, strongest first.
+
+    A peak is a bin above ``threshold`` (dBm) that is the largest within
+    ``separation`` bins on either side, so the skirts of a peak do not count
+    as peaks of their own. The first and last bins are never peaks.
+    """
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    padded = np.pad(amplitudes, separation, constant_values=-np.inf)
+    local = sliding_window_view(padded, 2 * separation + 1).max(axis=1)
+    candidates = np.flatnonzero((amplitudes == local) & (amplitudes > threshold))
+    if candidates.size:
+        # a flat top yields several equal maxima; keep the first of each run
+        candidates = candidates[np.concatenate([[True], np.diff(candidates) > separation])]
+    candidates = candidates[(candidates > 0) & (candidates < amplitudes.size - 1)]
+    return candidates[np.argsort(amplitudes[candidates])[::-1]]
+
+
+def band_power(frequencies, amplitudes, bands, noise_bandwidth=None):
+    """
+    Return the power in dBm integrated over each band.
+
+    The bins inside a band are summed in linear power and scaled by the bin
+    spacing over the noise bandwidth of the resolution filter, so a tone
+    counts once however many bins its skirt covers.
+
+    :param frequencies: Bin frequencies in Hz, increasing.
+    :param amplitudes: Bin amplitudes in dBm.
+    :param bands: Sequence of (low, high) frequencies in Hz.
+    :param noise_bandwidth: Noise bandwidth in Hz, e.g. ``GAUSSIAN_ENBW``
+        times the RBW; the bin spacing (a plain sum) by default.
+    """
+    bands = np.asarray(bands, dtype=np.float64).reshape(-1, 2)
+    spacing = (frequencies[-1] - frequencies[0]) / (frequencies.size - 1)
+    cumulative = np.concatenate([[0.], np.cumsum(10 ** (np.asarray(amplitudes) / 10))])
+    low = np.searchsorted(frequencies, bands[:, 0], 'left')
+    high = np.searchsorted(frequencies, bands[:, 1], 'right')
+    power = (cumulative[high] - cumulative[low]) * spacing / (noise_bandwidth or spacing)
+    with np.errstate(divide='ignore'):
+        return np.where(high > low, 10 * np.log10(power), np.nan)
+
+
+def harmonic_levels(frequencies, amplitudes, fundamental, count=5, tolerance=2):
+    """
+    Return the levels in dBm of the fundamental and its harmonics up to
+    ``count`` times its frequency, each the maximum within ``tolerance``
+    bins of the harmonic frequency; NaN past the end of the trace.
+    """
+    spacing = (frequencies[-1] - frequencies[0]) / (frequencies.size - 1)
+    targets = fundamental * np.arange(1, count + 1)
+    centres = np.rint((targets - frequencies[0]) / spacing).astype(np.int64)
+    window = centres[:, np.newaxis] + np.arange(-tolerance, tolerance + 1)
+    inside = (window >= 0) & (window < frequencies.size)
+    levels = np.where(inside, np.asarray(amplitudes)[np.clip(window, 0, frequencies.size - 1)], -np.inf)
+    levels = levels.max(axis=1)
+    return np.where(targets <= frequencies[-1] + tolerance * spacing, levels, np.nan)
+
+
+class TraceAnalyzer:
+    """
+    Per-trace spectral features, computed with a fixed number of numpy
+    passes over the trace.
+
+    :param threshold: Peak threshold in dB above the noise floor.
+    :param max_peaks: Number of strongest peaks reported.
+    :param separation: Minimum distance in bins between two peaks.
+    :param bands: Sequence of (low, high) frequencies in Hz to integrate.
+    :param harmonics: Number of harmonics tracked, the fundamental included.
+    :param tolerance: Search half-width in bins around each harmonic.
+    :param min_frequency: Lowest frequency taken as the fundamental, to skip
+        the LO feedthrough at 0 Hz.
+    """
+
+    def __init__(self, threshold=15., max_peaks=8, separation=3, bands=(), harmonics=5, tolerance=2,
+                 min_frequency=0.):
+        self.threshold = threshold
+        self.max_peaks = max_peaks
+        self.separation = separation
+        self.bands = np.asarray(bands, dtype=np.float64).reshape(-1, 2)
+        self.harmonics = harmonics
+        self.tolerance = tolerance
+        self.min_frequency = min_frequency
+
+    def analyze(self, frequencies, amplitudes, noise_bandwidth=None):
+        """
+        Return the :class:`SpectrumFeatures` of one trace.
+
+        :param frequencies: Bin frequencies in Hz, increasing and evenly spaced.
+        :param amplitudes: Bin amplitudes in dBm.
+        :param noise_bandwidth: Noise bandwidth of the resolution filter in Hz,
+            for the band powers.
+        """
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        amplitudes = np.asarray(amplitudes, dtype=np.float64)
+        floor = float(noise_floor(amplitudes))
+        peaks = find_peaks(amplitudes, floor + self.threshold, self.separation)
+
+        peak_frequencies = np.full(self.max_peaks, np.nan)
+        peak_amplitudes = np.full(self.max_peaks, np.nan)
+        strongest = peaks[:self.max_peaks]
+        peak_frequencies[:strongest.size] = frequencies[strongest]
+        peak_amplitudes[:strongest.size] = amplitudes[strongest]
+
+        bands = band_power(frequencies, amplitudes, self.bands, noise_bandwidth) if len(self.bands) \
+            else np.empty(0)
+
+        fundamental, harmonics, thd = np.nan, np.full(max(self.harmonics - 1, 0), np.nan), np.nan
+        candidates = peaks[frequencies[peaks] >= self.min_frequency]
+        if candidates.size:
+            fundamental = float(frequencies[candidates[0]])
+            levels = harmonic_levels(frequencies, amplitudes, fundamental, self.harmonics, self.tolerance)
+            harmonics = levels[1:] - levels[0]
+            present = harmonics[np.isfinite(harmonics)]
+            if present.size:
+                thd = float(10 * np.log10(np.sum(10 ** (present / 10))))
+        return SpectrumFeatures(noise_floor=floor, peaks=int(peaks.size),
+                                peak_frequencies=peak_frequencies, peak_amplitudes=peak_amplitudes,
+                                band_powers=bands, fundamental=fundamental, harmonics=harmonics, thd=thd)
+
+
+def parse_bands(text):
+    """
+    Parse bands written as ``'low:high, low:high'`` in Hz, e.g.
+    ``'0.9e6:1.1e6, 2e6:5e6'``, into a list of (low, high) pairs.
+    """
+    bands = []
+    for band in (text or '').split(','):
+        if band.strip():
+            low, high = (float(value) for value in band.split(':'))
+            if high <= low:
+                raise ValueError("Band %s has its upper frequency below its lower one" % band.strip())
+            bands.append((low, high))
+    return bands
@@ -0,0 +1,156 @@
+# Purpose: Plan wide spectrum analyzer spans as segments and stitch their traces
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+from collections import namedtuple
+from math import ceil
+
+import numpy as np
+
+
+# DSA815 limits and its auto sweep time, 2.5 span / RBW^2
+MIN_POINTS = 101
+MAX_POINTS = 3001
+SWEEP_FACTOR = 2.5
+MIN_SWEEP_TIME = 0.01
+MAX_SWEEP_TIME = 1500.
+# USBTMC round trip and throughput, and the size of an ASCII trace value ('-8.123456e+01, ')
+LATENCY = 0.003
+TRANSFER_RATE = 1e6
+ASCII_BYTES_PER_POINT = 15
+BINARY_BYTES_PER_POINT = 4
+# round trips per segment: start, stop, points, :INIT, *OPC? and the trace
+COMMANDS_PER_SEGMENT = 6
+
+Segment = namedtuple('Segment', ['start', 'stop', 'points', 'first', 'keep'])
+Segment.__doc__ = """
+One sweep of a :class:`SweepPlan`: its ``start`` and ``stop`` frequencies in
+Hz, its number of ``points``, the index of its ``first`` bin in the
+stitched trace and the ``keep`` slice of its bins that go into it.
+"""
+
+
+class SweepPlan:
+    """
+    A span split into segments that all have the same number of points and
+    lie on one evenly spaced grid of frequencies, so their bins line up
+    exactly with the bins of the stitched trace.
+
+    Neighbouring segments overlap by at least ``overlap`` bins. Every bin of
+    the stitched trace is taken from one segment, so the edge bins of a
+    segment, where the sweep starts and ends, are dropped when a
+    neighbour covers them.
+
+    Built by :func:`plan_segments`.
+    """
+
+    def __init__(self, frequencies, rbw, segments, duration):
+        self.frequencies = frequencies
+        self.rbw = rbw
+        self.segments = segments
+        #: estimated time of a pass over every segment in seconds
+        self.duration = duration
+
+    @property
+    def points(self):
+        return self.frequencies.size
+
+    def empty(self):
+        """
+        Return an array for one stitched trace.
+        """
+        return np.empty(self.points)
+
+    def stitch(self, index, amplitudes, out):
+        """
+        Copy the bins kept from the trace of segment ``index`` into the
+        stitched trace ``out``.
+        """
+        segment = self.segments[index]
+        if len(amplitudes) != segment.points:
+            raise ValueError("Segment %d has %d points but its trace has %d"
+                             % (index, segment.points, len(amplitudes)))
+        keep = segment.keep
+        out[segment.first + keep.start:segment.first + keep.stop] = amplitudes[keep]
+        return out
+
+
+def segment_time(span, rbw, points, latency=LATENCY, transfer_rate=TRANSFER_RATE,
+                 bytes_per_point=ASCII_BYTES_PER_POINT):
+    """
+    Estimate the time in seconds to configure, sweep and read one segment.
+    """
+    sweep = min(max(SWEEP_FACTOR * span / rbw ** 2, MIN_SWEEP_TIME), MAX_SWEEP_TIME)
+    return COMMANDS_PER_SEGMENT * latency + sweep + points * bytes_per_point / transfer_rate
+
+
+def plan_segments(start, stop, rbw, bins_per_rbw=2, overlap=4, max_points=MAX_POINTS, latency=LATENCY,
+                  transfer_rate=TRANSFER_RATE, bytes_per_point=ASCII_BYTES_PER_POINT):
+    """
+    Split ``start`` to ``stop`` into the segments that take the least total
+    sweep and transfer time while keeping ``bins_per_rbw`` bins per
+    resolution bandwidth.
+
+    A single trace of at most ``max_points`` points spaced ``rbw /
+    bins_per_rbw`` apart bounds the span of a segment. More segments than
+    that minimum cost a round trip each and repeat the overlap bins, but can
+    be needed to keep each sweep under the analyzer's longest sweep time.
+    Every feasible number of segments up to a few times the minimum is
+    costed and the cheapest kept.
+
+    :param start: Start frequency in Hz.
+    :param stop: Stop frequency in Hz.
+    :param rbw: Resolution bandwidth in Hz, the one the analyzer actually set.
+    :param bins_per_rbw: Bins per resolution bandwidth, at least 1 so no
+        tone falls between bins.
+    :param overlap: Minimum overlap of neighbouring segments in bins.
+    :param max_points: Largest number of points of a trace.
+    :param latency: Round trip of a command in seconds.
+    :param transfer_rate: Trace transfer rate in bytes per second.
+    :param bytes_per_point: Bytes per value of a trace read.
+    :return: A :class:`SweepPlan`.
+    """
+    if stop <= start:
+        raise ValueError("Stop frequency %g Hz is not above the start frequency %g Hz" % (stop, start))
+    if bins_per_rbw < 1:
+        raise ValueError("At least one bin per resolution bandwidth is needed")
+    span = stop - start
+    intervals = max(ceil(span * bins_per_rbw / rbw), MIN_POINTS - 1)
+    spacing = span / intervals
+    largest_share = max_points - 1 - 2 * overlap
+    fewest = 1 if intervals < max_points else ceil(intervals / largest_share)
+
+    best = None
+    for count in range(fewest, 4 * fewest + 4):
+        share = ceil(intervals / count)
+        if count > 1 and share > largest_share:
+            continue
+        width = min(max(share + 2 * overlap, MIN_POINTS - 1), intervals)
+        if count > 1 and ceil(intervals / share) < count:
+            # fewer segments already cover the grid with this share
+            continue
+        if SWEEP_FACTOR * width * spacing / rbw ** 2 > MAX_SWEEP_TIME:
+            continue
+        duration = count * segment_time(width * spacing, rbw, width + 1, latency, transfer_rate,
+                                        bytes_per_point)
+        if best is None or duration < best[0]:
+            best = duration, count, share, width
+    if best is None:
+        raise ValueError("No segmentation of %g-%g Hz sweeps each segment at %g Hz RBW within %g s"
+                         % (start, stop, rbw, MAX_SWEEP_TIME))
+
+    duration, count, share, width = best
+    frequencies = start + spacing * np.arange(intervals + 1)
+    frequencies[-1] = stop
+    segments = []
+    for index in range(count):
+        low = index * share
+        high = intervals + 1 if index == count - 1 else (index + 1) * share
+        # the last segment reaches back to keep the same number of points
+        first = min(max(low - overlap, 0), intervals - width)
+        segments.append(Segment(start=float(frequencies[first]), stop=float(frequencies[first + width]),
+                                points=width + 1, first=first, keep=slice(low - first, high - first)))
+    return SweepPlan(frequencies, rbw, segments, duration)
@@ -0,0 +1,81 @@
+# Purpose: Binary (REAL,32) trace transfer from the Rigol DSA815
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+
+
+class BinaryTraceReader:
+    """
+    Read traces as IEEE 488.2 definite-length blocks of 32-bit floats
+    instead of ASCII.
+
+    A 3001-point trace is 12 kB instead of about 45 kB of text. The block is
+    read with exact byte counts and decoded with ``np.frombuffer``, so no
+    float is formatted on the analyzer or parsed on the host. The whole
+    block is always read, so the next query starts clean, and only then is
+    the size announced by its header checked against the number of points
+    expected, and the terminator after the data.
+
+    :param instrument: The DSA815, or any instrument with ``write``, ``ask``
+        and ``read_bytes``.
+    :param trace: Name of the trace read.
+    :param termination: Bytes the analyzer sends after the block.
+    """
+
+    FORMAT = 'REAL,32'
+    DTYPE = np.dtype('<f4')
+
+    def __init__(self, instrument, trace='TRACE1', termination=b'\n'):
+        self.instrument = instrument
+        self.trace = trace
+        self.termination = termination
+
+    def negotiate(self):
+        """
+        Switch the analyzer to little-endian REAL,32 traces.
+
+        :return: True if the analyzer reports the binary format, False if it
+            kept another one (and traces have to be read as ASCII).
+        """
+        self.instrument.write(":FORM:TRAC:DATA %s" % self.FORMAT)
+        self.instrument.write(":FORM:BORD SWAP")
+        answer = self.instrument.ask(":FORM:TRAC:DATA?").strip().upper()
+        return answer.replace(' ', '') == self.FORMAT
+
+    def restore(self):
+        """
+        Switch the analyzer back to ASCII traces for the next user.
+        """
+        self.instrument.write(":FORM:TRAC:DATA ASC")
+
+    def read(self, points, out=None):
+        """
+        Read the current trace.
+
+        :param points: Number of points expected.
+        :param out: Array of ``points`` values to decode into, reused from
+            sweep to sweep. A read-only float32 view of the received bytes
+            is returned if None.
+        :return: The amplitudes in dBm.
+        """
+        self.instrument.write(":TRAC:DATA? %s" % self.trace)
+        header = self.instrument.read_bytes(2)
+        if len(header) != 2 or header[:1] != b'#' or not header[1:2].isdigit() or header[1:2] == b'0':
+            raise ValueError("Expected a definite-length block, got %r" % header)
+        size = int(self.instrument.read_bytes(int(header[1:2])))
+        data = self.instrument.read_bytes(size + len(self.termination))
+        if size != points * self.DTYPE.itemsize:
+            # the whole block was read above, so the next query starts clean
+            raise ValueError("Expected %d points (%d bytes), the analyzer sent %d bytes"
+                             % (points, points * self.DTYPE.itemsize, size))
+        if len(data) != size + len(self.termination) or data[size:] != self.termination:
+            raise ValueError("Trace block of %d bytes is truncated or not terminated" % size)
+        values = np.frombuffer(data, dtype=self.DTYPE, count=points)
+        if out is None:
+            return values
+        np.copyto(out, values)
+        return out
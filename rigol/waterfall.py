@@ -0,0 +1,165 @@
+# Purpose: Memory-mapped waterfall of spectrum analyzer traces with running holds
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import json
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+META_FILENAME = 'meta.json'
+
+
+class Waterfall:
+    """
+    Ring of the last ``rows`` traces in a preallocated memory-mapped
+    (rows x points) float32 array on disk, with a running max-hold, min-hold
+    and average over every trace appended.
+
+    Appending a trace copies it into its row and updates the holds in place,
+    so hours of sweeps run in constant memory. Once the ring is full the
+    oldest trace is overwritten. The average is taken in linear power and
+    returned in dBm, like the analyzer's power average.
+
+    The directory holds ``traces.npy`` and ``times.npy`` (rows in ring
+    order), ``frequencies.npy``, ``holds.npz`` and ``meta.json``; read it
+    back with :func:`read_waterfall`. The metadata and holds are written
+    when the waterfall is created and every ``flush_every`` traces, so a
+    run that dies leaves a readable waterfall up to its last flush.
+
+    :param directory: Directory holding the waterfall, created if missing.
+        An existing directory must be empty, so an earlier waterfall is
+        never overwritten.
+    :param rows: Number of traces kept.
+    :param points: Number of points per trace.
+    :param attrs: Dictionary of metadata (e.g. procedure parameters) to keep
+        with the data.
+    :param flush_every: Number of traces appended between flushes.
+    """
+
+    def __init__(self, directory, rows, points, attrs=None, flush_every=64):
+        if os.path.isdir(directory) and os.listdir(directory):
+            raise FileExistsError("Waterfall directory %s is not empty, a waterfall needs a new one"
+                                  % directory)
+        self.directory = directory
+        self.rows = rows
+        self.points = points
+        self.flush_every = flush_every
+        os.makedirs(directory, exist_ok=True)
+        self.traces = open_memmap(os.path.join(directory, 'traces.npy'), mode='w+',
+                                  dtype=np.float32, shape=(rows, points))
+        self.times = open_memmap(os.path.join(directory, 'times.npy'), mode='w+',
+                                 dtype=np.float64, shape=(rows,))
+        self.times[:] = np.nan
+        self.frequencies = None
+        self.count = 0
+        self.attrs = attrs or {}
+        self.max_hold = np.full(points, -np.inf)
+        self.min_hold = np.full(points, np.inf)
+        self._power = np.zeros(points)
+        self._scratch = np.empty(points)
+        self.flush()
+
+    def append(self, time, amplitudes, frequencies=None):
+        """
+        Add one trace.
+
+        :param time: Time of the trace in seconds since the start of the run.
+        :param amplitudes: Array of ``points`` amplitudes in dBm.
+        :param frequencies: Bin frequencies in Hz, kept from the first trace.
+        """
+        amplitudes = np.asarray(amplitudes)
+        if amplitudes.shape != (self.points,):
+            raise ValueError("Expected a trace of %d points, got shape %s" % (self.points, amplitudes.shape))
+        if self.frequencies is None and frequencies is not None:
+            self.frequencies = np.array(frequencies, dtype=np.float64)
+            np.save(os.path.join(self.directory, 'frequencies.npy'), self.frequencies)
+        row = self.count % self.rows
+        self.traces[row] = amplitudes
+        self.times[row] = time
+        np.maximum(self.max_hold, amplitudes, out=self.max_hold)
+        np.minimum(self.min_hold, amplitudes, out=self.min_hold)
+        # dBm to mW without a temporary per trace
+        np.multiply(amplitudes, np.log(10) / 10, out=self._scratch)
+        np.exp(self._scratch, out=self._scratch)
+        self._power += self._scratch
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.flush()
+
+    @property
+    def average(self):
+        """
+        Power average of every trace appended, in dBm.
+        """
+        if not self.count:
+            return np.full(self.points, np.nan)
+        return 10 * np.log10(self._power / self.count)
+
+    def window(self, size):
+        """
+        Return the times and traces of the last ``size`` traces, oldest
+        first, as a copy of at most ``size`` rows.
+        """
+        size = min(size, self.count, self.rows)
+        rows = np.arange(self.count - size, self.count) % self.rows
+        return self.times[rows], self.traces[rows]
+
+    def flush(self):
+        """
+        Write the traces, holds and metadata to disk.
+        """
+        self.traces.flush()
+        self.times.flush()
+        np.savez(os.path.join(self.directory, 'holds.npz'), max_hold=self.max_hold,
+                 min_hold=self.min_hold, average=self.average)
+        meta = {'rows': self.rows, 'points': self.points, 'count': self.count, 'attrs': self.attrs}
+        path = os.path.join(self.directory, META_FILENAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f, indent=1, default=str)
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_waterfall(directory):
+    """
+    Open a waterfall written by :class:`Waterfall`.
+
+    The rows are ordered by their times rather than by ``count``, so a
+    waterfall still being written, or left by a run that died, also returns
+    the traces appended since its last flush.
+
+    :return: Dictionary with ``times`` and ``traces`` in chronological order
+        (memory-mapped unless the ring wrapped), ``frequencies``,
+        ``max_hold``, ``min_hold``, ``average``, ``count`` (as of the last
+        flush) and ``attrs``.
+    """
+    with open(os.path.join(directory, META_FILENAME)) as f:
+        meta = json.load(f)
+    traces = np.load(os.path.join(directory, 'traces.npy'), mmap_mode='r')
+    times = np.load(os.path.join(directory, 'times.npy'), mmap_mode='r')
+    written = np.flatnonzero(~np.isnan(times))
+    order = written[np.argsort(times[written], kind='stable')]
+    if np.array_equal(order, np.arange(order.size)):
+        traces, times = traces[:order.size], times[:order.size]
+    else:
+        traces, times = traces[order], times[order]
+    result = {'times': times, 'traces': traces, 'count': meta['count'], 'attrs': meta['attrs']}
+    path = os.path.join(directory, 'frequencies.npy')
+    result['frequencies'] = np.load(path) if os.path.exists(path) else None
+    with np.load(os.path.join(directory, 'holds.npz')) as holds:
+        result.update({name: holds[name] for name in holds.files})
+    return result
@@ -7,47 +7,309 @@ log.addHandler(logging.NullHandler())
 
 from pymeasure.log import console_log
 from pymeasure.display.windows import ManagedWindow
-from pymeasure.display import Plotter
-from pymeasure.experiment import Procedure, FloatParameter, IntegerParameter, Worker, Results
-from pymeasure.instruments import DSA815
-from time import sleep
+from procedure.common.display import DecimatedWindow, DecimatedPlotter
+from pymeasure.experiment import Procedure, FloatParameter, IntegerParameter, BooleanParameter, Parameter, ListParameter, Worker, Results
+from time import sleep, time
+import os
+import numpy as np
+from itertools import count
+from procedure.storage import ColumnStore
+from procedure.rigol import (Waterfall, TraceAnalyzer, BinaryTraceReader, parse_bands, plan_segments, GAUSSIAN_ENBW,
+                             ASCII_BYTES_PER_POINT, BINARY_BYTES_PER_POINT)
+from procedure.simulation import connect
+from procedure.common import InstrumentedProcedure
 
 
 
-class DSA815Procedure(Procedure):
+class DSA815Procedure(InstrumentedProcedure, Procedure):
     serial_address = 'USB0::0x1AB1::0x09C4::DSA8A192800001::INSTR' 
     log.info(f"Serial address initialized to {serial_address}")
 
-    start_freq = FloatParameter('Start Frequency', units = 'Hz', default =0)
-    center_freq = FloatParameter('Center Frequency', units = 'Hz', default = 5e6)
-    stop_freq = FloatParameter('Stop Frequency', units = 'Hz', default = 10e6)
+    #the DSA815 covers 9 kHz to 1.5 GHz; its start may be set down to 0 Hz
+    start_freq = FloatParameter('Start Frequency', units = 'Hz', default =0, minimum = 0, maximum = 1.5e9)
+    center_freq = FloatParameter('Center Frequency', units = 'Hz', default = 5e6, minimum = 0, maximum = 1.5e9)
+    stop_freq = FloatParameter('Stop Frequency', units = 'Hz', default = 10e6, minimum = 0, maximum = 1.5e9)
     sweep_time = FloatParameter('Sweep Time', units = 's', default = 0.01)
     data_points = IntegerParameter('Data Points', default = 3001)
+    #traces as REAL,32 blocks instead of ASCII, if the analyzer accepts the format
+    binary_transfer = BooleanParameter('Binary Trace Transfer', default = True)
+    #split the span into segments swept at the resolution bandwidth below and stitch their traces,
+    #instead of one trace of Data Points points
+    segmented = BooleanParameter('Segmented Sweep', default = False)
+    resolution_bandwidth = FloatParameter('Resolution Bandwidth', units = 'Hz', default = 1e3,
+                                          minimum = 100, maximum = 1e6)
+    bins_per_rbw = IntegerParameter('Bins per RBW', default = 2, minimum = 1, maximum = 10)
+    #0 sweeps until stopped. Without a store directory every trace still goes to the csv
+    #as one row per bin; set one for multi-sweep runs to keep one row per sweep
+    sweeps = IntegerParameter('Sweeps', default = 1, minimum = 0)
+    #if set, each trace is stored as one row of a columnar store instead of the csv
+    store_directory = Parameter('Store Directory', default = '')
+    #if set, traces go to a memory-mapped waterfall ring with running holds instead
+    waterfall_directory = Parameter('Waterfall Directory', default = '')
+    waterfall_rows = IntegerParameter('Waterfall Rows', default = 3600, minimum = 1)
+    #waterfall runs send the max-hold of the traces of each interval to the csv and live plot; 0 for none
+    waterfall_preview = FloatParameter('Waterfall Preview Interval', units = 's', default = 1, minimum = 0)
+    #per-sweep features (noise floor, peaks, band powers, harmonics) next to or instead of the trace
+    trace_output = ListParameter('Trace Output', choices = ['Trace', 'Features', 'Trace and Features'],
+                                 default = 'Trace')
+    peak_threshold = FloatParameter('Peak Threshold', units = 'dB', default = 15)
+    max_peaks = IntegerParameter('Peaks Reported', default = 8, minimum = 1)
+    #comma separated low:high pairs in Hz, e.g. 0.9e6:1.1e6, 2e6:5e6
+    bands = Parameter('Bands', default = '')
+    harmonics = IntegerParameter('Harmonics', default = 5, minimum = 1)
+    min_fundamental = FloatParameter('Minimum Fundamental', units = 'Hz', default = 0)
   
-    DATA_COLUMNS = ['Frequency (Hz)', 'Amplitude (dBm)']
+    DATA_COLUMNS = ['Sweep', 'Time (s)', 'Frequency (Hz)', 'Amplitude (dBm)',
+                    'Noise Floor (dBm)', 'Peaks', 'Peak Frequency (Hz)', 'Peak Amplitude (dBm)',
+                    'Band Power (dBm)', 'Fundamental (Hz)', 'THD (dB)']
 
     def startup(self): 
+        self.start_instrumentation()
         log.info("Starting up the Rigol DSA815 spectrum analyzer...")
-        self.dsa815 = DSA815(self.serial_address)
+        self.dsa815 = self.instrument(connect('DSA815', self.serial_address), 'dsa815')
+        self.configure()
+        self.reader = None
+        self.buffer = None
+        self.frequencies = None
+        if self.binary_transfer:
+            self.reader = BinaryTraceReader(self.dsa815)
+            if not self.reader.negotiate():
+                log.warning("The analyzer did not accept REAL,32 traces, reading them as ASCII")
+                self.reader = None
+        self.plan = None
+        self._segment_started = False
+        if self.segmented:
+            #plan with the RBW the analyzer settled on
+            self.plan = plan_segments(self.start_freq, self.stop_freq, float(self.dsa815.ask(":BAND:RES?")),
+                                      bins_per_rbw = self.bins_per_rbw,
+                                      bytes_per_point = BINARY_BYTES_PER_POINT if self.reader
+                                      else ASCII_BYTES_PER_POINT)
+            log.info("Sweeping %g-%g Hz in %d segments of %d points at %g Hz RBW, %d points stitched, "
+                     "about %.2f s per pass" % (self.start_freq, self.stop_freq, len(self.plan.segments),
+                                                self.plan.segments[0].points, self.plan.rbw,
+                                                self.plan.points, self.plan.duration))
+        if self.reader is not None and self.plan is None:
+            #the bins do not change during the run, so the frequencies are worked out once
+            self.frequencies = np.linspace(float(self.dsa815.ask(":FREQ:STAR?")),
+                                           float(self.dsa815.ask(":FREQ:STOP?")),
+                                           int(float(self.dsa815.ask(":SWE:POIN?"))))
+        if self.sweeps != 1 or self.segmented:
+            #single sweep mode so every trace read back is a fresh sweep
+            self.dsa815.write(":INIT:CONT OFF")
+        self.store = None
+        #created with the first trace, once the number of points is known
+        self.waterfall = None
+        #so the first trace is previewed straight away
+        self._preview_time = -np.inf
+        self._preview_traces = 0
+        self.analyzer = None
+        if self.trace_output != 'Trace':
+            self.analyzer = TraceAnalyzer(threshold = self.peak_threshold, max_peaks = self.max_peaks,
+                                          bands = parse_bands(self.bands), harmonics = self.harmonics,
+                                          min_frequency = self.min_fundamental)
+            self.noise_bandwidth = GAUSSIAN_ENBW * float(self.dsa815.ask(":BAND:RES?"))
+        if self.store_directory:
+            self.store = self.instrument(ColumnStore(self.store_directory, chunk_rows = 16,
+                                                     attrs = self.parameter_values()), 'store')
+            if self.analyzer is not None:
+                #the arrays of every feature, apart from the DATA_COLUMNS rows of the store
+                self.feature_store = self.instrument(ColumnStore(os.path.join(self.store_directory, 'features'),
+                                                                 chunk_rows = 256,
+                                                                 attrs = self.parameter_values()), 'store')
+        elif self.sweeps != 1 and self.trace_output != 'Features' and not self.waterfall_directory:
+            log.warning("Without a store directory each trace goes to the csv as one row per bin")
         log.info("Starting up the measurement...")
 
     def execute(self):
-        data = self.dsa815.trace_df()
-        for i in range(self.data_points):
-            data = {'Frequency (Hz)': data[0][i], 'Amplitude (dBm)': data[1][i]}
-            self.emit('results', data)
-            log.debug("Emitting results: %s" % data)
-            sleep(0.01)
+        time_0 = time()
+        for sweep in (range(self.sweeps) if self.sweeps else count()):
+            if self.plan is not None:
+                frequencies, amplitudes = self.sweep_segments(more = not self.sweeps or sweep + 1 < self.sweeps)
+            else:
+                if self.sweeps != 1:
+                    self.trigger_sweep()
+                frequencies, amplitudes = self.read_trace()
+            self.emit_trace(sweep, time() - time_0, frequencies, amplitudes)
+            log.debug("Emitted sweep %d (%d points)" % (sweep, frequencies.size))
+            if self.sweeps:
+                self.emit('progress', 100 * (sweep + 1) / self.sweeps)
             if self.should_stop():
                 log.warning("Received stop request")
                 break
+
+    def configure(self):
+        """
+        Send the sweep settings to the analyzer. In a batch with a connection
+        pool, the settings already in place from the previous run are skipped.
+
+        A segmented sweep sets the resolution bandwidth and lets the analyzer
+        pick the sweep time of each segment; the points are the plan's.
+        """
+        self.dsa815.write(":FREQ:STAR %.10g" % self.start_freq)
+        self.dsa815.write(":FREQ:STOP %.10g" % self.stop_freq)
+        if self.segmented:
+            self.dsa815.write(":BAND:RES %.6g" % self.resolution_bandwidth)
+            self.dsa815.write(":SWE:TIME:AUTO ON")
+        else:
+            self.dsa815.write(":SWE:POIN %d" % self.data_points)
+            self.dsa815.write(":SWE:TIME %.6g" % self.sweep_time)
+
+    def trigger_sweep(self):
+        """
+        Start a single sweep and block until the analyzer has finished it.
+        """
+        self.dsa815.write(":INIT")
+        self.dsa815.ask("*OPC?")
+
+    def read_trace(self, points = None):
+        """
+        Read the last sweep and return its frequencies and amplitudes.
+
+        Binary traces are decoded into one buffer reused from sweep to sweep,
+        unless a store, which keeps the rows until it flushes them, gets the
+        trace. ASCII traces are parsed by ``trace_df``.
+
+        :param points: Number of points of the trace, those of the
+            configured sweep by default.
+        """
+        if self.reader is None:
+            trace = self.dsa815.trace_df()
+            return np.asarray(trace[0], dtype = np.float64), np.asarray(trace[1], dtype = np.float64)
+        points = points or self.frequencies.size
+        if self.store is not None and self.plan is None:
+            return self.frequencies, self.reader.read(points)
+        if self.buffer is None or self.buffer.size != points:
+            self.buffer = np.empty(points)
+        return self.frequencies, self.reader.read(points, out = self.buffer)
+
+    def start_segment(self, segment):
+        """
+        Tune the analyzer to one segment of the plan and start sweeping it.
+        """
+        self.dsa815.write(":FREQ:STAR %.10g" % segment.start)
+        self.dsa815.write(":FREQ:STOP %.10g" % segment.stop)
+        self.dsa815.write(":SWE:POIN %d" % segment.points)
+        self.dsa815.write(":INIT")
+
+    def sweep_segments(self, more = False):
+        """
+        Sweep every segment of the plan and return the frequencies and
+        amplitudes of the stitched trace.
+
+        The sweeps are pipelined: as soon as a segment is read, the next one
+        is started, so the analyzer sweeps it while the host stitches. With
+        ``more``, the first segment of the next pass is started too, and
+        sweeps while this trace is emitted.
+        """
+        segments = self.plan.segments
+        amplitudes = self.plan.empty()
+        if not self._segment_started:
+            self.start_segment(segments[0])
+        for index, segment in enumerate(segments):
+            self.dsa815.ask("*OPC?")
+            trace = self.read_trace(segment.points)[1]
+            if index + 1 < len(segments):
+                self.start_segment(segments[index + 1])
+            elif more:
+                self.start_segment(segments[0])
+            self.plan.stitch(index, trace, amplitudes)
+        self._segment_started = more
+        return self.plan.frequencies, amplitudes
+
+    def emit_trace(self, sweep, timestamp, frequencies, amplitudes):
+        """
+        Emit a whole trace in one pass, without pausing between bins, and its
+        features if they are asked for.
+
+        The trace goes to the waterfall, the store or the csv, in that order
+        of preference; a waterfall run also sends a preview to the csv every
+        Waterfall Preview Interval. The feature summary (first peak, total
+        band power) goes into the DATA_COLUMNS of the store row, or of one
+        csv row per sweep without a store. With a store, every peak, band
+        power and harmonic also goes into the ``features`` store inside it,
+        one row per sweep; export it with ``export_csv`` and ``columns``, as
+        its arrays differ in length.
+
+        :param sweep: Index of the sweep within the run.
+        :param timestamp: Time in seconds since the start of the run.
+        :param frequencies: Array of bin frequencies in Hz.
+        :param amplitudes: Array of bin amplitudes in dBm.
+        """
+        row = {'Sweep': sweep, 'Time (s)': timestamp}
+        if self.trace_output != 'Features':
+            if self.waterfall_directory:
+                if self.waterfall is None:
+                    self.waterfall = self.instrument(Waterfall(self.waterfall_directory, self.waterfall_rows,
+                                                               amplitudes.size, attrs = self.parameter_values()),
+                                                     'store')
+                self.waterfall.append(timestamp, amplitudes, frequencies)
+                self._preview_traces += 1
+                if self.waterfall_preview and timestamp - self._preview_time >= self.waterfall_preview:
+                    self.emit_preview(sweep, timestamp, frequencies)
+            elif self.store is not None:
+                row.update({'Frequency (Hz)': frequencies, 'Amplitude (dBm)': amplitudes})
+            else:
+                for f, a in zip(frequencies, amplitudes):
+                    self.emit('results', {'Sweep': sweep, 'Time (s)': timestamp,
+                                          'Frequency (Hz)': f, 'Amplitude (dBm)': a})
+
+        if self.analyzer is not None:
+            features = self.analyzer.analyze(frequencies, amplitudes, self.noise_bandwidth)
+            total = 10 * np.log10(np.sum(10 ** (features.band_powers / 10))) if features.band_powers.size \
+                else np.nan
+            summary = {'Noise Floor (dBm)': features.noise_floor, 'Peaks': features.peaks,
+                       'Peak Frequency (Hz)': features.peak_frequencies[0],
+                       'Peak Amplitude (dBm)': features.peak_amplitudes[0],
+                       'Band Power (dBm)': total, 'Fundamental (Hz)': features.fundamental,
+                       'THD (dB)': features.thd}
+            if self.store is not None:
+                row.update(summary)
+                arrays = {'Peak Frequencies (Hz)': features.peak_frequencies,
+                          'Peak Amplitudes (dBm)': features.peak_amplitudes,
+                          'Band Powers (dBm)': features.band_powers, 'Harmonics (dBc)': features.harmonics}
+                self.feature_store.append_row(dict({'Sweep': sweep, 'Time (s)': timestamp},
+                                                   **{name: value for name, value in arrays.items()
+                                                      if value.size}))
+            else:
+                self.emit('results', dict(row, **summary))
+
+        if self.store is not None and len(row) > 2:
+            self.store.append_row(row)
+
+    def emit_preview(self, sweep, timestamp, frequencies):
+        """
+        Emit the max-hold of the waterfall traces since the last preview as
+        csv rows, so the live plot follows a waterfall run without a row per
+        bin of every trace.
+        """
+        preview = self.waterfall.window(self._preview_traces)[1].max(axis = 0)
+        for f, a in zip(frequencies, preview):
+            self.emit('results', {'Sweep': sweep, 'Time (s)': timestamp,
+                                  'Frequency (Hz)': f, 'Amplitude (dBm)': a})
+        self._preview_time = timestamp
+        self._preview_traces = 0
     def shutdown(self): 
-        pass
-class ManagedWindow(ManagedWindow):
+        if self.reader is not None:
+            self.reader.restore()
+        if self.sweeps != 1 or self.segmented:
+            self.dsa815.write(":INIT:CONT ON")
+        if self.store is not None:
+            self.store.close()
+            if self.analyzer is not None:
+                self.feature_store.close()
+        if self.waterfall is not None:
+            self.waterfall.close()
+            log.info("Waterfall of %d traces written to %s" % (self.waterfall.count, self.waterfall_directory))
+        self.stop_instrumentation()
+class ManagedWindow(DecimatedWindow, ManagedWindow):
     def __init__(self): 
         super().__init__(procedure_class = DSA815Procedure, 
-            inputs = ['start_freq', 'center_freq', 'stop_freq', 'sweep_time', 'data_points'], 
-            displays = ['start_freq', 'center_freq', 'stop_freq', 'sweep_time', 'data_points'], 
+            inputs = ['start_freq', 'center_freq', 'stop_freq', 'sweep_time', 'data_points', 'binary_transfer', 'segmented',
+                      'resolution_bandwidth', 'bins_per_rbw', 'sweeps', 'store_directory',
+                      'waterfall_directory', 'waterfall_rows', 'waterfall_preview', 'trace_output', 'peak_threshold',
+                      'max_peaks', 'bands', 'harmonics', 'min_fundamental',
+                      'instrumentation', 'instrumentation_file'], 
+            displays = ['start_freq', 'center_freq', 'stop_freq', 'sweep_time', 'data_points', 'sweeps'], 
             x_axis = 'Frequency (Hz)', 
             y_axis = 'Amplitude (dBm)'
         )
@@ -62,7 +324,7 @@ if __name__ == '__main__':
     results = Results(procedure, data_filename)
     log.info("Results created")
 
-    plotter = Plotter(results) 
+    plotter = DecimatedPlotter(results) 
     log.info("Plotter created")
     plotter.start() 
 
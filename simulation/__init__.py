@@ -0,0 +1,5 @@
+from .bench import Bench, Axis, BENCH
+from .instruments import (connect, open_instrument, use_pool, is_simulated, SIMULATED, DRIVERS,
+                          driver_name, resolve_driver,
+                          SimulatedInstrument, SimulatedKeithley2000, SimulatedPM100USB, SimulatedSHRC203,
+                          SimulatedKPZ101, SimulatedKDC101, SimulatedCS165MUM, SimulatedDSA815)
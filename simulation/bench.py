@@ -0,0 +1,227 @@
+# Purpose: Physical model shared by the simulated instruments
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import threading
+from collections import deque
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+
+class Axis:
+    """
+    One motion axis with a trapezoidal velocity profile and leadscrew
+    backlash.
+
+    A move starts from wherever the axis is when it is commanded, so a new
+    move can interrupt the previous one. The recent moves are kept, so the
+    position can be evaluated at any past time (or array of times) and a
+    buffered detector read out after the fact still sees the stage where it
+    was during each sample.
+
+    :param position: Initial position.
+    :param velocity: Maximum velocity in units per second.
+    :param acceleration: Acceleration in units per second squared.
+    :param backlash: Total play of the drive; the carriage lags the command
+        by half of it in the direction of the last move.
+    :param history: Number of moves kept.
+    """
+
+    def __init__(self, position=0., velocity=1., acceleration=10., backlash=0., history=4096):
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.backlash = backlash
+        self.target = position
+        self._lock = threading.Lock()
+        # (start time, start position, end position, duration) of each move
+        self._segments = deque([(-np.inf, position, position, 0.)], maxlen=history)
+
+    def travel_time(self, distance):
+        """
+        Return the time a move of ``distance`` takes from standstill.
+        """
+        distance = abs(distance)
+        ramp = self.velocity ** 2 / self.acceleration
+        if distance >= ramp:
+            return distance / self.velocity + self.velocity / self.acceleration
+        return 2 * np.sqrt(distance / self.acceleration)
+
+    def start(self, target):
+        """
+        Start a move to ``target`` and return its duration in seconds.
+        """
+        with self._lock:
+            now = perf_counter()
+            start = float(self.position(now))
+            half = self.backlash / 2
+            end = float(np.clip(start, target - half, target + half))
+            # from rest the motor also has to take up the play; an interrupted
+            # move simply heads for the new end point
+            distance = target - self.target if now >= self.done_at() else end - start
+            duration = self.travel_time(distance)
+            self.target = target
+            self._segments.append((now, start, end, duration))
+        return duration
+
+    def position(self, t=None):
+        """
+        Return the carriage position at time ``t`` (``perf_counter`` seconds,
+        scalar or array); defaults to now.
+        """
+        t = perf_counter() if t is None else t
+        if np.ndim(t) == 0 and t >= self._segments[-1][0]:
+            return float(self._profile(np.float64(t), *self._segments[-1]))
+        segments = np.array(self._segments)
+        t = np.asarray(t, dtype=np.float64)
+        index = np.clip(np.searchsorted(segments[:, 0], t, side='right') - 1, 0, None)
+        return self._profile(t, *segments[index].T)
+
+    def done_at(self):
+        """
+        Return the time at which the current move finishes.
+        """
+        t0, _, _, duration = self._segments[-1]
+        return t0 + duration
+
+    def _profile(self, t, t0, start, end, duration):
+        # distance along a symmetric trapezoid (or triangle) velocity profile
+        tau = np.clip(t - t0, 0., duration)
+        ramp = np.minimum(self.velocity / self.acceleration, duration / 2)
+        peak = self.acceleration * ramp
+        travelled = np.where(
+            tau < ramp, 0.5 * self.acceleration * tau ** 2,
+            np.where(tau < duration - ramp,
+                     0.5 * peak * ramp + peak * (tau - ramp),
+                     0.5 * peak * ramp + peak * (duration - 2 * ramp)
+                     + peak * (tau - duration + ramp)
+                     - 0.5 * self.acceleration * (tau - duration + ramp) ** 2))
+        total = peak * (duration - ramp)
+        fraction = np.divide(travelled, total, out=np.ones_like(travelled), where=total > 0)
+        return start + (end - start) * fraction
+
+
+class Bench:
+    """
+    The optical bench the simulated instruments share.
+
+    Stage, focus and piezo axes are driven by the simulated controllers; the
+    detectors and the camera read the light they produce at the time of each
+    sample:
+
+    * the optical power at the detector is a pair of Gaussian spots in the
+      SHRC203 XY plane (um), modulated by the interference fringe of the
+      KPZ101 piezo voltage;
+    * the camera sees a fixed random texture that drifts slowly, follows the
+      XY stage and blurs with the distance of the KDC101 from best focus.
+
+    :param seed: Seed of the noise generator.
+    :param focus: KDC101 position of best focus in mm.
+    :param fringe_period: Piezo voltage per interference fringe in V.
+    :param peak_power: Optical power at the centre of the main spot in W.
+    """
+
+    def __init__(self, seed=0, focus=0.2, fringe_period=1.19, peak_power=1e-3):
+        self.rng = np.random.default_rng(seed)
+        self.focus = focus
+        self.fringe_period = fringe_period
+        self.fringe_visibility = 0.9
+        self.peak_power = peak_power
+        self.epoch = perf_counter()
+
+        self.x = Axis(velocity=2000., acceleration=2e4)               # SHRC203 ch_1, um
+        self.y = Axis(velocity=2000., acceleration=2e4)               # SHRC203 ch_2, um
+        self.z = Axis(velocity=2.4, acceleration=1.5, backlash=0.005)  # KDC101, mm
+        self.piezo = Axis(velocity=7500., acceleration=7.5e6)         # KPZ101 output, V
+
+        # camera drift in px: a slow linear creep plus a thermal wander
+        self.drift_rate = np.array([0.05, -0.03])
+        self.wander = np.array([1.5, 1.])
+        self.wander_period = 120.
+        self.pixel_size = 0.1       # um of stage travel per camera pixel
+        self.defocus_blur = 100.    # blur sigma in px per mm of defocus
+        self._texture = None
+        self._noise = None
+
+    def pattern(self, x, y):
+        """
+        Return the relative intensity at stage position ``(x, y)`` in um.
+        """
+        main = np.exp(-((x - 1.) ** 2 + y ** 2) / (2 * 0.25 ** 2))
+        side = 0.3 * np.exp(-((x - 0.5) ** 2 + (y - 0.5) ** 2) / (2 * 0.1 ** 2))
+        return main + side + 0.02
+
+    def fringe(self, voltage):
+        """
+        Return the relative interference intensity at a piezo voltage.
+        """
+        phase = 2 * np.pi * voltage / self.fringe_period
+        return 0.5 * (1 + self.fringe_visibility * np.cos(phase))
+
+    def power(self, t=None):
+        """
+        Return the noiseless optical power in W at time ``t`` (scalar or array).
+        """
+        t = perf_counter() if t is None else t
+        return self.peak_power * self.pattern(self.x.position(t), self.y.position(t)) \
+            * self.fringe(self.piezo.position(t))
+
+    def drift(self, t=None):
+        """
+        Return the camera drift ``(dx, dy)`` in px at time ``t``.
+        """
+        t = (perf_counter() if t is None else t) - self.epoch
+        return self.drift_rate * t + self.wander * np.sin(2 * np.pi * t / self.wander_period)
+
+    def image(self, shape, t=None, noise=2.):
+        """
+        Render a camera frame of ``shape`` ``(height, width)`` at time ``t``.
+
+        :return: uint8 RGB frame.
+        """
+        t = perf_counter() if t is None else t
+        margin = 64
+        if self._texture is None or self._texture.shape != (shape[0] + 2 * margin, shape[1] + 2 * margin):
+            self._texture = self._make_texture((shape[0] + 2 * margin, shape[1] + 2 * margin))
+
+        offset = self.drift(t) + np.array([self.x.position(t), self.y.position(t)]) / self.pixel_size
+        offset = np.clip(offset, -margin + 1, margin - 1)
+        # the texture content moves by `offset` across the sensor
+        matrix = np.float32([[1, 0, margin - offset[0]], [0, 1, margin - offset[1]]])
+        frame = cv2.warpAffine(self._texture, matrix, (shape[1], shape[0]),
+                               flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+
+        sigma = min(self.defocus_blur * abs(float(self.z.position(t)) - self.focus), 25.)
+        if sigma > 4:
+            # wide blurs are done at reduced resolution to keep up with the frame rate
+            factor = int(sigma // 2)
+            small = cv2.resize(frame, (shape[1] // factor, shape[0] // factor), interpolation=cv2.INTER_AREA)
+            small = cv2.GaussianBlur(small, (0, 0), sigma / factor)
+            frame = cv2.resize(small, (shape[1], shape[0]), interpolation=cv2.INTER_LINEAR)
+        elif sigma > 0.1:
+            frame = cv2.GaussianBlur(frame, (0, 0), sigma)
+        if noise:
+            # cv2's generator is several times faster than numpy's at this size
+            if self._noise is None or self._noise.shape != frame.shape:
+                self._noise = np.empty(frame.shape, dtype=np.float32)
+            cv2.randn(self._noise, 0., noise)
+            frame += self._noise
+        frame = np.clip(frame, 0, 255).astype(np.uint8)
+        return cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
+
+    def _make_texture(self, shape):
+        # features on a few length scales so every focus metric has a peak
+        texture = np.zeros(shape, dtype=np.float32)
+        for sigma, weight in ((1.5, 0.5), (4., 1.), (12., 1.5)):
+            layer = self.rng.standard_normal(shape).astype(np.float32)
+            layer = cv2.GaussianBlur(layer, (0, 0), sigma)
+            texture += weight * layer / layer.std()
+        texture = 128 + 30 * texture
+        return np.clip(texture, 0, 255)
+
+
+BENCH = Bench()
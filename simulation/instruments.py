@@ -0,0 +1,659 @@
+# Purpose: Simulated stand-ins for the instruments used by the procedures
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import importlib
+import re
+import threading
+from math import ceil
+from time import sleep, perf_counter
+
+import numpy as np
+import pandas as pd
+
+from .bench import BENCH, Axis
+
+
+def _wait_until(deadline):
+    remaining = deadline - perf_counter()
+    if remaining > 0:
+        sleep(remaining)
+
+
+class SimulatedInstrument:
+    """
+    Base class of the simulated instruments.
+
+    Every command or query costs ``latency`` seconds, the round trip of the
+    real bus, and is counted in :attr:`commands`. Subclasses handle SCPI
+    commands in :meth:`_command` and queries in :meth:`_query`. A query sent
+    with :meth:`write` leaves its answer to be taken with :meth:`read` or
+    :meth:`read_bytes`, as on a message-based bus.
+
+    :param address: The address the procedure asked for, kept for logging.
+    :param bench: The :class:`Bench` to act on; the shared default if None.
+    :param latency: Override of the round-trip time in seconds.
+    """
+    latency = 0.002
+
+    def __init__(self, address, bench=None, latency=None, **kwargs):
+        self.address = address
+        self.bench = bench or BENCH
+        if latency is not None:
+            self.latency = latency
+        self.commands = 0
+        self._lock = threading.RLock()
+        self._output = bytearray()
+
+    def write(self, command):
+        with self._lock:
+            self._io()
+            for part in command.split(';'):
+                part = part.strip()
+                if part and '?' in part.split()[0]:
+                    answer = self._query(part)
+                    self._output += answer if isinstance(answer, bytes) else (answer + '\n').encode()
+                elif part:
+                    self._command(part)
+
+    def read(self):
+        with self._lock:
+            end = self._output.find(b'\n') + 1 or len(self._output)
+            return self.read_bytes(end).decode().rstrip('\n')
+
+    def read_bytes(self, count, **kwargs):
+        with self._lock:
+            if count < 0:
+                count = len(self._output)
+            if count > len(self._output):
+                raise TimeoutError("%s timed out reading %d bytes, %d waiting"
+                                   % (type(self).__name__, count, len(self._output)))
+            data = bytes(self._output[:count])
+            del self._output[:count]
+            return data
+
+    def ask(self, command):
+        with self._lock:
+            self._io()
+            return self._query(command.strip())
+
+    def values(self, command):
+        return [float(value) for value in self.ask(command).split(',')]
+
+    def check_errors(self):
+        return []
+
+    def shutdown(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def _io(self, transfer=0.):
+        self.commands += 1
+        sleep(self.latency + transfer)
+
+    def _command(self, command):
+        log.debug("%s ignored command %r" % (type(self).__name__, command))
+
+    def _query(self, command):
+        if command == '*OPC?':
+            return '1'
+        if command == '*IDN?':
+            return 'SIMULATED,%s,0,0' % type(self).__name__
+        raise ValueError("%s has no query %r" % (type(self).__name__, command))
+
+
+class SimulatedKeithley2000(SimulatedInstrument):
+    """
+    Keithley 2000/2100 multimeter reading a photodiode amplifier on the bench.
+
+    Readings integrate for ``voltage_nplc`` power line cycles and carry white
+    noise that falls with the square root of the integration time. ``:INIT``
+    runs ``trigger_count`` readings ``trigger_delay`` apart, into the buffer if
+    it is fed; the values are taken from the bench at the time of each
+    reading, so a buffer filled during a move records the move.
+
+    :param responsivity: Amplifier output in V per W of optical power.
+    :param noise: RMS noise in V at 1 NPLC.
+    """
+    latency = 0.0015
+    line_frequency = 60.
+    max_points = 1024
+
+    def __init__(self, address, responsivity=1e3, noise=2e-5, **kwargs):
+        super().__init__(address, **kwargs)
+        self.responsivity = responsivity
+        self.noise = noise
+        self.voltage_nplc = 1.
+        self.trigger_count = 1
+        self.trigger_delay = 0.
+        self.buffer_points = 2
+        self._feed = False
+        self._times = np.empty(0)
+        self._values = np.empty(0)
+        self._done = 0.
+
+    @property
+    def integration(self):
+        return self.voltage_nplc / self.line_frequency
+
+    def measure_voltage(self, max_voltage=1, ac=False):
+        self.write(":SENS:FUNC 'VOLT:%s'" % ('AC' if ac else 'DC'))
+
+    @property
+    def voltage(self):
+        with self._lock:
+            self._io()
+            start = perf_counter()
+            sleep(self.integration)
+            return float(self._sample(np.array([start]))[0])
+
+    def config_buffer(self, points=64, delay=0):
+        self.write(":TRAC:CLEAR")
+        self.buffer_points = int(np.clip(points, 2, self.max_points))
+        self.trigger_count = self.buffer_points
+        self.trigger_delay = delay
+        self._feed = True
+
+    def start_buffer(self):
+        self.write(":INIT")
+
+    def is_buffer_full(self):
+        return (int(self.ask("*STB?")) & 65) == 65
+
+    def wait_for_buffer(self, should_stop=lambda: False, timeout=60, interval=0.1):
+        start = perf_counter()
+        while not self.is_buffer_full():
+            sleep(interval)
+            if should_stop():
+                return
+            if perf_counter() - start > timeout:
+                raise Exception("Timed out waiting for Keithley buffer to fill.")
+
+    @property
+    def buffer_data(self):
+        with self._lock:
+            values = self._readings() if self._feed else np.empty(0)
+            # ASCII transfer of roughly 16 bytes per reading
+            self._io(transfer=16 * values.size / 1e6)
+            return values.copy()
+
+    def reset_buffer(self):
+        self.write(":TRAC:CLEAR")
+
+    def stop_buffer(self):
+        self.write(":ABOR")
+
+    def disable_buffer(self):
+        self.write(":TRAC:FEED:CONT NEV")
+
+    def _command(self, command):
+        command = command.upper()
+        if command == ':INIT':
+            self._trigger()
+        elif command == ':ABOR':
+            # keep only the readings that finished
+            finished = self._times + self.integration <= perf_counter()
+            self._times = self._times[finished]
+            self._values = np.empty(0)
+            self._done = perf_counter()
+        elif command == ':TRAC:CLEAR':
+            self._times = np.empty(0)
+            self._values = np.empty(0)
+        elif command.startswith(':TRAC:FEED:CONT'):
+            self._feed = not command.endswith('NEV')
+        else:
+            super()._command(command)
+
+    def _query(self, command):
+        command = command.upper()
+        if command == '*OPC?':
+            _wait_until(self._done)
+            return '1'
+        if command == ':FETC?':
+            readings = self._readings()
+            return '%+.8E' % (readings[-1] if readings.size else np.nan)
+        if command == '*STB?':
+            full = self._feed and self._times.size >= self.buffer_points \
+                and perf_counter() >= self._done
+            return '65' if full else '0'
+        if command == ':TRAC:DATA?':
+            return ','.join('%+.8E' % value for value in self._readings())
+        return super()._query(command)
+
+    def _trigger(self):
+        period = self.integration + self.trigger_delay
+        start = perf_counter() + self.trigger_delay
+        self._times = start + period * np.arange(max(1, int(self.trigger_count)))
+        self._values = np.empty(0)
+        self._done = self._times[-1] + self.integration
+
+    def _readings(self):
+        _wait_until(self._done)
+        if self._values.size != self._times.size:
+            self._values = self._sample(self._times)
+        return self._values
+
+    def _sample(self, starts):
+        power = self.bench.power(starts + self.integration / 2)
+        noise = self.noise / np.sqrt(max(self.voltage_nplc, 0.01))
+        return self.responsivity * power + self.bench.rng.normal(0., noise, np.shape(starts))
+
+
+class SimulatedPM100USB(SimulatedInstrument):
+    """
+    Thorlabs PM100USB power meter on the bench. Each reading averages for
+    ``averaging`` seconds and has a noise floor plus a relative noise.
+    """
+    latency = 0.001
+
+    def __init__(self, address, averaging=0.003, noise=1e-8, relative_noise=2e-3, **kwargs):
+        super().__init__(address, **kwargs)
+        self.averaging = averaging
+        self.noise = noise
+        self.relative_noise = relative_noise
+        self._wavelength = 1550.
+
+    @property
+    def wavelength(self):
+        self._io()
+        return self._wavelength
+
+    @wavelength.setter
+    def wavelength(self, value):
+        self._io()
+        self._wavelength = float(np.clip(value, 400., 1700.))
+
+    @property
+    def power(self):
+        with self._lock:
+            self._io()
+            start = perf_counter()
+            sleep(self.averaging)
+            power = float(self.bench.power(start + self.averaging / 2))
+            rng = self.bench.rng
+            return power * (1 + rng.normal(0., self.relative_noise)) + rng.normal(0., self.noise)
+
+
+class SimulatedAxis:
+    """
+    One channel of the simulated SHRC203; ``move`` blocks until the axis
+    has stopped, like the controller's busy flag.
+    """
+
+    def __init__(self, controller, axis, settle=0.002):
+        self.controller = controller
+        self.axis = axis
+        self.settle = settle
+
+    def move(self, position):
+        with self.controller._lock:
+            self.controller._io()
+        duration = self.axis.start(float(position))
+        sleep(duration + self.settle)
+
+    @property
+    def position(self):
+        with self.controller._lock:
+            self.controller._io()
+        return float(self.axis.position())
+
+    def home(self):
+        self.move(0.)
+
+
+class SimulatedSHRC203(SimulatedInstrument):
+    """
+    OptoSigma SHRC203 three-axis controller; ``ch_1`` and ``ch_2`` drive the
+    bench X and Y stages (um), ``ch_3`` a free axis.
+    """
+    latency = 0.005
+
+    def __init__(self, address, **kwargs):
+        super().__init__(address, **kwargs)
+        self.ch_1 = SimulatedAxis(self, self.bench.x)
+        self.ch_2 = SimulatedAxis(self, self.bench.y)
+        self.ch_3 = SimulatedAxis(self, Axis(velocity=2000., acceleration=2e4))
+
+
+class SimulatedKPZ101(SimulatedInstrument):
+    """
+    Thorlabs KPZ101 piezo driver; the output voltage slews to each setpoint
+    and moves the interference fringe on the bench.
+    """
+    latency = 0.004
+    max_voltage = 75.
+
+    def set_voltage(self, voltage):
+        voltage = float(np.clip(voltage, 0., self.max_voltage))
+        with self._lock:
+            self._io()
+        self.bench.piezo.start(voltage)
+        return voltage
+
+    @property
+    def voltage(self):
+        with self._lock:
+            self._io()
+        return float(self.bench.piezo.position())
+
+    def move_home(self):
+        self.set_voltage(0.)
+
+
+class SimulatedKDC101(SimulatedInstrument):
+    """
+    Thorlabs KDC101 servo driving the bench focus axis (mm). Moves block
+    until the axis is inside its settle window; the leadscrew has backlash.
+    """
+    latency = 0.005
+
+    def __init__(self, address, settle=0.05, **kwargs):
+        super().__init__(address, **kwargs)
+        self.settle = settle
+
+    def load_config(self):
+        self._io()
+
+    def move_home(self):
+        self.move_absolute(0.)
+
+    def move_absolute(self, position):
+        with self._lock:
+            self._io()
+        duration = self.bench.z.start(float(position))
+        sleep(duration + self.settle)
+
+    def move_relative(self, distance):
+        self.move_absolute(self.bench.z.target + distance)
+
+    @property
+    def position(self):
+        with self._lock:
+            self._io()
+        return float(self.bench.z.position())
+
+
+class SimulatedCS165MUM(SimulatedInstrument):
+    """
+    Thorlabs CS165MU camera looking at the bench. The sensor free-runs at
+    ``frame_rate`` (or slower for long exposures) and the driver queues up
+    to ``queue_frames`` finished frames; older ones are lost. Each frame is
+    rendered at the middle of its exposure.
+    """
+    latency = 0.
+    shape = (1080, 1440)
+    frame_rate = 34.8
+    queue_frames = 4
+
+    def __init__(self, address, **kwargs):
+        super().__init__(address, **kwargs)
+        self.exposure_time = 0.01
+        self._epoch = perf_counter()
+        self._next = 1
+
+    def image_acquire(self):
+        with self._lock:
+            period = max(1. / self.frame_rate, self.exposure_time)
+            latest = int((perf_counter() - self._epoch) // period)
+            index = max(self._next, latest - self.queue_frames + 1)
+            finished = self._epoch + index * period
+            _wait_until(finished)
+            self._next = index + 1
+        return self.bench.image(self.shape, finished - self.exposure_time / 2)
+
+
+class SimulatedDSA815(SimulatedInstrument):
+    """
+    Rigol DSA815 spectrum analyser looking at a source with a carrier, its
+    harmonics and a spur, over a log-detected noise floor.
+
+    Sweeps take the time set by ``:SWE:TIME`` or, in auto, the time the
+    resolution bandwidth needs for the span. In single sweep mode ``:INIT``
+    starts a sweep and ``*OPC?`` blocks until it is finished. Traces are
+    sent as ASCII or, after ``:FORM:TRAC:DATA REAL,32``, as a block of
+    float32 in the byte order set by ``:FORM:BORD``; either way a read costs
+    the transfer time of its bytes.
+    """
+    latency = 0.003
+    transfer_rate = 1e6     # bytes per second over USBTMC
+    danl = -135.            # displayed average noise level in dBm/Hz
+    tones = ((0., -20.), (1e6, -10.), (2e6, -45.), (3e6, -58.), (4e6, -70.), (7.3e6, -72.))
+
+    def __init__(self, address, **kwargs):
+        super().__init__(address, **kwargs)
+        self._preset()
+
+    def _preset(self):
+        self.start_frequency = 0.
+        self.stop_frequency = 10e6
+        self.points = 601
+        self.resolution_bandwidth = None
+        self.sweep_time = None
+        self.continuous = True
+        self.trace_format = 'ASC'
+        self.byte_order = 'NORM'
+        self._sweep_done = 0.
+
+    def initialize(self):
+        self.write("*RST")
+
+    @property
+    def rbw(self):
+        if self.resolution_bandwidth:
+            return self.resolution_bandwidth
+        span = self.stop_frequency - self.start_frequency
+        return float(np.clip(span / 300, 100., 1e6))
+
+    @property
+    def sweep_duration(self):
+        if self.sweep_time:
+            return self.sweep_time
+        span = self.stop_frequency - self.start_frequency
+        return float(np.clip(2.5 * span / self.rbw ** 2, 0.01, 1.5e3))
+
+    def trace(self):
+        """
+        Return the frequencies and amplitudes (dBm) of a freshly swept trace.
+        """
+        rng = self.bench.rng
+        frequencies = np.linspace(self.start_frequency, self.stop_frequency, self.points)
+        rbw = self.rbw
+        floor = 10 ** ((self.danl + 10 * np.log10(rbw)) / 10)
+        power = floor * rng.exponential(size=self.points)
+        sigma = rbw / 2.355
+        for frequency, level in self.tones:
+            frequency *= 1 + 1e-7 * rng.standard_normal()
+            power += 10 ** (level / 10) * np.exp(-0.5 * ((frequencies - frequency) / sigma) ** 2)
+        return frequencies, 10 * np.log10(power)
+
+    def trace_df(self):
+        frequencies = np.linspace(self.start_frequency, self.stop_frequency, self.points)
+        amplitudes = np.array(self.values(":TRAC:DATA? TRACE1"))
+        return pd.DataFrame({0: frequencies, 1: amplitudes})
+
+    def values(self, command):
+        response = self.ask(command)
+        if response.startswith('#'):
+            # definite length block header: '#', digit count, byte count
+            response = response[2 + int(response[1]):]
+        return [float(value) for value in response.split(',')]
+
+    def _command(self, command):
+        # headers without the optional :SENSe root and leading colon
+        header, argument = re.match(r'(?::?SENSE?)?:?([A-Z:*]+)\s*(.*)', command.upper()).groups()
+        if header == '*RST':
+            self._preset()
+        elif header == 'INIT:CONT':
+            self.continuous = argument in ('ON', '1')
+        elif header == 'INIT':
+            self._sweep_done = perf_counter() + self.sweep_duration
+        elif header.endswith('FORM:TRAC:DATA') or header == 'FORM':
+            self.trace_format = 'REAL,32' if argument.replace(' ', '') == 'REAL,32' else 'ASC'
+        elif header.startswith('FORM:BORD'):
+            self.byte_order = 'SWAP' if argument.startswith('SWAP') else 'NORM'
+        elif header.endswith('FREQ:STAR'):
+            self.start_frequency = float(argument)
+        elif header.endswith('FREQ:STOP'):
+            self.stop_frequency = float(argument)
+        elif header.endswith('FREQ:CENT'):
+            span = self.stop_frequency - self.start_frequency
+            self.start_frequency = float(argument) - span / 2
+            self.stop_frequency = float(argument) + span / 2
+        elif header.endswith('FREQ:SPAN'):
+            centre = (self.stop_frequency + self.start_frequency) / 2
+            self.start_frequency = centre - float(argument) / 2
+            self.stop_frequency = centre + float(argument) / 2
+        elif header.endswith('SWE:POIN'):
+            self.points = int(np.clip(int(float(argument)), 101, 3001))
+        elif header.endswith('SWE:TIME:AUTO'):
+            if argument in ('ON', '1'):
+                self.sweep_time = None
+        elif header.endswith('SWE:TIME'):
+            self.sweep_time = float(argument)
+        elif header.endswith('BAND:RES:AUTO') or header.endswith('BWID:RES:AUTO'):
+            if argument in ('ON', '1'):
+                self.resolution_bandwidth = None
+        elif header.endswith('BAND:RES') or header.endswith('BWID:RES'):
+            self.resolution_bandwidth = float(argument)
+        else:
+            super()._command(command)
+
+    def _query(self, command):
+        command = command.upper()
+        if command == '*OPC?':
+            _wait_until(self._sweep_done)
+            return '1'
+        if command.startswith(':TRAC:DATA?') or command.startswith(':TRACE:DATA?'):
+            _wait_until(self._sweep_done)
+            amplitudes = self.trace()[1]
+            if self.trace_format == 'REAL,32':
+                data = amplitudes.astype('<f4' if self.byte_order == 'SWAP' else '>f4').tobytes()
+                sleep(len(data) / self.transfer_rate)
+                return b'#9%09d' % len(data) + data + b'\n'
+            data = ', '.join('%.6e' % value for value in amplitudes)
+            sleep(len(data) / self.transfer_rate)
+            return '#9%09d%s' % (len(data), data)
+        if command.startswith(':FORM:TRAC:DATA?') or command.startswith(':FORM?'):
+            return 'REAL,32' if self.trace_format == 'REAL,32' else 'ASCii'
+        if command.endswith('FREQ:STAR?'):
+            return '%.6e' % self.start_frequency
+        if command.endswith('FREQ:STOP?'):
+            return '%.6e' % self.stop_frequency
+        if command.endswith('SWE:POIN?'):
+            return '%d' % self.points
+        if command.endswith('SWE:TIME?'):
+            return '%.6e' % self.sweep_duration
+        if command.endswith('BAND:RES?') or command.endswith('BWID:RES?'):
+            return '%.6e' % self.rbw
+        return super()._query(command)
+
+
+SIMULATED = {
+    'Keithley2000': SimulatedKeithley2000,
+    'ThorlabsPM100USB': SimulatedPM100USB,
+    'SHRC203': SimulatedSHRC203,
+    'KPZ101': SimulatedKPZ101,
+    'KDC101': SimulatedKDC101,
+    'CS165MUM': SimulatedCS165MUM,
+    'DSA815': SimulatedDSA815,
+}
+
+
+# Module and class of the real driver behind each instrument name. Drivers
+# are only imported when a real address is opened, so simulated runs do
+# not need them installed.
+DRIVERS = {
+    'Keithley2000': 'pymeasure.instruments.keithley:Keithley2000',
+    'ThorlabsPM100USB': 'pymeasure.instruments.thorlabs:ThorlabsPM100USB',
+    'SHRC203': 'pymeasure.instruments.optosigma:SHRC203',
+    'KPZ101': 'pymeasure.instruments.thorlabs:KPZ101',
+    'KDC101': 'pymeasure.instruments.thorlabs:KDC101',
+    'CS165MUM': 'pymeasure.instruments.thorlabs:CS165MUM',
+    'DSA815': 'pymeasure.instruments:DSA815',
+}
+
+
+def driver_name(instrument):
+    """
+    Return the name of ``instrument``, given as a driver class, a key of
+    :data:`DRIVERS` or a ``'module:Class'`` path.
+    """
+    if isinstance(instrument, str):
+        return instrument.rpartition(':')[2]
+    return instrument.__name__
+
+
+def resolve_driver(instrument):
+    """
+    Return the driver class of ``instrument``, importing it if it is given
+    by name (see :func:`driver_name`).
+    """
+    if not isinstance(instrument, str):
+        return instrument
+    module, _, name = DRIVERS.get(instrument, instrument).partition(':')
+    if not name:
+        raise ValueError("Unknown instrument %s, expected one of %s or a 'module:Class' path"
+                         % (instrument, sorted(DRIVERS)))
+    return getattr(importlib.import_module(module), name)
+
+
+def is_simulated(address):
+    """
+    Return True for addresses that select a simulated instrument, i.e.
+    addresses starting with ``SIM`` (e.g. ``'SIM::KEITHLEY'``).
+    """
+    return str(address).upper().startswith('SIM')
+
+
+_pool = None
+
+
+def use_pool(pool):
+    """
+    Route :func:`connect` through ``pool`` (an object with a ``connect``
+    method taking the same arguments, such as
+    :class:`procedure.batch.pool.ConnectionPool`), or back to opening a
+    new session per call with None.
+
+    :return: The pool used until now.
+    """
+    global _pool
+    previous, _pool = _pool, pool
+    return previous
+
+
+def connect(instrument, address, **kwargs):
+    """
+    Open ``instrument`` at ``address``, or its simulated stand-in on the
+    shared bench if the address is a simulated one.
+
+    While a pool is set with :func:`use_pool`, the session is taken from
+    the pool instead, so it stays open across procedure runs.
+
+    :param instrument: The pymeasure instrument class, or its name (e.g.
+        ``'Keithley2000'``), in which case the driver is only imported
+        for a real address.
+    :param address: VISA address of the instrument.
+    """
+    if _pool is not None:
+        return _pool.connect(instrument, address, **kwargs)
+    return open_instrument(instrument, address, **kwargs)
+
+
+def open_instrument(instrument, address, **kwargs):
+    """
+    Open a new session to ``instrument`` at ``address``, simulated or not,
+    regardless of any pool.
+    """
+    if not is_simulated(address):
+        return resolve_driver(instrument)(address, **kwargs)
+    name = driver_name(instrument)
+    if name not in SIMULATED:
+        raise ValueError("No simulated instrument for %s" % name)
+    log.info("Using simulated %s at %s" % (name, address))
+    return SIMULATED[name](address, **kwargs)
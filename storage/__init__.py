@@ -0,0 +1 @@
+from .columnstore import ColumnStore, ColumnStoreReader, export_csv
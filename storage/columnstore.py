@@ -0,0 +1,266 @@
+# Purpose: Columnar binary results store for scans, spectra and camera frames
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import json
+import os
+import zlib
+
+import numpy as np
+
+
+META_FILENAME = 'meta.json'
+
+
+class ColumnStore:
+    """
+    Append-only columnar store on disk.
+
+    Each column is typed and may hold N-D values per row (a trace or an image).
+    Batches are buffered and written in chunks of ``chunk_rows`` rows.
+    Uncompressed columns are kept as one raw file each so the reader can
+    memory-map them; compressed columns are written as one zlib block per chunk.
+
+    Opening a directory that already holds a store resumes it: new rows are
+    appended after the stored ones, and data written past the stored row
+    count (e.g. by a run that died before updating the metadata) is dropped.
+
+    :param directory: Directory holding the store, created if missing.
+    :param chunk_rows: Number of rows buffered before a chunk is written.
+    :param compression: zlib level (1-9) for the column chunks, or None.
+    :param attrs: Dictionary of metadata (e.g. procedure parameters) to keep
+        with the data, merged into the stored one when resuming.
+    """
+
+    def __init__(self, directory, chunk_rows=4096, compression=None, attrs=None):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        os.makedirs(directory, exist_ok=True)
+
+        self.meta = {'rows': 0, 'columns': [], 'attrs': attrs or {}}
+        self._pending = {}
+        self._pending_rows = 0
+        if os.path.exists(os.path.join(directory, META_FILENAME)):
+            self._resume(attrs)
+
+    @property
+    def columns(self):
+        return [c['name'] for c in self.meta['columns']]
+
+    def append(self, batch):
+        """
+        Append a batch of rows.
+
+        :param batch: Dictionary mapping column names to arrays whose first
+            dimension is the number of rows in the batch. Every call must
+            provide the same columns, with the same per-row shape.
+        """
+        arrays = {name: np.asarray(values) for name, values in batch.items()}
+        rows = {a.shape[0] if a.ndim else 1 for a in arrays.values()}
+        if len(rows) != 1:
+            raise ValueError("Columns in a batch must have the same number of rows")
+        arrays = {name: a.reshape(1) if a.ndim == 0 else a for name, a in arrays.items()}
+
+        if not self.meta['columns']:
+            self._create_columns(arrays)
+        elif set(arrays) != set(self.columns):
+            raise KeyError("Batch columns %s do not match store columns %s"
+                           % (sorted(arrays), self.columns))
+
+        for name, a in arrays.items():
+            self._pending.setdefault(name, []).append(a)
+        self._pending_rows += rows.pop()
+        if self._pending_rows >= self.chunk_rows:
+            self.flush()
+
+    def append_row(self, row):
+        """
+        Append a single row given as a dictionary of scalars or arrays.
+        """
+        self.append({name: np.asarray(value)[np.newaxis] for name, value in row.items()})
+
+    def flush(self):
+        """
+        Write the buffered rows to disk and update the metadata.
+        """
+        if not self._pending_rows:
+            return
+        for index, column in enumerate(self.meta['columns']):
+            chunk = np.concatenate(self._pending[column['name']]).astype(column['dtype'], copy=False)
+            if chunk.shape[1:] != tuple(column['shape']):
+                raise ValueError("Column '%s' expects rows of shape %s, got %s"
+                                 % (column['name'], tuple(column['shape']), chunk.shape[1:]))
+            data = np.ascontiguousarray(chunk).tobytes()
+            if self.compression:
+                path = os.path.join(self.directory, 'c%d.%d.z' % (index, len(column['chunks'])))
+                with open(path, 'wb') as f:
+                    f.write(zlib.compress(data, self.compression))
+                column['chunks'].append(chunk.shape[0])
+            else:
+                with open(os.path.join(self.directory, 'c%d.bin' % index), 'ab') as f:
+                    f.write(data)
+
+        self.meta['rows'] += self._pending_rows
+        self._pending = {}
+        self._pending_rows = 0
+        self._write_meta()
+        log.debug("Flushed store %s to %d rows" % (self.directory, self.meta['rows']))
+
+    def close(self):
+        self.flush()
+        self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _resume(self, attrs):
+        with open(os.path.join(self.directory, META_FILENAME)) as f:
+            meta = json.load(f)
+        if any(bool(c['compression']) != bool(self.compression) for c in meta['columns']):
+            raise ValueError("Store %s cannot be resumed with compression %s"
+                             % (self.directory, self.compression))
+        meta['attrs'].update(attrs or {})
+        self.meta = meta
+        for index, column in enumerate(meta['columns']):
+            if column['compression']:
+                continue
+            path = os.path.join(self.directory, 'c%d.bin' % index)
+            size = meta['rows'] * np.dtype(column['dtype']).itemsize * int(np.prod(column['shape']))
+            with open(path, 'ab') as f:
+                if f.tell() < size:
+                    raise ValueError("Column file %s holds fewer than the %d stored rows" % (path, meta['rows']))
+                if f.tell() > size:
+                    log.warning("Dropping %d bytes of %s past the %d stored rows"
+                                % (f.tell() - size, path, meta['rows']))
+                    f.truncate(size)
+        log.info("Resuming store %s at %d rows" % (self.directory, meta['rows']))
+
+    def _create_columns(self, arrays):
+        for index, (name, a) in enumerate(arrays.items()):
+            # data files left without metadata are not part of the store
+            if not self.compression:
+                open(os.path.join(self.directory, 'c%d.bin' % index), 'wb').close()
+            self.meta['columns'].append({
+                'name': name,
+                'dtype': a.dtype.str,
+                'shape': list(a.shape[1:]),
+                'compression': self.compression,
+                'chunks': [],
+            })
+
+    def _write_meta(self):
+        path = os.path.join(self.directory, META_FILENAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.meta, f, indent=1, default=str)
+        os.replace(path + '.tmp', path)
+
+
+class ColumnStoreReader:
+    """
+    Read access to a :class:`ColumnStore` directory.
+
+    Uncompressed columns are returned as read-only memory maps, so large scans
+    can be sliced without loading them. Compressed columns are decompressed
+    on first access and cached.
+
+    :param directory: Directory written by a :class:`ColumnStore`.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILENAME)) as f:
+            self.meta = json.load(f)
+        self._columns = {c['name']: (i, c) for i, c in enumerate(self.meta['columns'])}
+        self._cache = {}
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    @property
+    def attrs(self):
+        return self.meta['attrs']
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __getitem__(self, name):
+        if name not in self._cache:
+            self._cache[name] = self._load(name)
+        return self._cache[name]
+
+    def _load(self, name):
+        index, column = self._columns[name]
+        dtype = np.dtype(column['dtype'])
+        shape = (self.meta['rows'],) + tuple(column['shape'])
+        if not column['compression']:
+            if not self.meta['rows']:
+                return np.empty(shape, dtype=dtype)
+            path = os.path.join(self.directory, 'c%d.bin' % index)
+            return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+        chunks = []
+        for i, rows in enumerate(column['chunks']):
+            with open(os.path.join(self.directory, 'c%d.%d.z' % (index, i)), 'rb') as f:
+                data = zlib.decompress(f.read())
+            chunks.append(np.frombuffer(data, dtype=dtype).reshape((rows,) + shape[1:]))
+        if not chunks:
+            return np.empty(shape, dtype=dtype)
+        return np.concatenate(chunks)
+
+
+def export_csv(directory, filename, columns=None, delimiter=','):
+    """
+    Export a store to CSV.
+
+    Columns holding one value per row are written as-is. Columns holding a
+    1-D array per row (e.g. a trace) are expanded so each element gets its own
+    line, with the scalar columns repeated. Only 1-D columns of the same
+    length as the first one can share lines; the others (e.g. a handful of
+    peak frequencies next to a trace) are skipped and can be exported on
+    their own through ``columns``. Columns with higher dimensions (images)
+    are skipped.
+
+    :param directory: Directory written by a :class:`ColumnStore`.
+    :param filename: CSV file to write.
+    :param columns: Columns to export, defaults to all of them.
+    """
+    reader = ColumnStoreReader(directory)
+    columns = columns or reader.columns
+    scalars = [c for c in columns if reader[c].ndim == 1]
+    vectors = [c for c in columns if reader[c].ndim == 2]
+    skipped = [c for c in columns if reader[c].ndim > 2]
+    if skipped:
+        log.warning("Columns %s hold images and are not exported to CSV" % skipped)
+    if vectors:
+        length = reader[vectors[0]].shape[1]
+        mismatched = [c for c in vectors if reader[c].shape[1] != length]
+        if mismatched:
+            log.warning("Columns %s do not hold %d values per row like %s and are not exported to "
+                        "the same CSV" % (mismatched, length, vectors[0]))
+        vectors = [c for c in vectors if c not in mismatched]
+
+    header = [c for c in columns if c in scalars or c in vectors]
+    with open(filename, 'w') as f:
+        f.write(delimiter.join(header) + '\n')
+        if not vectors:
+            for start in range(0, len(reader), 65536):
+                block = np.column_stack([reader[c][start:start + 65536] for c in header])
+                np.savetxt(f, block, delimiter=delimiter, fmt='%.10g')
+            return
+
+        block = np.empty((length, len(header)), dtype=np.float64)
+        for row in range(len(reader)):
+            for i, c in enumerate(header):
+                block[:, i] = reader[c][row]
+            np.savetxt(f, block, delimiter=delimiter, fmt='%.10g')
@@ -0,0 +1,11 @@
+# Purpose: Make the checkout importable as the procedure package, whatever its directory is called
+
+
+import os
+import sys
+import types
+
+if 'procedure' not in sys.modules:
+    package = types.ModuleType('procedure')
+    package.__path__ = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    sys.modules['procedure'] = package
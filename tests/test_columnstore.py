@@ -0,0 +1,59 @@
+# Purpose: Tests of the columnar results store
+
+
+import numpy as np
+import pytest
+
+from procedure.storage import ColumnStore, ColumnStoreReader, export_csv
+
+
+def write(directory, values, **kwargs):
+    with ColumnStore(directory, **kwargs) as store:
+        store.append({'x': np.asarray(values), 'trace': np.outer(values, np.ones(3))})
+
+
+def test_round_trip(tmp_path):
+    write(tmp_path, [0, 1, 2, 3, 4], chunk_rows=2)
+    reader = ColumnStoreReader(tmp_path)
+    assert len(reader) == 5
+    np.testing.assert_array_equal(reader['x'], [0, 1, 2, 3, 4])
+    assert reader['trace'].shape == (5, 3)
+
+
+@pytest.mark.parametrize('compression', [None, 3])
+def test_reopen_resumes(tmp_path, compression):
+    write(tmp_path, [0, 1, 2, 3, 4], compression=compression)
+    write(tmp_path, [100, 101, 102], compression=compression)
+    reader = ColumnStoreReader(tmp_path)
+    assert len(reader) == 8
+    np.testing.assert_array_equal(reader['x'], [0, 1, 2, 3, 4, 100, 101, 102])
+    np.testing.assert_array_equal(reader['trace'][-1], [102, 102, 102])
+
+
+def test_reopen_drops_unrecorded_rows(tmp_path):
+    write(tmp_path, [0, 1, 2])
+    # a run that died after writing its data but before its metadata
+    with open(tmp_path / 'c0.bin', 'ab') as f:
+        f.write(np.arange(2).tobytes())
+    write(tmp_path, [7])
+    np.testing.assert_array_equal(ColumnStoreReader(tmp_path)['x'], [0, 1, 2, 7])
+
+
+def test_stale_files_without_metadata_are_replaced(tmp_path):
+    (tmp_path / 'c0.bin').write_bytes(np.arange(5).tobytes())
+    write(tmp_path, [9, 8])
+    np.testing.assert_array_equal(ColumnStoreReader(tmp_path)['x'], [9, 8])
+
+
+def test_export_csv_skips_vectors_of_another_length(tmp_path):
+    with ColumnStore(tmp_path / 'store') as store:
+        store.append({'sweep': np.arange(2), 'trace': np.arange(10.).reshape(2, 5),
+                      'peaks': np.arange(4.).reshape(2, 2)})
+    export_csv(tmp_path / 'store', tmp_path / 'all.csv')
+    lines = (tmp_path / 'all.csv').read_text().splitlines()
+    assert lines[0] == 'sweep,trace'
+    assert len(lines) == 1 + 2 * 5
+    assert lines[-1] == '1,9'
+
+    export_csv(tmp_path / 'store', tmp_path / 'peaks.csv', columns=['sweep', 'peaks'])
+    assert (tmp_path / 'peaks.csv').read_text().splitlines() == ['sweep,peaks', '0,0', '0,1', '1,2', '1,3']
@@ -0,0 +1,42 @@
+# Purpose: Tests of the phase-correlation drift estimator
+
+
+import cv2
+import numpy as np
+import pytest
+
+from procedure.microscope.focus import Drift
+
+
+def textured(seed=0, shape=(128, 128)):
+    return cv2.GaussianBlur(np.random.default_rng(seed).random(shape), (0, 0), 2)
+
+
+def shifted(image, dx, dy):
+    # sub-pixel shift as a phase ramp, so the true drift is exact
+    fy = np.fft.fftfreq(image.shape[0])[:, np.newaxis]
+    fx = np.fft.fftfreq(image.shape[1])[np.newaxis, :]
+    return np.real(np.fft.ifft2(np.fft.fft2(image) * np.exp(-2j * np.pi * (fx * dx + fy * dy))))
+
+
+@pytest.mark.parametrize('upsample', [None, 20])
+@pytest.mark.parametrize('dx, dy', [(3.3, -1.7), (0.25, 0.6), (-5.5, 2.2)])
+def test_estimate_recovers_subpixel_shift(upsample, dx, dy):
+    reference = textured()
+    shift, confidence = Drift(reference, upsample=upsample).estimate(shifted(reference, dx, dy))
+    np.testing.assert_allclose(shift, [dx, dy], atol=0.1)
+    assert confidence > 0.5
+
+
+def test_estimate_with_noise():
+    reference = textured(1)
+    noisy = shifted(reference, 2.4, -3.1) + np.random.default_rng(2).normal(0, 0.01, reference.shape)
+    shift = Drift(reference, upsample=10).estimate(noisy)[0]
+    np.testing.assert_allclose(shift, [2.4, -3.1], atol=0.1)
+
+
+def test_set_reference():
+    drift = Drift(textured(3))
+    reference = textured(4)
+    drift.set_reference(reference)
+    np.testing.assert_allclose(drift.estimate(reference)[0], [0, 0], atol=0.1)
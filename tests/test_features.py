@@ -0,0 +1,75 @@
+# Purpose: Tests of the spectrum trace features
+
+
+import numpy as np
+import pytest
+
+from procedure.rigol.features import (TraceAnalyzer, noise_floor, find_peaks, band_power, harmonic_levels,
+                                      parse_bands)
+
+
+@pytest.fixture
+def trace():
+    # 10 kHz bins, a -10 dBm tone at 1 MHz with harmonics at -40 and -50 dBm
+    frequencies = np.linspace(0, 10e6, 1001)
+    amplitudes = np.full(frequencies.size, -90.)
+    amplitudes[[100, 200, 300]] = [-10., -50., -60.]
+    return frequencies, amplitudes
+
+
+def test_noise_floor(trace):
+    assert noise_floor(trace[1]) == -90.
+
+
+def test_find_peaks_strongest_first(trace):
+    np.testing.assert_array_equal(find_peaks(trace[1], -70.), [100, 200, 300])
+    np.testing.assert_array_equal(find_peaks(trace[1], -55.), [100, 200])
+
+
+def test_find_peaks_skips_skirts_and_edges():
+    amplitudes = np.array([0., -90., -90., -20., -10., -20., -90., -90., -90., -5.])
+    np.testing.assert_array_equal(find_peaks(amplitudes, -50.), [4])
+
+
+def test_band_power(trace):
+    frequencies, amplitudes = trace
+    powers = band_power(frequencies, amplitudes, [(0.95e6, 1.05e6), (4.001e6, 4.005e6)])
+    assert powers[0] == pytest.approx(10 * np.log10(10 ** -1 + 10 * 10 ** -9))
+    # a band between two bins holds no power
+    assert np.isnan(powers[1])
+
+
+def test_harmonic_levels(trace):
+    frequencies, amplitudes = trace
+    levels = harmonic_levels(frequencies, amplitudes, 1e6, count=4)
+    np.testing.assert_array_equal(levels, [-10., -50., -60., -90.])
+    assert np.isnan(harmonic_levels(frequencies, amplitudes, 4e6, count=3)[-1])
+
+
+def test_analyze(trace):
+    analyzer = TraceAnalyzer(threshold=15, max_peaks=4, bands=[(0.95e6, 1.05e6)], harmonics=3,
+                             min_frequency=0.5e6)
+    features = analyzer.analyze(*trace)
+    assert features.noise_floor == -90.
+    assert features.peaks == 3
+    np.testing.assert_array_equal(features.peak_frequencies[:3], [1e6, 2e6, 3e6])
+    assert np.isnan(features.peak_frequencies[3])
+    assert features.band_powers.shape == (1,)
+    assert features.fundamental == 1e6
+    np.testing.assert_array_equal(features.harmonics, [-40., -50.])
+    assert features.thd == pytest.approx(10 * np.log10(1e-4 + 1e-5))
+
+
+def test_analyze_without_peaks(trace):
+    features = TraceAnalyzer(threshold=100).analyze(*trace)
+    assert features.peaks == 0
+    assert np.isnan(features.fundamental) and np.isnan(features.thd)
+    assert features.harmonics.shape == (4,)
+    assert features.band_powers.size == 0
+
+
+def test_parse_bands():
+    assert parse_bands('0.9e6:1.1e6, 2e6:5e6') == [(0.9e6, 1.1e6), (2e6, 5e6)]
+    assert parse_bands('') == []
+    with pytest.raises(ValueError):
+        parse_bands('5e6:2e6')
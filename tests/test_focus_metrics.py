@@ -0,0 +1,40 @@
+# Purpose: Tests of the batched focus metrics
+
+
+import cv2
+import numpy as np
+import pytest
+
+from procedure.microscope.focus import FocusScorer, focus_scores, METRICS
+
+
+@pytest.fixture
+def frames():
+    sharp = (np.random.default_rng(0).random((120, 160)) * 255).astype(np.uint8)
+    return np.stack([sharp, cv2.GaussianBlur(sharp, (0, 0), 3)])
+
+
+@pytest.mark.parametrize('metric', METRICS)
+def test_sharp_frame_scores_higher(frames, metric):
+    sharp, blurred = focus_scores(frames, metric)
+    assert sharp > blurred
+
+
+@pytest.mark.parametrize('metric', METRICS)
+def test_stack_matches_single_frames(frames, metric):
+    scorer = FocusScorer(metric)
+    stacked = scorer.score(frames)
+    # the second call reuses the buffers sized by the first
+    single = [scorer.score(frame)[0] for frame in frames]
+    np.testing.assert_allclose(stacked, single, rtol=1e-5)
+
+
+def test_color_frames_score_as_gray(frames):
+    gray = frames[0].astype(np.float32)
+    color = np.repeat(frames[0][..., np.newaxis], 3, axis=2)
+    np.testing.assert_allclose(focus_scores(color), focus_scores(gray), rtol=1e-4)
+
+
+def test_unknown_metric():
+    with pytest.raises(ValueError):
+        FocusScorer('sharpness')
@@ -0,0 +1,41 @@
+# Purpose: Tests of the sinusoidal fringe fit
+
+
+import numpy as np
+import pytest
+
+from procedure.thorlabs.fringe import fit_fringe
+
+
+def fringe(x, period=2.5, amplitude=0.3, offset=1., phase=0.7):
+    return offset + amplitude * np.cos(2 * np.pi * x / period + phase)
+
+
+def test_fit_recovers_parameters():
+    x = np.linspace(0, 20, 200)
+    fit = fit_fringe(x, fringe(x))
+    assert fit.period == pytest.approx(2.5, rel=1e-6)
+    assert fit.amplitude == pytest.approx(0.3, rel=1e-6)
+    assert fit.offset == pytest.approx(1., rel=1e-6)
+    assert fit.visibility == pytest.approx(0.3, rel=1e-6)
+    assert fit.phase == pytest.approx(0.7, abs=1e-6)
+    assert fit.fringes == pytest.approx(8., rel=1e-6)
+
+
+def test_fit_with_noise_and_unordered_drive():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 15, 300)
+    fit = fit_fringe(x, fringe(x) + rng.normal(0, 0.02, x.size))
+    assert fit.period == pytest.approx(2.5, rel=1e-2)
+    assert abs(fit.period - 2.5) < 5 * fit.period_error
+    assert fit.amplitude == pytest.approx(0.3, rel=0.05)
+
+
+@pytest.mark.parametrize('y', [np.ones(100), np.random.default_rng(1).normal(1, 0.01, 100)],
+                         ids=['flat', 'noise'])
+def test_no_fringe(y):
+    assert fit_fringe(np.linspace(0, 10, 100), y) is None
+
+
+def test_too_few_points():
+    assert fit_fringe([0, 1, 2], [1, 2, 1]) is None
@@ -0,0 +1,86 @@
+# Purpose: Tests of the raster scan engine
+
+
+import numpy as np
+import pytest
+
+from procedure.common import StepScheduler
+from procedure.optosigma.scan import bin_samples, AdaptiveScan
+
+
+class Axis:
+
+    def __init__(self):
+        self.position = 0.
+
+    def move(self, position):
+        self.position = position
+
+
+class Stage:
+
+    def __init__(self):
+        self.ch_1 = Axis()
+        self.ch_2 = Axis()
+
+
+def measure(scan, field):
+    stage = Stage()
+    scheduler = StepScheduler(stage.ch_2.move, lambda: field(stage.ch_1.position, stage.ch_2.position))
+    return list(scan.run(stage, scheduler))
+
+
+def test_bin_samples_averages_each_pixel():
+    positions = np.array([-0.2, 0.1, 0.9, 1.2, 1.9, 2.1])
+    values = np.array([1., 3., 10., 20., 5., 7.])
+    np.testing.assert_allclose(bin_samples([0., 1., 2.], positions, values), [2., 15., 6.])
+
+
+def test_bin_samples_fills_empty_pixels():
+    positions = np.array([0., 0.1, 3.])
+    values = np.array([1., 1., 4.])
+    np.testing.assert_allclose(bin_samples([0., 1., 2., 3.], positions, values), [1., 2., 3., 4.])
+
+
+def test_bin_samples_reversed_row_and_outside_samples():
+    positions = np.array([-5., 0., 1., 2., 7.])
+    values = np.array([100., 0., 1., 2., 100.])
+    np.testing.assert_allclose(bin_samples([2., 1., 0.], positions, values), [2., 1., 0.])
+
+
+def test_bin_samples_needs_two_pixels():
+    with pytest.raises(ValueError):
+        bin_samples([0.], np.array([0.]), np.array([1.]))
+
+
+def test_resample_plane_from_coarse_pass():
+    xs, ys = np.arange(17.), np.arange(33.)
+    # each coarse tile spans a third of the range of the plane
+    scan = AdaptiveScan(xs, ys, stride=8, threshold=0.5)
+    points = measure(scan, lambda x, y: 2 * x + 3 * y)
+    # so none is refined, and bilinear tiles reproduce the plane
+    assert len(points) == 3 * 5
+    np.testing.assert_allclose(scan.resample(), 2 * xs[:, np.newaxis] + 3 * ys[np.newaxis, :])
+
+
+def test_resample_refines_an_edge():
+    xs, ys = np.arange(33.), np.arange(33.)
+    field = lambda x, y: float(x + y > 40)
+    scan = AdaptiveScan(xs, ys, stride=8, threshold=0.05)
+    points = measure(scan, field)
+    truth = (xs[:, np.newaxis] + ys[np.newaxis, :] > 40).astype(float)
+    grid = scan.resample()
+    assert len(points) < truth.size / 2
+    assert not np.isnan(grid).any()
+    for x, y, value in points:
+        assert grid[int(x), int(y)] == value
+    # only pixels next to the edge may be interpolated
+    distance = np.abs(xs[:, np.newaxis] + ys[np.newaxis, :] - 40.5)
+    np.testing.assert_array_equal(grid[distance > 2], truth[distance > 2])
+
+
+def test_resample_single_row():
+    xs, ys = np.array([5.]), np.arange(17.)
+    scan = AdaptiveScan(xs, ys, stride=4)
+    measure(scan, lambda x, y: float(y >= 10))
+    np.testing.assert_array_equal(scan.resample(), (ys >= 10)[np.newaxis, :].astype(float))
@@ -0,0 +1,71 @@
+# Purpose: Tests of the segmented sweep planning and stitching
+
+
+import numpy as np
+import pytest
+
+from procedure.rigol.segments import plan_segments, MAX_POINTS, MIN_POINTS
+
+
+def sweep(plan, index):
+    # a segment trace that encodes the frequency of each of its bins
+    segment = plan.segments[index]
+    return np.linspace(segment.start, segment.stop, segment.points) / 1e6
+
+
+def test_single_segment_for_narrow_span():
+    plan = plan_segments(1e6, 2e6, 1e3)
+    assert len(plan.segments) == 1
+    assert plan.points == 2001
+    assert plan.segments[0].points == 2001
+
+
+def test_narrow_span_keeps_minimum_points():
+    plan = plan_segments(1e6, 1.01e6, 1e3)
+    assert plan.points == MIN_POINTS
+
+
+@pytest.mark.parametrize('start, stop, rbw, bins_per_rbw', [(0, 100e6, 10e3, 2), (9e3, 1.5e9, 300e3, 3),
+                                                            (10e6, 13e6, 1e3, 2)])
+def test_segments_tile_the_grid(start, stop, rbw, bins_per_rbw):
+    plan = plan_segments(start, stop, rbw, bins_per_rbw=bins_per_rbw)
+    spacing = np.diff(plan.frequencies)
+    assert spacing.max() <= rbw / bins_per_rbw * (1 + 1e-9)
+    assert plan.frequencies[0] == start and plan.frequencies[-1] == stop
+    assert len({segment.points for segment in plan.segments}) == 1
+    covered = np.zeros(plan.points, dtype=int)
+    for previous, segment in zip([None] + plan.segments[:-1], plan.segments):
+        assert segment.points <= MAX_POINTS
+        assert segment.start == plan.frequencies[segment.first]
+        assert segment.stop == plan.frequencies[segment.first + segment.points - 1]
+        covered[segment.first + segment.keep.start:segment.first + segment.keep.stop] += 1
+        if previous is not None:
+            assert previous.first + previous.points - segment.first >= 4
+    np.testing.assert_array_equal(covered, 1)
+
+
+def test_stitch_lines_up_bins():
+    plan = plan_segments(0, 100e6, 10e3)
+    assert len(plan.segments) > 1
+    stitched = plan.empty()
+    for index in range(len(plan.segments)):
+        plan.stitch(index, sweep(plan, index), stitched)
+    np.testing.assert_allclose(stitched, plan.frequencies / 1e6, rtol=1e-9)
+
+
+def test_stitch_rejects_wrong_length():
+    plan = plan_segments(0, 100e6, 10e3)
+    with pytest.raises(ValueError):
+        plan.stitch(0, np.zeros(plan.segments[0].points - 1), plan.empty())
+
+
+def test_binary_transfer_is_cheaper():
+    ascii = plan_segments(0, 1.5e9, 10e3)
+    binary = plan_segments(0, 1.5e9, 10e3, bytes_per_point=4)
+    assert binary.duration < ascii.duration
+
+
+@pytest.mark.parametrize('start, stop, bins_per_rbw', [(2e6, 1e6, 2), (1e6, 2e6, 0)])
+def test_invalid_plans(start, stop, bins_per_rbw):
+    with pytest.raises(ValueError):
+        plan_segments(start, stop, 1e3, bins_per_rbw=bins_per_rbw)
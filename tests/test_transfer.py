@@ -0,0 +1,75 @@
+# Purpose: Tests of the binary DSA815 trace transfer
+
+
+import numpy as np
+import pytest
+
+from procedure.rigol.transfer import BinaryTraceReader
+
+
+class Analyzer:
+    """
+    Answers :TRAC:DATA? with a block and checks that every byte is read.
+    """
+
+    def __init__(self, block, trace_format='REAL,32'):
+        self.block = block
+        self.trace_format = trace_format
+        self.pending = b''
+        self.commands = []
+
+    def write(self, command):
+        self.commands.append(command)
+        if command.startswith(':TRAC:DATA?'):
+            self.pending = self.block
+
+    def ask(self, command):
+        self.commands.append(command)
+        return self.trace_format + '\n'
+
+    def read_bytes(self, count):
+        data, self.pending = self.pending[:count], self.pending[count:]
+        return data
+
+
+def block(values, termination=b'\n'):
+    data = np.asarray(values, dtype='<f4').tobytes()
+    size = str(len(data)).encode()
+    return b'#' + str(len(size)).encode() + size + data + termination
+
+
+def test_negotiate():
+    analyzer = Analyzer(b'')
+    assert BinaryTraceReader(analyzer).negotiate()
+    assert analyzer.commands[:2] == [':FORM:TRAC:DATA REAL,32', ':FORM:BORD SWAP']
+    assert not BinaryTraceReader(Analyzer(b'', trace_format='ASCii')).negotiate()
+
+
+def test_read():
+    values = np.linspace(-90, -10, 601)
+    analyzer = Analyzer(block(values))
+    trace = BinaryTraceReader(analyzer).read(601)
+    np.testing.assert_allclose(trace, values, rtol=1e-6)
+    assert analyzer.pending == b''
+
+
+def test_read_into_buffer():
+    out = np.empty(5)
+    reader = BinaryTraceReader(Analyzer(block([1, 2, 3, 4, 5])))
+    assert reader.read(5, out=out) is out
+    np.testing.assert_array_equal(out, [1, 2, 3, 4, 5])
+
+
+def test_wrong_size_is_drained():
+    analyzer = Analyzer(block(np.zeros(10)))
+    with pytest.raises(ValueError, match='Expected 12 points'):
+        BinaryTraceReader(analyzer).read(12)
+    # the next query starts clean
+    assert analyzer.pending == b''
+
+
+@pytest.mark.parametrize('data', [b'-8.1e+01, -8.2e+01\n', b'#0', block([1, 2, 3], termination=b'')],
+                         ids=['ascii', 'indefinite', 'unterminated'])
+def test_bad_blocks(data):
+    with pytest.raises(ValueError):
+        BinaryTraceReader(Analyzer(data)).read(3)
@@ -1,4 +1,5 @@
-
-from .autofocus import AutofocusProcedure 
-
-
+from .cs165mu_procedure import CS165MUProcedure
+from .camera_pipeline import FramePipeline, ColorConversion, FocusStage, DriftStage
+from .interference_procedure import InterferenceProcedure
+from .kpz101_procedure import KPZ101Procedure
+from .fringe import fit_fringe, FringeFit
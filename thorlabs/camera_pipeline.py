@@ -0,0 +1,196 @@
+# Purpose: Producer/consumer frame pipeline for the Thorlabs CS165MU camera
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+class FramePipeline:
+    """
+    Grab frames on one thread and process them on another.
+
+    The grab thread copies every frame into a free slot of a preallocated
+    ring of ``slots`` buffers and hands the slot to the processing thread,
+    so the sensor is read again while the previous frame is processed. When
+    every slot is still waiting to be processed the new frame is dropped
+    and counted. The processing thread runs each stage in turn on the slot
+    buffer and puts a result dictionary on :attr:`results`.
+
+    A stage is a callable ``stage(frame, result)`` that may add entries to
+    ``result``; stages must not keep a reference to ``frame``, which is
+    reused once the slot is released.
+
+    :param grab: Callable returning the next frame (e.g. ``camera.image_acquire``).
+    :param stages: List of processing stages.
+    :param slots: Number of frame buffers in the ring.
+    """
+
+    def __init__(self, grab, stages, slots=8):
+        self.grab = grab
+        self.stages = stages
+        self.slots = slots
+        self.ring = None
+        self.results = queue.Queue()
+
+        self.grabbed = 0
+        self.processed = 0
+        self.dropped = 0
+        self.latency_last = 0.
+        self.latency_max = 0.
+        self._latency_total = 0.
+
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        self._halt = threading.Event()
+        self._threads = []
+
+    def start(self):
+        first = np.asarray(self.grab())
+        self.ring = np.empty((self.slots,) + first.shape, dtype=first.dtype)
+        for slot in range(self.slots):
+            self._free.put(slot)
+        self._store(first, time.perf_counter())
+
+        self._threads = [threading.Thread(target=self._grab_loop, daemon=True),
+                         threading.Thread(target=self._process_loop, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        log.info("Frame pipeline started with %d slots of %s %s"
+                 % (self.slots, first.shape, first.dtype))
+
+    def stop(self):
+        self._halt.set()
+        self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    @property
+    def latency_mean(self):
+        return self._latency_total / self.processed if self.processed else 0.
+
+    def counters(self):
+        """
+        Return the frame counters and latencies (seconds) as a dictionary.
+        """
+        return {'grabbed': self.grabbed, 'processed': self.processed,
+                'dropped': self.dropped, 'latency_last': self.latency_last,
+                'latency_mean': self.latency_mean, 'latency_max': self.latency_max}
+
+    def _store(self, frame, timestamp):
+        self.grabbed += 1
+        try:
+            slot = self._free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return
+        np.copyto(self.ring[slot], frame)
+        self._ready.put((slot, self.grabbed - 1, timestamp))
+
+    def _grab_loop(self):
+        while not self._halt.is_set():
+            frame = self.grab()
+            self._store(frame, time.perf_counter())
+
+    def _process_loop(self):
+        while True:
+            item = self._ready.get()
+            if item is None:
+                return
+            slot, index, timestamp = item
+            result = {'frame': index, 'timestamp': timestamp}
+            try:
+                for stage in self.stages:
+                    stage(self.ring[slot], result)
+            except Exception:
+                log.exception("Processing frame %d failed" % index)
+            finally:
+                self._free.put(slot)
+
+            latency = time.perf_counter() - timestamp
+            self.processed += 1
+            self.latency_last = latency
+            self.latency_max = max(self.latency_max, latency)
+            self._latency_total += latency
+            result['latency'] = latency
+            self.results.put(result)
+
+
+class ColorConversion:
+    """
+    Pipeline stage converting frames into a preallocated output buffer.
+
+    :param code: OpenCV colour conversion code, e.g. ``cv2.COLOR_RGB2BGR``.
+    :param key: Result entry that receives the converted frame. It is
+        overwritten by the next frame, so later stages should use it rather
+        than keep it.
+    """
+
+    def __init__(self, code, key='converted'):
+        self.code = code
+        self.key = key
+        self._buffer = None
+
+    def __call__(self, frame, result):
+        self._buffer = cv2.cvtColor(frame, self.code, dst=self._buffer)
+        result[self.key] = self._buffer
+
+
+class FocusStage:
+    """
+    Pipeline stage adding ``'focus'`` from a :class:`FocusScorer`.
+    """
+
+    def __init__(self, scorer):
+        self.scorer = scorer
+
+    def __call__(self, frame, result):
+        result['focus'] = float(self.scorer.score(frame)[0])
+
+
+class DriftStage:
+    """
+    Pipeline stage adding ``'drift_x'``, ``'drift_y'`` and
+    ``'drift_confidence'`` against the first frame it sees.
+
+    :param drift_class: The drift estimator class, e.g. ``Drift``.
+    :param roi: Optional ``(top, bottom, left, right)`` box to track, which
+        keeps the FFTs small on full-resolution frames, or ``'centre'`` for
+        the ``roi_size`` box in the middle of the first frame.
+    :param roi_size: ``(height, width)`` of the centred box.
+    """
+
+    def __init__(self, drift_class, roi=None, roi_size=(256, 256), **kwargs):
+        self.drift_class = drift_class
+        self.roi = roi
+        self.roi_size = roi_size
+        self.kwargs = kwargs
+        self.drift = None
+
+    def __call__(self, frame, result):
+        if self.roi == 'centre':
+            self.roi = centred_roi(frame.shape, self.roi_size)
+        if self.roi is not None:
+            top, bottom, left, right = self.roi
+            frame = frame[top:bottom, left:right]
+        if self.drift is None:
+            self.drift = self.drift_class(frame, **self.kwargs)
+        (dx, dy), confidence = self.drift.estimate(frame)
+        result['drift_x'], result['drift_y'] = dx, dy
+        result['drift_confidence'] = confidence
+
+
+def centred_roi(shape, size):
+    """
+    Return the ``(top, bottom, left, right)`` box of ``size`` ``(height,
+    width)`` in the middle of a frame of ``shape``, clipped to the frame.
+    """
+    height, width = min(size[0], shape[0]), min(size[1], shape[1])
+    top, left = (shape[0] - height) // 2, (shape[1] - width) // 2
+    return top, top + height, left, left + width
@@ -1,15 +1,6 @@
-# Author: Amelie Deshazer 
-# Date: 2024-07-16 
-# Purpose: Camera procedure to control the camera 
-
-
-import logging 
-log = logging.getLogger(__name__)
-log.addHandler(logging.NullHandler())
-
 #Author: Amelie Deshazer 
 #Date: 2024-07-03 
-#Purpose: Procedure for controlling keithley 2100 powermeter. 
+#Purpose: Procedure for streaming the Thorlabs CS165MU camera. 
 
 
 import logging 
@@ -17,74 +8,86 @@ import logging
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
-import pandas as pd 
 import time 
-import c2 as cv2
-from time import sleep
+import queue
+import cv2
 from pymeasure.log import console_log
-from pymeasure.instruments.thorlabs import CS165MUM
 from pymeasure.display.windows import ManagedWindow
 from pymeasure.experiment import Results, Worker, Procedure, FloatParameter, IntegerParameter
 from pymeasure.display import Plotter
+from procedure.microscope.focus import FocusScorer, Drift
+from procedure.thorlabs.camera_pipeline import FramePipeline, ColorConversion, FocusStage, DriftStage
+from procedure.simulation import connect
+from procedure.common import InstrumentedProcedure
 
 
-class Keithley2100Procedure(Procedure):
+class CS165MUProcedure(InstrumentedProcedure, Procedure):
     camera_visa = 0 #must add visa address
-    stage_visa = 
-    #wait_time = FloatParameter('Time', units = 's', default = 0.01)
-    log.info(f"Wait_time initialized to {visa}")
-    exposure_time = FloatParameter('Exposure Time', units = 's', default = 0.01)
-    DATA_COLUMNS = ['Time(s)', 'Voltage(V)']
+    duration = FloatParameter('Duration', units = 's', default = 10)
+    slots = IntegerParameter('Ring Buffer Slots', default = 8, minimum = 2)
+    drift_roi = IntegerParameter('Drift ROI Size', units = 'px', default = 256, minimum = 16)
+    log.info(f"Camera address initialized to {camera_visa}")
+
+    DATA_COLUMNS = ['Frame', 'Time (s)', 'Focus Score', 'Drift X (px)', 'Drift Y (px)',
+                    'Latency (s)', 'Dropped Frames']
 
     def startup(self):
+        self.start_instrumentation()
         log.info("Starting up Thorlabs Color Camera...")
-        self.camera = CS165MUM(self.visa) 
-        image = self.camera.image_acquire()
-        sleep(0.01)
-        image_bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR) #convert array from RGB to BGR
-        cv2.imshow('image', image_bgr)
-        
-        #initialize the instrument
+        self.camera = self.instrument(connect('CS165MUM', self.camera_visa), 'camera')
+
+        #the grab thread keeps the sensor busy while frames are converted and scored
+        self.pipeline = FramePipeline(self.camera.image_acquire, [
+            ColorConversion(cv2.COLOR_RGB2BGR),
+            FocusStage(FocusScorer(roi = 'auto', level = 1)),
+            DriftStage(Drift, roi = 'centre', roi_size = (self.drift_roi, self.drift_roi)),
+        ], slots = self.slots)
         log.info("Starting up the measurement...")
 
-        #focus 
-
-        stage = 
     def execute(self):
-        time_0 = time.time()
-        while True:
-            time_1 = time.time()
-            self.keithley.start_buffer()
-            dtime = time_1 - time_0 #measure time elapsed
-            data = {'Time (s)': dtime,
-                'Voltage(V)': self.keithley.voltage
-            }
-            print(data)
+        self.pipeline.start()
+        time_0 = time.perf_counter()
+        while time.perf_counter() - time_0 < self.duration:
+            try:
+                result = self.pipeline.results.get(timeout = 0.1)
+            except queue.Empty:
+                result = None
+            if result is not None:
+                data = {'Frame': result['frame'],
+                    'Time (s)': result['timestamp'] - time_0,
+                    'Focus Score': result.get('focus'),
+                    'Drift X (px)': result.get('drift_x'),
+                    'Drift Y (px)': result.get('drift_y'),
+                    'Latency (s)': result['latency'],
+                    'Dropped Frames': self.pipeline.dropped
+                }
+                self.emit('results', data)
 
-            self.emit('results', data)
-            sleep(self.wait_time)
-            
             if self.should_stop():
                 log.info("Stopping...")
                 break 
     
     def shutdown(self): 
-        pass
+        #the pipeline threads must stop even if execute failed or was aborted
+        if getattr(self, 'pipeline', None) is not None:
+            self.pipeline.stop()
+            log.info("Frame pipeline counters: %s" % self.pipeline.counters())
+        self.stop_instrumentation()
 class ManagedWindow(ManagedWindow):
     def __init__(self): 
-        super().__init__(procedure_class = Keithley2100Procedure, 
-            inputs = ['wait_time'], 
-            displays = ['wait_time', 'voltage'], 
+        super().__init__(procedure_class = CS165MUProcedure, 
+            inputs = ['duration', 'slots', 'drift_roi', 'instrumentation', 'instrumentation_file'], 
+            displays = ['duration', 'slots'], 
             x_axis = 'Time (s)', 
-            y_axis = 'Voltage (V)'
+            y_axis = 'Focus Score'
         )
-        self.setWindowTitle('Keithley 2100 Powermeter')
+        self.setWindowTitle('Thorlabs CS165MU Camera')
 
 if __name__ == '__main__':
     console_log(log)
-    procedure = Keithley2100Procedure() #calling the class procedure
+    procedure = CS165MUProcedure() #calling the class procedure
     
-    data_filename = 'keithley2.csv'
+    data_filename = 'cs165mu.csv'
     log.info("Constructing the Results with a data file: %s" % data_filename)
     results = Results(procedure, data_filename)
     log.info("Results created")
@@ -104,4 +107,4 @@ class CovertRGBtoBGR:
     def __init__(self):
         pass
     def covert(self, image):
-        return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
\ No newline at end of file
+        return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
@@ -0,0 +1,114 @@
+# Purpose: Sinusoidal fringe fitting for the piezo interference sweeps
+
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+from collections import namedtuple
+
+import numpy as np
+
+
+FringeFit = namedtuple('FringeFit', ['period', 'period_error', 'amplitude', 'offset',
+                                     'visibility', 'phase', 'fringes'])
+FringeFit.__doc__ = """
+Result of :func:`fit_fringe`: the fringe ``period`` and its standard error
+in units of the drive, the ``amplitude`` and ``offset`` of the signal, the
+``visibility`` (amplitude / offset), the ``phase`` in radians at zero drive
+and the number of ``fringes`` covered by the data.
+"""
+
+
+def fit_fringe(x, y, iterations=5, min_snr=5.):
+    """
+    Fit ``y = offset + amplitude * cos(2 pi x / period + phase)``.
+
+    The period is first estimated from the peak of the zero-padded spectrum
+    of the data (resampled onto a uniform grid if needed), then all four
+    parameters are refined by a few Gauss-Newton steps on the linearised
+    model. Everything is vectorised, so a fit of a few hundred points takes
+    well under a millisecond and can run after every step of a sweep.
+
+    The spectral peak always yields some period, even for flat or pure
+    noise data, so the fit is only kept if its amplitude exceeds
+    ``min_snr`` times its standard error from the residual, and is not
+    negligible against the signal itself.
+
+    :param x: Drive values (e.g. piezo voltage), in any order.
+    :param y: Signal at each drive value.
+    :param iterations: Number of Gauss-Newton refinements.
+    :param min_snr: Smallest ratio of the amplitude to its standard error.
+    :return: A :class:`FringeFit`, or None if the data show no fringe.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = x.size
+    if n < 8 or np.ptp(x) == 0:
+        return None
+
+    # centring the drive decorrelates the phase from the frequency
+    centre = x.mean()
+    t = x - centre
+    order = np.argsort(t)
+    grid = np.linspace(t[order[0]], t[order[-1]], n)
+    uniform = np.interp(grid, t[order], y[order])
+    uniform -= uniform.mean()
+    padded = 8 * n
+    spectrum = np.abs(np.fft.rfft(uniform * np.hanning(n), padded))
+    peak = int(np.argmax(spectrum[1:])) + 1
+    if peak >= spectrum.size - 1:
+        return None
+    # parabolic interpolation of the spectral peak
+    s0, s1, s2 = spectrum[peak - 1:peak + 2]
+    denominator = s0 - 2 * s1 + s2
+    offset = 0.5 * (s0 - s2) / denominator if denominator < 0 else 0.
+    frequency = (peak + offset) / (padded * (grid[1] - grid[0]))
+
+    a, b, c = _linear_fit(t, y, frequency)
+    for _ in range(iterations):
+        phase = 2 * np.pi * frequency * t
+        cos, sin = np.cos(phase), np.sin(phase)
+        residual = y - (a * cos + b * sin + c)
+        jacobian = np.column_stack([cos, sin, np.ones(n), 2 * np.pi * t * (b * cos - a * sin)])
+        step = np.linalg.lstsq(jacobian, residual, rcond=None)[0]
+        a, b, c, frequency = a + step[0], b + step[1], c + step[2], frequency + step[3]
+
+    phase = 2 * np.pi * frequency * t
+    cos, sin = np.cos(phase), np.sin(phase)
+    residual = y - (a * cos + b * sin + c)
+    jacobian = np.column_stack([cos, sin, np.ones(n), 2 * np.pi * t * (b * cos - a * sin)])
+    variance = residual @ residual / max(n - 4, 1)
+    try:
+        covariance = variance * np.linalg.inv(jacobian.T @ jacobian)
+        frequency_error = float(np.sqrt(max(covariance[3, 3], 0.)))
+    except np.linalg.LinAlgError:
+        frequency_error = np.inf
+
+    if frequency < 0:
+        frequency, b = -frequency, -b
+    if frequency == 0:
+        return None
+    amplitude = float(np.hypot(a, b))
+    # the standard error of a cos + b sin fitted to n points with this residual
+    amplitude_error = np.sqrt(2 * variance / n)
+    if amplitude <= min_snr * amplitude_error or amplitude <= np.sqrt(np.finfo(float).eps) * np.abs(y).max():
+        log.debug("No fringe: amplitude %g against a standard error of %g" % (amplitude, amplitude_error))
+        return None
+    # a cos(wt) + b sin(wt) = A cos(wt + phi); referred back to x = 0
+    phi = np.arctan2(-b, a) - 2 * np.pi * frequency * centre
+    phi = float(np.angle(np.exp(1j * phi)))
+    period = 1 / float(frequency)
+    return FringeFit(period=period,
+                     period_error=frequency_error * period ** 2,
+                     amplitude=amplitude,
+                     offset=float(c),
+                     visibility=amplitude / c if c else np.nan,
+                     phase=phi,
+                     fringes=float(np.ptp(x) * frequency))
+
+
+def _linear_fit(t, y, frequency):
+    phase = 2 * np.pi * frequency * t
+    design = np.column_stack([np.cos(phase), np.sin(phase), np.ones(t.size)])
+    return np.linalg.lstsq(design, y, rcond=None)[0]
@@ -1,93 +1,172 @@
 # Procedure for KPZ101
-import logging 
+import logging
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
-import pandas as pd 
-from numpy import np
-from time import sleep
+import pandas as pd
+import numpy as np
 from pymeasure.log import console_log
-from pymeasure.instruments.keithley import Keithley2000
-from pymeasure.instruments.thorlabs import KPZ101
 from pymeasure.display.windows import ManagedWindow
-from pymeasure.experiment import Results, Worker, Procedure, FloatParameter, IntegerParameter
+from pymeasure.experiment import Results, Worker, Procedure, FloatParameter, IntegerParameter, BooleanParameter
 from pymeasure.display import Plotter
+from procedure.common import StepScheduler, FixedSettle, InstrumentedProcedure
+from procedure.simulation import connect
+from procedure.thorlabs.fringe import fit_fringe
 
 
-class InterferenceProcedure(Procedure):
-    visa = 'USB0::0x05E6::0x2100::1149087::INSTR' 
+class InterferenceProcedure(InstrumentedProcedure, Procedure):
+    visa = 'USB0::0x05E6::0x2100::1149087::INSTR'
     address = '29252556'
-    wait_time = FloatParameter('Time(s)', units = 's', default = 0.1)
+    wait_time = FloatParameter('Settle Time', units = 's', default = 0.01)
     #voltage_stage = FloatParameter('Voltage (V):Stage', units = 'V', default = 0.0)
-    start_freq = FloatParameter('Start Frequency', units = 'Hz', default = 0.0)
-    stop_freq = FloatParameter('Stop Frequency', units = 'Hz', default = 750)
-    step_size = FloatParameter('Step Size', units = 'Hz', default = 0.266)
+    #the names are kept from the original parameters; they set the piezo voltage ramp
+    start_freq = FloatParameter('Start Voltage', units = 'V', default = 5.0, minimum = 0, maximum = 75)
+    stop_freq = FloatParameter('Stop Voltage', units = 'V', default = 75.0, minimum = 0, maximum = 75)
+    step_size = FloatParameter('Step Size', units = 'V', default = 0.266, minimum = 0.001)
+    #the return sweep retraces the ramp to show the piezo hysteresis
+    bidirectional = BooleanParameter('Bidirectional', default = True)
+    #every step averages a buffered block of readings taken by the meter itself
+    samples = IntegerParameter('Samples per Step', default = 16, minimum = 1, maximum = 1024)
+    nplc = FloatParameter('Integration Time', units = 'NPLC', default = 0.1, minimum = 0.01, maximum = 10)
+    #a sweep direction ends as soon as the fitted fringe period is known to the tolerance
+    early_stop = BooleanParameter('Stop When Resolved', default = False)
+    period_tolerance = FloatParameter('Period Tolerance', default = 0.002, minimum = 0)
+    min_fringes = FloatParameter('Minimum Fringes', default = 3, minimum = 1)
 
-    log.info(f"Wait_time initialized to {wait_time}")
-    log.info(f"Start frequency initialized to {start_freq}")
-    log.info(f"Stop frequency initialized to {stop_freq}")
-    log.info(f"Step size initialized to {step_size}")
-
-    DATA_COLUMNS = ['Voltage(V):Stage', 'Voltage(V)']
+    DATA_COLUMNS = ['Step', 'Direction', 'Voltage(V):Stage', 'Voltage(V)', 'Voltage Error(V)',
+                    'Period(V)', 'Visibility', 'Phase(rad)']
 
     def startup(self):
+        self.start_instrumentation()
         log.info("Starting up the Keithley 2100 powermeter...")
-        self.keithley = Keithley2000(self.visa) 
-        self.kpz101 = KPZ101(self.address)
+        self.keithley = self.instrument(connect('Keithley2000', self.visa), 'keithley')
+        self.kpz101 = self.instrument(connect('KPZ101', self.address), 'kpz101')
         self.keithley.measure_voltage(0.01, ac = False)
+        self.keithley.voltage_nplc = self.nplc
+        if self.samples > 1:
+            self.keithley.config_buffer(self.samples)
         self.kpz101.move_home()
-        sleep(self.wait_time) 
-        
+        self.sleep(self.wait_time)
+        self.fits = {}
+
         #initialize the instrument
         log.info("Starting up the measurement...")
+
     def execute(self):
-        voltages = np.arange(5, 75, 0.266)
+        voltages = np.arange(self.start_freq, self.stop_freq + self.step_size / 2, self.step_size)
+        self.step = 0
+        last = self.sweep(voltages, 1)
+        if self.bidirectional and not self.should_stop():
+            #retrace whatever the forward sweep covered
+            self.sweep(voltages[last::-1], -1)
+
+        for direction, fit in self.fits.items():
+            if fit is not None:
+                log.info("%s sweep: period %.4f +/- %.4f V, visibility %.3f, phase %.3f rad"
+                         % ('Forward' if direction > 0 else 'Return', fit.period,
+                            fit.period_error, fit.visibility, fit.phase))
+        if self.fits.get(1) is not None and self.fits.get(-1) is not None:
+            shift = np.angle(np.exp(1j * (self.fits[-1].phase - self.fits[1].phase)))
+            log.info("Hysteresis phase shift %.3f rad (%.4f V)"
+                     % (shift, shift / (2 * np.pi) * self.fits[1].period))
 
-        for voltage in voltages: 
-            piezo_voltage = self.kpz101.set_voltage(voltage)
-            self.keithley.start_buffer()
+    def sweep(self, voltages, direction):
+        """
+        Step the piezo through ``voltages`` and emit the averaged reading and
+        the running fringe fit at every step.
 
-            data = {'Voltage (V):Stage': piezo_voltage,
-                'Voltage(V)': self.keithley.voltage
+        :return: Index of the last voltage measured.
+        """
+        if self.samples > 1:
+            #the buffer holds its block until the next :INIT, so the piezo can
+            #move on while the block is read back
+            scheduler = StepScheduler(self.kpz101.set_voltage, self.acquire, self.fetch,
+                                      FixedSettle(self.wait_time), overlap = True)
+        else:
+            scheduler = StepScheduler(self.kpz101.set_voltage, self.read,
+                                      settle = FixedSettle(self.wait_time))
+
+        measured = np.empty(voltages.size)
+        values = np.empty(voltages.size)
+        fit = None
+        index = -1
+        self.resolved = False
+        for index, (voltage, (mean, error)) in enumerate(scheduler.run(voltages, self.stop_sweep)):
+            measured[index], values[index] = voltage, mean
+            fit = fit_fringe(measured[:index + 1], values[:index + 1])
+            self.resolved = self.early_stop and self.is_resolved(fit)
+            data = {'Step': self.step,
+                'Direction': direction,
+                'Voltage(V):Stage': voltage,
+                'Voltage(V)': mean,
+                'Voltage Error(V)': error,
+                'Period(V)': fit.period if fit else np.nan,
+                'Visibility': fit.visibility if fit else np.nan,
+                'Phase(rad)': fit.phase if fit else np.nan
             }
-            print(data)
             self.emit('results', data)
-            sleep(self.wait_time)
-            
-            if self.should_stop():
-                log.info("Stopping...")
-                break 
-    
-    def shutdown(self): 
+            self.step += 1
+            self.emit('progress', 100 * self.step / (voltages.size * (2 if self.bidirectional else 1)))
+
+        self.fits[direction] = fit
+        log.info("Sweep timing (s): %s" % scheduler.summary())
+        if self.resolved:
+            log.info("Fringe period resolved after %d steps" % (index + 1))
+        return index
+
+    def stop_sweep(self):
+        return self.should_stop() or self.resolved
+
+    def is_resolved(self, fit):
+        return fit is not None and fit.fringes >= self.min_fringes \
+            and fit.period_error <= self.period_tolerance * fit.period
+
+    def acquire(self):
+        self.keithley.start_buffer()
+        self.keithley.wait_for_buffer(should_stop = self.should_stop,
+                                      interval = max(0.001, self.samples * self.nplc / 60 / 4))
+
+    def fetch(self, latched):
+        readings = np.asarray(self.keithley.buffer_data, dtype = np.float64)
+        return readings.mean(), readings.std(ddof = 1) / np.sqrt(readings.size)
+
+    def read(self):
+        return self.keithley.voltage, np.nan
+
+    def shutdown(self):
+        if self.samples > 1:
+            self.keithley.disable_buffer()
         self.kpz101.disconnect()
+        self.stop_instrumentation()
 class ManagedWindow(ManagedWindow):
-    def __init__(self): 
-        super().__init__(procedure_class = Keithley2100Procedure, 
-            inputs = ['wait_time', 'start_freq', 'stop_freq', 'step_size'] 
-            displays = ['wait_time', 'start_freq', 'stop_freq', 'step_size',
-                        'voltage'], 
-            x_axis = 'Voltage (V):Stage', 
-            y_axis = 'Voltage (V)'
+    def __init__(self):
+        super().__init__(procedure_class = InterferenceProcedure,
+            inputs = ['wait_time', 'start_freq', 'stop_freq', 'step_size', 'bidirectional',
+                      'samples', 'nplc', 'early_stop', 'period_tolerance', 'min_fringes',
+                      'instrumentation', 'instrumentation_file'],
+            displays = ['wait_time', 'start_freq', 'stop_freq', 'step_size', 'samples'],
+            x_axis = 'Voltage(V):Stage',
+            y_axis = 'Voltage(V)'
         )
         self.setWindowTitle('Measure Interference')
 
 if __name__ == '__main__':
     console_log(log)
-    procedure = Keithley2100Procedure() #calling the class procedure
-    
+    procedure = InterferenceProcedure() #calling the class procedure
+
     data_filename = 'measure_interference.csv'
     log.info("Constructing the Results with a data file: %s" % data_filename)
     results = Results(procedure, data_filename)
     log.info("Results created")
 
-    plotter = Plotter(results) 
+    plotter = Plotter(results)
     log.info("Plotter created")
-    plotter.start() 
+    plotter.start()
 
     log.info("Creating the worker...")
     worker = Worker(results)
     log.info("Worker created")
     worker.start()
     worker.join(timeout = 3600) #timeout in seconds
-    log.info("Measurement is finished.")
\ No newline at end of file
+    log.info("Measurement is finished.")
@@ -1,93 +1,186 @@
 # Procedure for KPZ101
-import logging 
+import logging
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
-import pandas as pd 
-from numpy import np
-from time import sleep
+import pandas as pd
+import numpy as np
+from time import perf_counter
 from pymeasure.log import console_log
-from pymeasure.instruments.keithley import Keithley2000
-from pymeasure.instruments.thorlabs import KPZ101
 from pymeasure.display.windows import ManagedWindow
-from pymeasure.experiment import Results, Worker, Procedure, FloatParameter, IntegerParameter
+from pymeasure.experiment import Results, Worker, Procedure, FloatParameter, IntegerParameter, BooleanParameter
 from pymeasure.display import Plotter
+from procedure.common import StepScheduler, FixedSettle, InstrumentedProcedure
+from procedure.simulation import connect
+from procedure.thorlabs.fringe import fit_fringe
 
 
-class Keithley2100Procedure(Procedure):
-    visa = 'USB0::0x05E6::0x2100::1149087::INSTR' 
+class KPZ101Procedure(InstrumentedProcedure, Procedure):
+    visa = 'USB0::0x05E6::0x2100::1149087::INSTR'
     address = '29252556'
     wait_time = FloatParameter('Time(s)', units = 's', default = 0.1)
     #voltage_stage = FloatParameter('Voltage (V):Stage', units = 'V', default = 0.0)
-    start_freq = FloatParameter('Start Frequency', units = 'Hz', default = 0.0)
-    stop_freq = FloatParameter('Stop Frequency', units = 'Hz', default = 750)
-    step_size = FloatParameter('Step Size', units = 'Hz', default = 0.266)
+    #the names are kept from the original parameters; they set the piezo voltage ramp
+    start_freq = FloatParameter('Start Voltage', units = 'V', default = 5.0, minimum = 0, maximum = 75)
+    stop_freq = FloatParameter('Stop Voltage', units = 'V', default = 75.0, minimum = 0, maximum = 75)
+    step_size = FloatParameter('Step Size', units = 'V', default = 0.266, minimum = 0.001)
+
+    #continuous ramp: the piezo is driven through the whole range while the meter
+    #fills its buffer on its own trigger, and the two are matched up by time afterwards
+    ramp = BooleanParameter('Continuous Ramp', default = False)
+    ramp_rate = FloatParameter('Ramp Rate', units = 'V/s', default = 20.0, minimum = 0.01)
+    update_interval = FloatParameter('Ramp Update Interval', units = 's', default = 0.005, minimum = 0.001)
+    sample_interval = FloatParameter('Sample Interval', units = 's', default = 0.002)
+    nplc = FloatParameter('Integration Time', units = 'NPLC', default = 0.05, minimum = 0.01, maximum = 10)
 
     log.info(f"Wait_time initialized to {wait_time}")
-    log.info(f"Start frequency initialized to {start_freq}")
-    log.info(f"Stop frequency initialized to {stop_freq}")
+    log.info(f"Start voltage initialized to {start_freq}")
+    log.info(f"Stop voltage initialized to {stop_freq}")
     log.info(f"Step size initialized to {step_size}")
 
-    DATA_COLUMNS = ['Voltage(V):Stage', 'Voltage(V)']
+    DATA_COLUMNS = ['Time(s)', 'Voltage(V):Stage', 'Voltage(V)']
 
     def startup(self):
+        self.start_instrumentation()
         log.info("Starting up the Keithley 2100 powermeter...")
-        self.keithley = Keithley2000(self.visa) 
-        self.kpz101 = KPZ101(self.address)
+        self.keithley = self.instrument(connect('Keithley2000', self.visa), 'keithley')
+        self.kpz101 = self.instrument(connect('KPZ101', self.address), 'kpz101')
         self.keithley.measure_voltage(0.01, ac = False)
+        self.keithley.voltage_nplc = self.nplc
         self.kpz101.move_home()
-        sleep(self.wait_time) 
-        
+        self.sleep(self.wait_time)
+
         #initialize the instrument
         log.info("Starting up the measurement...")
-    def execute(self):
-        voltages = np.arange(5, 75, 0.266)
 
-        for voltage in voltages: 
-            piezo_voltage = self.kpz101.set_voltage(voltage)
-            self.keithley.start_buffer()
+    def execute(self):
+        if self.ramp:
+            self.execute_ramp()
+            return
 
-            data = {'Voltage (V):Stage': piezo_voltage,
-                'Voltage(V)': self.keithley.voltage
+        voltages = np.arange(self.start_freq, self.stop_freq + self.step_size / 2, self.step_size)
+        scheduler = StepScheduler(self.kpz101.set_voltage, lambda: self.keithley.voltage,
+                                  settle = FixedSettle(self.wait_time))
+        time_0 = perf_counter()
+        for step, (voltage, reading) in enumerate(scheduler.run(voltages, self.should_stop)):
+            data = {'Time(s)': perf_counter() - time_0,
+                'Voltage(V):Stage': voltage,
+                'Voltage(V)': reading
             }
-            print(data)
             self.emit('results', data)
-            sleep(self.wait_time)
-            
-            if self.should_stop():
-                log.info("Stopping...")
-                break 
-    
-    def shutdown(self): 
-        pass
+            self.emit('progress', 100 * (step + 1) / voltages.size)
+        log.info("Step timing (s): %s" % scheduler.summary())
+
+    def execute_ramp(self):
+        """
+        Drive one continuous ramp from the start to the stop voltage while the
+        meter records a single buffer, then emit the readings against the
+        piezo voltage interpolated at each reading's time.
+
+        The KPZ101 has no ramp generator, so the ramp is a staircase of
+        setpoints every ``update_interval``, each logged with the time it was
+        sent. The meter's readings are timed from the end of the ``:INIT``
+        write and its programmed sample period, each at the middle of its
+        integration after the trigger delay that precedes it. The sample
+        period is stretched if the ramp would not fit in the 1024 point
+        buffer.
+        """
+        span = self.stop_freq - self.start_freq
+        duration = abs(span) / self.ramp_rate
+        integration = self.nplc / 60
+        period = max(self.sample_interval, integration, duration / 1024)
+        if period > self.sample_interval:
+            log.info("Sample interval stretched to %.4f s to fit the ramp in the buffer" % period)
+        points = int(np.clip(np.ceil(duration / period) + 1, 2, 1024))
+
+        self.kpz101.set_voltage(self.start_freq)
+        self.sleep(self.wait_time)
+        self.keithley.config_buffer(points, period - integration)
+
+        self.keithley.start_buffer()
+        time_0 = perf_counter()
+        command_times, command_voltages = self.drive_ramp(time_0, duration, span)
+        self.keithley.wait_for_buffer(should_stop = self.should_stop,
+                                      timeout = 2 * points * period + 1,
+                                      interval = 0.05)
+        if self.should_stop():
+            self.keithley.stop_buffer()
+            log.info("Stopping...")
+            return
+        readings = np.asarray(self.keithley.buffer_data, dtype = np.float64)
+
+        #the trigger delay comes before each reading
+        times = period * (np.arange(readings.size) + 1) - integration / 2
+        #only readings taken while the ramp ran have a known piezo voltage
+        inside = (times >= command_times[0]) & (times <= command_times[-1])
+        voltages = np.interp(times[inside], command_times, command_voltages)
+        self.emit_ramp(times[inside], voltages, readings[inside])
+
+        fit = fit_fringe(voltages, readings[inside])
+        if fit is not None:
+            log.info("Ramp of %d readings in %.2f s: fringe period %.4f +/- %.4f V, visibility %.3f"
+                     % (voltages.size, duration, fit.period, fit.period_error, fit.visibility))
+
+    def drive_ramp(self, time_0, duration, span):
+        """
+        Send the ramp setpoints and return the times (relative to ``time_0``)
+        and voltages of the commands actually sent.
+        """
+        times, voltages = [], []
+        elapsed = 0.
+        while elapsed < duration and not self.should_stop():
+            voltage = self.start_freq + span * elapsed / duration
+            sent = perf_counter()
+            self.kpz101.set_voltage(voltage)
+            times.append((sent + perf_counter()) / 2 - time_0)
+            voltages.append(voltage)
+            elapsed = perf_counter() - time_0
+            self.sleep(max(0., self.update_interval - (elapsed - times[-1])))
+            elapsed = perf_counter() - time_0
+        self.kpz101.set_voltage(self.stop_freq)
+        times.append(perf_counter() - time_0)
+        voltages.append(self.stop_freq)
+        return np.array(times), np.array(voltages)
+
+    def emit_ramp(self, times, voltages, readings):
+        for t, v, r in zip(times, voltages, readings):
+            self.emit('results', {'Time(s)': t, 'Voltage(V):Stage': v, 'Voltage(V)': r})
+        self.emit('progress', 100)
+
+    def shutdown(self):
+        if self.ramp:
+            self.keithley.disable_buffer()
+        self.kpz101.disconnect()
+        self.stop_instrumentation()
 class ManagedWindow(ManagedWindow):
-    def __init__(self): 
-        super().__init__(procedure_class = Keithley2100Procedure, 
-            inputs = ['wait_time', 'start_freq', 'stop_freq', 'step_size'] 
-            displays = ['wait_time', 'start_freq', 'stop_freq', 'step_size',
-                        'voltage'], 
-            x_axis = 'Voltage (V):Stage', 
-            y_axis = 'Voltage (V)'
+    def __init__(self):
+        super().__init__(procedure_class = KPZ101Procedure,
+            inputs = ['wait_time', 'start_freq', 'stop_freq', 'step_size', 'ramp', 'ramp_rate',
+                      'update_interval', 'sample_interval', 'nplc',
+                      'instrumentation', 'instrumentation_file'],
+            displays = ['wait_time', 'start_freq', 'stop_freq', 'step_size', 'ramp'],
+            x_axis = 'Voltage(V):Stage',
+            y_axis = 'Voltage(V)'
         )
         self.setWindowTitle('Measure Interference')
 
 if __name__ == '__main__':
     console_log(log)
-    procedure = Keithley2100Procedure() #calling the class procedure
-    
+    procedure = KPZ101Procedure() #calling the class procedure
+
     data_filename = 'measure_interference.csv'
     log.info("Constructing the Results with a data file: %s" % data_filename)
     results = Results(procedure, data_filename)
     log.info("Results created")
 
-    plotter = Plotter(results) 
+    plotter = Plotter(results)
     log.info("Plotter created")
-    plotter.start() 
+    plotter.start()
 
     log.info("Creating the worker...")
     worker = Worker(results)
     log.info("Worker created")
     worker.start()
     worker.join(timeout = 3600) #timeout in seconds
-    log.info("Measurement is finished.")
\ No newline at end of file
+    log.info("Measurement is finished.")